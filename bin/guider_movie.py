@@ -18,7 +18,8 @@ from opscore.utility import assembleImage
 
 matplotlib.use('agg')
 
-gimgbase = 'proc-gimg-%04d.fits.gz'
+# proc- files are either gzipped (.fits.gz) or tile-compressed (.fits).
+gimgbase = 'proc-gimg-%04d.fits'
 tempbase = 'temp-gimg-%04d.png'
 
 
@@ -390,6 +391,8 @@ def make_images(gimgdir, start, end, tempdir, cmap=None, verbose=False):
     files = []
     for i in range(start, end):
         infile = os.path.join(gimgdir, gimgbase % i)
+        if not os.path.exists(infile):
+            infile += '.gz'
         if os.path.exists(infile):
             outfile = os.path.join(tempdir, tempbase % count)
             imageMaker = ImageMaker(infile)
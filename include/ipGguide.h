@@ -36,9 +36,13 @@
 #define STATIC static
 #define DOUBLE double
 
-// Error code; must match guiderImage.py:FWHM_BAD
+// Error code; must match guideLib.py:FWHM_BAD
 #define FWHM_BAD 99.99
 
+// Version of the interface python calls (the REGION, MASK and FIBERDATA
+// structs and the functions that take them); must match guideLib.py:ABI_VERSION
+#define GUIDE_ABI_VERSION 1
+
 /*the Alta guider is 16 bit, but bitshifted in GCAM */
 /* max value of guider data*/
 
@@ -221,6 +225,17 @@ void rotate_mask(const MASK* maskin, MASK* maskout, float theta);
 FIBERDATA* fiberdata_new(int nfibers);
 void fiberdata_free(FIBERDATA* f);
 
+int guide_abi_version(void);
+void guide_struct_sizes(int *sizes);
+
+int gfindstars_buffer(
+    S16 *data,                 /* data picture, dedarked and flattened */
+    int nrow, int ncol,        /* its size */
+    int rowstride,             /* elements from the start of one row to the next */
+    struct g_fiberdata *ptr,
+    int mode
+    );
+
 int gbin(
      REGION *inputReg,       /* the input region */
      REGION *outputReg       /* the output region */
@@ -2,17 +2,75 @@
 """ Wrap top-level guider functions. """
 
 import os
+import sys
 import threading
 
+import numpy
+
 import guiderActor
 import guiderActor.myGlobals as myGlobals
 import opscore.protocols.keys as keys
 import opscore.protocols.types as types
-from guiderActor import GuiderState, Msg
+from guiderActor import GuiderState, Msg, plugmapCache, stageTimer
 from opscore.utility.qstr import qstr
 from sdss.utilities import yanny
 
 
+def _guide_offsets_path(plate, pointingID, wavelength):
+    """The plateGuideOffsets file of plate for this pointing and wavelength, in the platelist product."""
+    # plates/0046XX/004671/plateGuideOffsets-004671-p1-l16600.par
+    return os.path.join(os.environ['PLATELIST_DIR'], 'plates',
+                        '%04dXX' % (int(plate / 100)), '%06d' % (plate),
+                        'plateGuideOffsets-%06d-p%d-l%05d.par' %
+                        (plate, pointingID, wavelength))
+
+
+def _read_guide_offsets(path):
+    """
+    Read the HAOFFSETS table of a plateGuideOffsets file, and return the guide
+    probes' rows as an array of their iguide and delha, xfoff and yfoff arrays.
+    """
+    haOffsets = yanny.yanny(path, np=True)['HAOFFSETS']
+    guide = haOffsets[haOffsets['holetype'] == 'GUIDE']
+    names = ('iguide', 'delha', 'xfoff', 'yfoff')
+    guideOffsets = numpy.empty(len(guide), dtype=[(name, guide.dtype[name]) for name in names])
+    for name in names:
+        guideOffsets[name] = guide[name]
+    return guideOffsets
+
+
+def _fscan(cmdVar, plPlugMapMKey):
+    """The (fscanMJD, fscanID) of a getGprobesPlateGeom reply, as strings, for a snapshot validation."""
+    return tuple(str(v) for v in cmdVar.getLastKeyVarData(plPlugMapMKey)[1:3])
+
+
+class _Call(threading.Thread):
+    """
+    Call func(*args) in a new thread, so that commands to other actors that
+    don't depend on each other can wait for their replies at the same time.
+    """
+
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self, name=func.__name__)
+        self.daemon = True
+        self.func, self.args = func, args
+        self.result = self.excInfo = None
+        self.start()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            self.excInfo = sys.exc_info()
+
+    def wait(self):
+        """Wait for the call to finish, and return its result or raise its exception."""
+        self.join()
+        if self.excInfo is not None:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.result
+
+
 class GuiderCmd(object):
     """Wrap commands to the guider actor"""
 
@@ -109,6 +167,12 @@ class GuiderCmd(object):
             keys.Key(
                 "geek",
                 help='Show things that only some of us love'),
+            keys.Key(
+                "reset",
+                help='Clear the accumulated values'),
+            keys.Key(
+                "clear",
+                help='Delete the cached files and cartridge snapshots'),
             keys.Key(
                 'cartfile',
                 types.String(),
@@ -205,6 +269,8 @@ class GuiderCmd(object):
             ('focus', '(on|off)', self.focus),
             ('scale', '(on|off)', self.scale),
             ('status', '[geek]', self.status),
+            ('timing', '[reset]', self.timing),
+            ('plugmapCache', '[clear] [<plate>]', self.plugmapCache),
             ('centerUp', '', self.centerUp),
             ('fk5InFiber', '[<probe>] [<time>]', self.fk5InFiber),
             ('starInFiber', '[<probe>] [<gprobe>] [<fromProbe>] [<fromGprobe>]', self.starInFiber),
@@ -509,6 +575,24 @@ class GuiderCmd(object):
         # Check that the claimed cartridge is actually on the telescope
         #
         actorState = guiderActor.myGlobals.actorState
+        timer = stageTimer.FrameTimer()
+
+        extraArgs = ""
+        if plate:
+            extraArgs += " plate=%s" % (plate)
+        if mjd:
+            extraArgs += " mjd=%s" % (mjd)
+        if fscanId:
+            extraArgs += " fscanId=%s" % (fscanId)
+
+        # If we already know which cartridge to look up, query the platedb
+        # while the mcp tells us which cartridge is on the telescope.
+        gState = actorState.gState
+        snapshot = platedbCalls = None
+        if cartridge > 0 and cartridge != 19:
+            snapshot = gState.cartridgeSnapshots.get(cartridge, pointing)
+            platedbCalls = self._startPlatedbQueries(cmd, timer, cartridge, pointing, extraArgs,
+                                                     snapshot)
 
         if force and cartridge != -1:
             loadedCartridge = cartridge
@@ -516,12 +600,15 @@ class GuiderCmd(object):
                        .format(loadedCartridge))
         else:
             instrumentNumKey = actorState.models["mcp"].keyVarDict["instrumentNum"]
-            cmdVar = actorState.actor.cmdr.call(
-                actor="mcp",
-                forUserCmd=cmd,
-                cmdStr="info",
-                keyVars=[instrumentNumKey])
+            with timer.stage('mcp'):
+                cmdVar = actorState.actor.cmdr.call(
+                    actor="mcp",
+                    forUserCmd=cmd,
+                    cmdStr="info",
+                    keyVars=[instrumentNumKey])
             if cmdVar.didFail:
+                for call in (platedbCalls or {}).values():
+                    call.join()
                 cmd.fail("text=\"Failed to ask mcp for info on cartridges\"")
                 return
 
@@ -539,13 +626,14 @@ class GuiderCmd(object):
             if force:
                 cmd.warn("text=\"%s\"" % (msg + "; proceeding"))
             else:
+                for call in (platedbCalls or {}).values():
+                    call.join()
                 cmd.fail("text=\"%s\"" % msg)
                 return
 
         # cart 19 is the engineering camera, and has no info in platedb.
         if cartridge == 19:
             # don't do anything but clear the gprobes and output status.
-            gState = actorState.gState
             gState.deleteAllGprobes()
             gState.cartridge = cartridge
             gState.plate = 0
@@ -555,29 +643,43 @@ class GuiderCmd(object):
             queue.put(Msg(Msg.STATUS, cmd, finish=True))
             return
 
-        # Get the plate from the plateDB
-        extraArgs = ""
-        if plate:
-            extraArgs += " plate=%s" % (plate)
-        if mjd:
-            extraArgs += " mjd=%s" % (mjd)
-        if fscanId:
-            extraArgs += " fscanId=%s" % (fscanId)
+        # Get the plate and the valid gprobes from the plateDB
+        if platedbCalls is None:
+            snapshot = gState.cartridgeSnapshots.get(cartridge, pointing)
+            platedbCalls = self._startPlatedbQueries(cmd, timer, cartridge, pointing, extraArgs,
+                                                     snapshot)
+        replies = dict((name, call.wait()) for name, call in platedbCalls.items())
 
         pointingInfoKey = actorState.models['platedb'].keyVarDict[
             'pointingInfo']
         guideWavelengthKey = actorState.models['platedb'].keyVarDict[
             'guideWavelength']
-
-        cmdVar = actorState.actor.cmdr.call(actor="platedb", forUserCmd=cmd,
-                                            cmdStr="loadCartridge cartridge=%d pointing=%s %s" % \
-                                                (cartridge, pointing, extraArgs),
-                                            keyVars=[pointingInfoKey, guideWavelengthKey])
+        cmdVar = replies['loadCartridge']
         if cmdVar.didFail:
             cmd.fail("text=\"Failed to lookup plate corresponding to %d/%s\"" %
                      (cartridge, pointing))
             return
 
+        # Everything that decides what we load, for comparing with the cartridge's snapshot;
+        # the plugging's fscan is added from the plPlugMapM geometry reply.
+        validation = (extraArgs, guideWavelength,
+                      tuple(str(v) for v in cmdVar.getLastKeyVarData(pointingInfoKey)),
+                      str(cmdVar.getLastKeyVarData(guideWavelengthKey)))
+        plPlugMapMKey = actorState.models["platedb"].keyVarDict["plPlugMapM"]
+        geometryCall = None
+        if snapshot is not None:
+            # The same plate may have been replugged and rescanned: validate the fscan too.
+            geometryCall = self._startGeometryQuery(cmd, timer, extraArgs)
+            geometry = geometryCall.wait()
+            if (not geometry.didFail and
+                    snapshot.matches(validation + _fscan(geometry, plPlugMapMKey))):
+                self._loadSnapshot(cmd, queue, snapshot, timer)
+                return
+            gState.cartridgeSnapshots.drop(snapshot)
+            cmd.inform('text="cartridge %d has changed since it was last loaded"' % cartridge)
+            query = self._platedbQueries(cartridge, pointing, extraArgs)['getGprobes']
+            replies['getGprobes'] = self._platedbCall(cmd, timer, *query)
+
         plate = cmdVar.getLastKeyVarData(pointingInfoKey)[0]
         boresight_ra = cmdVar.getLastKeyVarData(pointingInfoKey)[3]
         boresight_dec = cmdVar.getLastKeyVarData(pointingInfoKey)[4]
@@ -606,16 +708,11 @@ class GuiderCmd(object):
         if design_ha < 0:
             design_ha += 360
 
-        # Lookup the valid gprobes
+        # The valid gprobes
         gprobeKey = actorState.models["platedb"].keyVarDict["gprobe"]
         gprobesInUseKey = actorState.models["platedb"].keyVarDict[
             "gprobesInUse"]
-        cmdVar = actorState.actor.cmdr.call(
-            actor="platedb",
-            forUserCmd=cmd,
-            cmdStr="getGprobes cartridge=%d pointing=%s %s" %
-            (cartridge, pointing, extraArgs),
-            keyVars=[gprobeKey, gprobesInUseKey])
+        cmdVar = replies['getGprobes']
         if cmdVar.didFail:
             cmd.fail("text=\"Failed to lookup gprobes for cartridge %d\"" %
                      (cartridge))
@@ -639,14 +736,31 @@ class GuiderCmd(object):
                          (probeId, str(key)))
                 continue
 
-        # Add in the plate/fibre geometry from plPlugMapM
-        plPlugMapMKey = actorState.models["platedb"].keyVarDict["plPlugMapM"]
+        # Add in the plate/fibre geometry from plPlugMapM, unless validating a snapshot
+        # already asked for it. Without a plate, platedb looks up the one its
+        # loadCartridge found, so it has to wait for that; the guide offsets are read while it runs.
         guideInfoKey = actorState.models["platedb"].keyVarDict["guideInfo"]
-        cmdVar = actorState.actor.cmdr.call(
-            actor="platedb",
-            forUserCmd=cmd,
-            cmdStr="getGprobesPlateGeom %s" % (extraArgs),
-            keyVars=[guideInfoKey, plPlugMapMKey])
+        if geometryCall is None:
+            geometryCall = self._startGeometryQuery(cmd, timer, extraArgs)
+
+        # Add in the refraction functions from plateGeomCoeffs
+        #
+        # I'm not sure how to get numeric pointing IDs, but it turns out that
+        # shared plates will only ever have one pointing.
+        pointingID = 1
+        if pointing != 'A':
+            cmd.warn(
+                'text="pointing name is %s, but we are using pointing #1. This is probably OK."'
+                % (pointing))
+
+        # Reads the guide offsets, if the guide wavelength is defined
+        offsetStatus = None
+        if guideWavelength and guideWavelength != -1:
+            with timer.stage('offsets'):
+                offsetStatus = self.addGuideOffsets(cmd, plate, guideWavelength,
+                                                    pointingID, gprobes)
+
+        cmdVar = geometryCall.wait()
         if cmdVar.didFail:
             cmd.fail("text=%s" % qstr(
                 "Failed to lookup gprobes's geometry for cartridge %d" %
@@ -655,6 +769,7 @@ class GuiderCmd(object):
         assert int(cmdVar.getLastKeyVarData(plPlugMapMKey)[0]) == plate
         fscanMJD = cmdVar.getLastKeyVarData(plPlugMapMKey)[1]
         fscanID = cmdVar.getLastKeyVarData(plPlugMapMKey)[2]
+        validation += _fscan(cmdVar, plPlugMapMKey)
 
         # unpack the platedb guideInfo keys into the probe
         for key in cmdVar.getKeyVarData(guideInfoKey):
@@ -666,23 +781,10 @@ class GuiderCmd(object):
                          (key[0], str(key)))
                 continue
 
-        # Add in the refraction functions from plateGeomCoeffs
-        #
-        # I'm not sure how to get numeric pointing IDs, but it turns out that
-        # shared plates will only ever have one pointing.
-        pointingID = 1
-        if pointing != 'A':
-            cmd.warn(
-                'text="pointing name is %s, but we are using pointing #1. This is probably OK."'
-                % (pointing))
-
         # Sets the guide offsets, if the guide wavelength is defined
-        gState = actorState.gState
         gState.refractionBalance = 0
         gState.guideWavelength = -1
-        if guideWavelength and guideWavelength != -1:
-            offsetStatus = self.addGuideOffsets(cmd, plate, guideWavelength,
-                                                pointingID, gprobes)
+        if offsetStatus is not None:
             if offsetStatus:
                 gState.guideWavelength = guideWavelength
                 gState.refractionBalance = 1
@@ -691,67 +793,135 @@ class GuiderCmd(object):
                 cmd.fail('text="failed to load guide offsets."')
                 return
 
+        loadArgs = dict(cartridge=cartridge,
+                        plate=plate,
+                        pointing=pointing,
+                        fscanMJD=fscanMJD,
+                        fscanID=fscanID,
+                        boresight_ra=boresight_ra,
+                        boresight_dec=boresight_dec,
+                        design_ha=design_ha,
+                        survey=survey,
+                        surveyMode=surveyMode)
+        # The master thread keeps what it builds from this in the snapshot.
+        snapshot = GuiderState.CartridgeSnapshot(cartridge, pointing, validation, loadArgs,
+                                                 gState.guideWavelength,
+                                                 gState.refractionBalance)
+        if offsetStatus:
+            snapshot.offsetsFile = _guide_offsets_path(plate, pointingID, guideWavelength)
+            snapshot.offsetsVersion = plugmapCache.file_version(snapshot.offsetsFile)
+
         # Send that information off to the master thread
         #
         queue.put(
             Msg(Msg.LOAD_CARTRIDGE,
                 cmd=cmd,
-                cartridge=cartridge,
-                plate=plate,
-                pointing=pointing,
-                fscanMJD=fscanMJD,
-                fscanID=fscanID,
-                boresight_ra=boresight_ra,
-                boresight_dec=boresight_dec,
-                design_ha=design_ha,
-                survey=survey,
-                surveyMode=surveyMode,
-                gprobes=gprobes))
+                gprobes=gprobes,
+                timer=timer,
+                snapshot=snapshot,
+                **loadArgs))
+
+    def _loadSnapshot(self, cmd, queue, snapshot, timer):
+        """Load a cartridge again from its snapshot, which the platedb says is still valid."""
+        cmd.inform('text="cartridge %d is still plugged with plate %d; using what was loaded before"' %
+                   (snapshot.cartridge, snapshot.plate))
+        gState = myGlobals.actorState.gState
+        gState.guideWavelength = snapshot.guideWavelength
+        gState.refractionBalance = snapshot.refractionBalance
+        if snapshot.refractionBalance == 1:
+            cmd.inform('text="refraction balance set to 1."')
+        queue.put(
+            Msg(Msg.LOAD_CARTRIDGE,
+                cmd=cmd,
+                gprobes=None,
+                timer=timer,
+                snapshot=snapshot,
+                **snapshot.loadArgs))
+
+    def _platedbCall(self, cmd, timer, stage, cmdStr, keyVars):
+        """Send cmdStr to the platedb and wait for its reply, timing it as stage of timer."""
+        with timer.stage(stage):
+            return myGlobals.actorState.actor.cmdr.call(
+                actor="platedb", forUserCmd=cmd, cmdStr=cmdStr, keyVars=keyVars)
+
+    def _platedbQueries(self, cartridge, pointing, extraArgs):
+        """The (stage, cmdStr, keyVars) of the platedb loadCartridge and getGprobes queries."""
+        keyVarDict = myGlobals.actorState.models['platedb'].keyVarDict
+        args = "cartridge=%d pointing=%s %s" % (cartridge, pointing, extraArgs)
+        return {'loadCartridge': ('platedb', "loadCartridge %s" % args,
+                                  [keyVarDict['pointingInfo'], keyVarDict['guideWavelength']]),
+                'getGprobes': ('gprobes', "getGprobes %s" % args,
+                               [keyVarDict['gprobe'], keyVarDict['gprobesInUse']])}
+
+    def _startGeometryQuery(self, cmd, timer, extraArgs):
+        """Start the platedb getGprobesPlateGeom query in its own thread; return its _Call."""
+        keyVarDict = myGlobals.actorState.models['platedb'].keyVarDict
+        return _Call(self._platedbCall, cmd, timer, 'geometry',
+                     "getGprobesPlateGeom %s" % (extraArgs),
+                     [keyVarDict['guideInfo'], keyVarDict['plPlugMapM']])
+
+    def _startPlatedbQueries(self, cmd, timer, cartridge, pointing, extraArgs, snapshot=None):
+        """
+        Start the platedb loadCartridge and getGprobes queries for cartridge,
+        which don't depend on each other, each in its own thread; return a dict
+        of their _Calls. A snapshot is validated by loadCartridge and then
+        getGprobesPlateGeom, so getGprobes is only needed without one.
+        """
+        queries = self._platedbQueries(cartridge, pointing, extraArgs)
+        if snapshot is not None:
+            del queries['getGprobes']
+        return dict((name, _Call(self._platedbCall, cmd, timer, *query))
+                    for name, query in queries.items())
 
     def addGuideOffsets(self, cmd, plate, wavelength, pointingID, gprobes):
         """
         Read in the new (needed for APOGEE/MARVELS) plateGuideOffsets interpolation arrays.
+
+        The guide probes' rows of the file are kept in the plugmap cache, keyed
+        by the file's modification time and size as well as plate and wavelength.
         """
 
-        # Get .par file name in the platelist product.
-        # plates/0046XX/004671/plateGuideOffsets-004671-p1-l16600.par
-        path = os.path.join(os.environ['PLATELIST_DIR'], 'plates',
-                            '%04dXX' % (int(plate / 100)), '%06d' % (plate),
-                            'plateGuideOffsets-%06d-p%d-l%05d.par' %
-                            (plate, pointingID, wavelength))
+        path = _guide_offsets_path(plate, pointingID, wavelength)
         if not os.path.exists(path):
             failMsg = ('text="no refraction corrections for '
                        'plate {0} at {1:d}A"'.format(plate, wavelength))
             cmd.error(failMsg)
             return False
 
-        try:
-            ygo = yanny.yanny(path, np=True)
-            guideOffsets = ygo['HAOFFSETS']
-            cmd.inform('text="loaded guider coeffs for %dA from %s"' %
+        cache = myGlobals.actorState.gState.plugmapCache
+        cacheKey = (plate, pointingID, wavelength) + plugmapCache.file_version(path)
+        guideOffsets = cache.get('guideOffsets', plate, cacheKey)
+        if guideOffsets is not None:
+            cmd.inform('text="loaded guider coeffs for %dA from the cached %s"' %
                        (wavelength, path))
-        except Exception, e:
-            cmd.error('text="failed to read plateGuideOffsets file %s: %s"' %
-                      (path, e))
-            return False
+        else:
+            try:
+                guideOffsets = _read_guide_offsets(path)
+                cmd.inform('text="loaded guider coeffs for %dA from %s"' %
+                           (wavelength, path))
+            except Exception, e:
+                cmd.error('text="failed to read plateGuideOffsets file %s: %s"' %
+                          (path, e))
+                return False
+            try:
+                cache.put('guideOffsets', plate, cacheKey, guideOffsets)
+            except EnvironmentError, e:
+                cmd.warn('text=%s' % qstr('could not cache the guide offsets: %s' % e))
 
         for gpID, gProbe in gprobes.items():
             if gProbe.fiber_type == 'TRITIUM':
                 continue
 
-            offset = [
-                o for o in guideOffsets
-                if o['holetype'] == "GUIDE" and o['iguide'] == gpID
-            ]
-            if len(offset) != 1:
+            rows = numpy.flatnonzero(guideOffsets['iguide'] == gpID)
+            if len(rows) != 1:
                 cmd.warn(
                     'text="no or too many (%d) guideOffsets for probe %s"' %
-                    (len(offset), gpID))
+                    (len(rows), gpID))
                 continue
 
-            gProbe.haOffsetTimes[wavelength] = offset[0]['delha']
-            gProbe.haXOffsets[wavelength] = offset[0]['xfoff']
-            gProbe.haYOffsets[wavelength] = offset[0]['yfoff']
+            gProbe.haOffsetTimes[wavelength] = guideOffsets['delha'][rows[0]]
+            gProbe.haXOffsets[wavelength] = guideOffsets['xfoff'][rows[0]]
+            gProbe.haYOffsets[wavelength] = guideOffsets['yfoff'][rows[0]]
             cmd.inform('text="applied corrections to gProbeID={0} for {1}A"'
                        .format(gpID, wavelength))
 
@@ -841,12 +1011,27 @@ class GuiderCmd(object):
         """Return guide status status"""
 
         self.actor.sendVersionKey(cmd)
-        if "geek" in cmd.cmd.keywords:
+        geek = "geek" in cmd.cmd.keywords
+        if geek:
             for t in threading.enumerate():
                 cmd.inform('text="%s"' % t)
 
         myGlobals.actorState.queues[guiderActor.MASTER].put(
-            Msg(Msg.STATUS, cmd=cmd, finish=True))
+            Msg(Msg.STATUS, cmd=cmd, finish=True, geek=geek))
+
+    def timing(self, cmd):
+        """Report the rolling percentiles of the time taken by each stage of the guide loop."""
+        reset = "reset" in cmd.cmd.keywords
+        myGlobals.actorState.queues[guiderActor.MASTER].put(
+            Msg(Msg.TIMING, cmd=cmd, reset=reset))
+
+    def plugmapCache(self, cmd):
+        """Report the cache of parsed plugmaps and guide offsets; clear it and the cartridge snapshots, or just one plate's."""
+        keywords = cmd.cmd.keywords
+        clear = 'clear' in keywords
+        plate = keywords['plate'].values[0] if 'plate' in keywords else None
+        myGlobals.actorState.queues[guiderActor.MASTER].put(
+            Msg(Msg.PLUGMAP_CACHE, cmd=cmd, clear=clear, plate=plate))
 
     def decenter(self, cmd):
         """Enable/disable decentered guiding."""
@@ -12,7 +12,8 @@ import masterThread
 import movieThread
 import opscore.actor.keyvar
 import opscore.actor.model
-from guiderActor import myGlobals
+from gimg import guideLib
+from guiderActor import myGlobals, plugmapCache
 
 
 def set_default_pids(config, gState):
@@ -63,6 +64,27 @@ def set_gcamera(config, gState):
     gState.gcameraMagnification = float(config.get('gcamera', 'magnification'))
 
 
+def set_image_analysis(config, gState):
+    """Set the guider image processing options from the config file."""
+
+    gState.calibCacheMB = float(config.get('general', 'calibCacheMB'))
+    gState.sparseProcessing = config.get('general', 'sparseProcessing') == 'True'
+    gState.procWriterQueue = int(config.get('general', 'procWriterQueue'))
+    gState.procWriterPolicy = config.get('general', 'procWriterPolicy')
+    gState.procFormat = config.get('general', 'procFormat')
+    gState.procQuantizeLevel = float(config.get('general', 'procQuantizeLevel'))
+    gState.starFinder = config.get('general', 'starFinder')
+    gState.starFinderShadow = config.get('general', 'starFinderShadow') == 'True'
+
+
+def set_plate_caches(config, gState):
+    """Set where parsed plugmaps and guide offsets are cached, and how many cartridges to keep."""
+
+    gState.plugmapCache = plugmapCache.PlugmapCache(config.get('general', 'plugmapCacheDir'))
+    gState.cartridgeSnapshots = GuiderState.CartridgeSnapshots(
+        int(config.get('general', 'cartridgeSnapshots')))
+
+
 class GuiderActor(actorcore.Actor.SDSSActor):
     """Manage the threads that calculate guiding corrections and gcamera commands."""
 
@@ -102,6 +124,8 @@ class GuiderActor(actorcore.Actor.SDSSActor):
         libguide_path = os.path.expandvars('$GUIDERACTOR_DIR/lib/libguide.so')
         assert os.path.exists(libguide_path), ('cannot find libguide.so. Was it compiled '
                                                'and linked in $GUIDERACTOR_DIR/lib/libguide.so?')
+        # Load it now, so a libguide.so built from a different ipGguide.h fails here.
+        guideLib.load()
 
         # guiderActor.myGlobals.actorState = actorcore.Actor.ActorState(self)
         # actorState = guiderActor.myGlobals.actorState
@@ -141,8 +165,11 @@ class GuiderActor(actorcore.Actor.SDSSActor):
         set_pid_scaling(self.config, gState)
         set_telescope(self.config, gState)
         set_gcamera(self.config, gState)
+        set_image_analysis(self.config, gState)
+        set_plate_caches(self.config, gState)
 
         gState.fitting_algorithm = self.config.get('general', 'fitting_algorithm')
+        gState.pipelineExposures = self.config.get('general', 'pipelineExposures') == 'True'
 
 
 class GuiderActorAPO(GuiderActor):
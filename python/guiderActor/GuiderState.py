@@ -2,12 +2,15 @@
 Classes related to the current state of the guider.
 """
 
+import collections
 import math
+import threading
 
 import numpy
 
 import PID
-from guiderActor import myGlobals
+from gimg import calibCache
+from guiderActor import myGlobals, plugmapCache, stageTimer
 
 # gprobebits
 # To help manage the guide probe status bits.
@@ -23,6 +26,61 @@ TOOFAINT = 0x20  # observed star is too faint to be reliably used for guiding
 UNKNOWN = 0xff  # shouldn't ever happen
 
 
+# The columns of a GProbeTable, holding one guide probe in each row.
+GPROBE_DTYPE = numpy.dtype([
+    ('id', numpy.int32),
+    # gprobebits
+    ('bits', numpy.int32),
+    # from platedb.gprobe
+    ('xCenter', numpy.float64),
+    ('yCenter', numpy.float64),
+    ('radius', numpy.float64),
+    ('rotation', numpy.float64),
+    ('xFerruleOffset', numpy.float64),
+    ('yFerruleOffset', numpy.float64),
+    ('focusOffset', numpy.float64),
+    ('fiber_type', 'S20'),
+    # from platedb.guideInfo
+    ('ra', numpy.float64),
+    ('dec', numpy.float64),
+    ('xFocal', numpy.float64),
+    ('yFocal', numpy.float64),
+    ('phi', numpy.float64),
+    ('throughput', numpy.float64),
+    # from the plugmap, and the guide loop.
+    ('ugriz', numpy.float64, (5, )),
+    ('ref_mag', numpy.float64),
+    ('rotStar2Sky', numpy.float64),
+])
+
+
+def _column(name, cast=None):
+    """A property for the GProbeTable column name, in a GProbe's row."""
+
+    def get(self):
+        value = self.table.data[name][self.row]
+        return value if cast is None else cast(value)
+
+    def set(self, value):
+        self.table.data[name][self.row] = value
+        if name == 'id':
+            self.table._index = None
+
+    return property(get, set)
+
+
+def _list_column(name):
+    """A property for the GProbeTable list name, in a GProbe's row."""
+
+    def get(self):
+        return getattr(self.table, name)[self.row]
+
+    def set(self, value):
+        getattr(self.table, name)[self.row] = value
+
+    return property(get, set)
+
+
 class GProbe(object):
     """
     Contains information about a single guide probe.
@@ -33,21 +91,52 @@ class GProbe(object):
     GProbe flag bits are set via the corresponding property:
         broken, disabled (enabled), noStar, notExist, atFocus (aboveFocus,belowFocus), toofaint
     and gProbe.good will tell you if all bits are in the OK state.
+
+    A GProbe is a view of a row of a GProbeTable: one made on its own has a
+    table of its own, until it is put in another one.
     """
+    __slots__ = ('table', 'row')
 
     def __init__(self, id=-9999, gprobeKey=None, guideInfoKey=None):
         """Pass the contents of platedb.gprobe and/or platedb.guideInfo keyword to initialize"""
+        self.table = GProbeTable(1)
+        self.row = 0
         self.id = id
-        self._bits = GOOD
-        self._ugriz = [
-            numpy.nan,
-        ] * 5
-        self.ref_mag = numpy.nan
         if gprobeKey is not None:
             self.from_platedb_gprobe(gprobeKey)
         if guideInfoKey is not None:
             self.from_platedb_guideInfo(guideInfoKey)
 
+    @classmethod
+    def view(cls, table, row):
+        """The GProbe for row of table."""
+        gProbe = cls.__new__(cls)
+        gProbe.table = table
+        gProbe.row = row
+        return gProbe
+
+    id = _column('id', int)
+    _bits = _column('bits', int)
+    xCenter = _column('xCenter')
+    yCenter = _column('yCenter')
+    radius = _column('radius')
+    rotation = _column('rotation')
+    xFerruleOffset = _column('xFerruleOffset')
+    yFerruleOffset = _column('yFerruleOffset')
+    focusOffset = _column('focusOffset')
+    fiber_type = _column('fiber_type')
+    ra = _column('ra')
+    dec = _column('dec')
+    xFocal = _column('xFocal')
+    yFocal = _column('yFocal')
+    phi = _column('phi')
+    throughput = _column('throughput')
+    ref_mag = _column('ref_mag')
+    rotStar2Sky = _column('rotStar2Sky')
+    haOffsetTimes = _list_column('haOffsetTimes')
+    haXOffsets = _list_column('haXOffsets')
+    haYOffsets = _list_column('haYOffsets')
+
     def checkFocus(self):
         """Set the above/below focus bits based on the focusOffset value."""
         # allow a small range of allowed focus offsets.
@@ -225,46 +314,412 @@ class GProbe(object):
         The 2" fiber magnitudes of the object in this fiber.
         Computes the synthetic predicted reference magnitude (self.ref_mag) when set.
         '''
-        return self._ugriz
+        return self.table.data['ugriz'][self.row]
 
     @ugriz.setter
     def ugriz(self, value):
+        self.table.set_ugriz([self.row], [value])
+
+
+def _airmass():
+    """The airmass at the current telescope position."""
+    actorState = myGlobals.actorState
+    # get airmass from tcc only gives alt = tcc.axePos[2]
+    try:
+        zd = 90. - actorState.models['tcc'].keyVarDict['axePos'][1]
+    except TypeError:
+        zd = 90.  # if the tcc doesn't return a proper position.
+    # TBD: zd=0 never occurs for tracking, but need to test for zd=0 for simulate
+    return 1. / math.cos(math.radians(zd))
+
+
+def _ref_mag(ugriz, airmass):
+    """
+    Compute the reference magnitude for the targets with these ugriz (an (n, 5) array).
+
+    The magnitude the guider should measure for each star/fiber at
+    this airmass. Guider effective wavelength is
+    5400A, so calculate guidermag from g and r. Then correct for
+    atmospheric extinction.
+
+    APO atmospheric extinction coeff at airmass=1 taken from table 3 of the
+    ubercal paper, Padmanabhan et al. 2008 ApJ.
+    with the k0 value for the filters, g:0.17, r:0.10
+
+    Color terms for transformation from r + a1 + a2*(g-r) + a3*(g-r)**2 = ref_mag
+    a1=0.535, a2=0.506, a3=-0.0312
+    Coefficient are from Masayuki, Gunn&Strkyer stds observed through modeled
+    guider & g,r passbands
+    """
+    k0_g = 0.17
+    k0_r = 0.10
+    a1 = 0.535
+    a2 = 0.506
+    a3 = -0.0312
+
+    gobs = ugriz[:, 1] + airmass * k0_g
+    robs = ugriz[:, 2] + airmass * k0_r
+    # numpy.power, as the scalar ** (numpy squares arrays as x*x).
+    return robs + a1 + a2 * (gobs - robs) + a3 * numpy.power(gobs - robs, 2)
+    # return (gobs+robs)/2. #jkp TBD: placeholder
+
+
+class GProbeTable(object):
+    """
+    The guide probes of a cartridge: a dict of id:GProbe, whose GProbes are
+    views of the rows of one GPROBE_DTYPE array (data), so that the probes'
+    flags, geometry and magnitudes can be used for all of them at once.
+
+    table[id] = gProbe copies gProbe into the table, and makes it a view of
+    its row there.
+
+    The rows are found from an index of the ids, sorted once and kept until
+    data is replaced or an id is changed through a GProbe or table[id].
+    """
+
+    def __init__(self, n=0):
+        """A table of n probes, with id -9999, no bits set and everything else NaN."""
+        self.data = numpy.empty(n, GPROBE_DTYPE)
+        for name in GPROBE_DTYPE.names:
+            self.data[name] = numpy.nan if GPROBE_DTYPE[name].base.kind == 'f' else 0
+        self.data['id'] = -9999
+        self.data['bits'] = GOOD
+        self.data['fiber_type'] = ''
+        # Each row's refraction offset tables, as dicts of wavelength:array.
+        self.haOffsetTimes = [{} for i in range(n)]
+        self.haXOffsets = [{} for i in range(n)]
+        self.haYOffsets = [{} for i in range(n)]
+
+    @classmethod
+    def from_probes(cls, gProbes):
+        """
+        A new table with a copy of each of this sequence of GProbes, in order,
+        and a row with UNKNOWN bits for each None.
         """
-        Compute the reference magnitude for this probe's target.
+        table = cls(len(gProbes))
+        for row, gProbe in enumerate(gProbes):
+            if gProbe is None:
+                table.data['bits'][row] = UNKNOWN
+            else:
+                table._copy(row, gProbe)
+        return table
+
+    def copy(self):
+        """A copy of this table. The probes' refraction offset arrays are shared, not copied."""
+        table = GProbeTable()
+        table.data = self.data.copy()
+        table.haOffsetTimes = [dict(d) for d in self.haOffsetTimes]
+        table.haXOffsets = [dict(d) for d in self.haXOffsets]
+        table.haYOffsets = [dict(d) for d in self.haYOffsets]
+        return table
 
-        The magnitude the guider should measure for this star/fiber at
-        the current telescope position. Guider effective wavelength is
-        5400A, so calculate guidermag from g and r. Then correct for
-        atmospheric extinction.
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._index = None
+
+    def _copy(self, row, gProbe):
+        """Copy gProbe into row."""
+        self.data[row] = gProbe.table.data[gProbe.row]
+        self.haOffsetTimes[row] = gProbe.haOffsetTimes
+        self.haXOffsets[row] = gProbe.haXOffsets
+        self.haYOffsets[row] = gProbe.haYOffsets
+        self._index = None
+
+    def _sorted_ids(self):
+        """(order, ids[order]) of the table's ids, sorted the first time it is needed."""
+        if self._index is None:
+            order = numpy.argsort(self.data['id'], kind='mergesort')
+            self._index = (order, self.data['id'][order])
+        return self._index
+
+    def rows(self, ids):
+        """The row of each of this sequence of probe ids, or -1 for those not in the table."""
+        ids = numpy.asarray(ids, dtype=int)
+        rows = numpy.full(ids.shape, -1, dtype=int)
+        if len(self):
+            order, sortedIds = self._sorted_ids()
+            pos = numpy.searchsorted(sortedIds, ids)
+            pos = numpy.minimum(pos, len(self) - 1)
+            found = sortedIds[pos] == ids
+            rows[found] = order[pos[found]]
+        return rows
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, id):
+        return self.rows([id])[0] >= 0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, id):
+        row = self.rows([id])[0]
+        if row < 0:
+            raise KeyError(id)
+        return GProbe.view(self, row)
+
+    def __setitem__(self, id, gProbe):
+        row = self.rows([id])[0]
+        if row < 0:
+            new = GProbeTable(1)
+            self.data = numpy.concatenate((self.data, new.data))
+            self.haOffsetTimes += new.haOffsetTimes
+            self.haXOffsets += new.haXOffsets
+            self.haYOffsets += new.haYOffsets
+            row = len(self) - 1
+        self._copy(row, gProbe)
+        self.data['id'][row] = id
+        self._index = None
+        gProbe.table = self
+        gProbe.row = row
+
+    def get(self, id, default=None):
+        return self[id] if id in self else default
+
+    def keys(self):
+        return [int(id) for id in self.data['id']]
+
+    def values(self):
+        return [GProbe.view(self, row) for row in range(len(self))]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def _any_bit(self, bits):
+        return (self.data['bits'] & bits) != 0
+
+    def exists(self):
+        """Which probes are not broken and have a star defined: see GProbe.exists."""
+        return ~self._any_bit(BROKEN | NOSTAR)
 
-        APO atmospheric extinction coeff at airmass=1 taken from table 3 of the
-        ubercal paper, Padmanabhan et al. 2008 ApJ.
-        with the k0 value for the filters, g:0.17, r:0.10
+    def enabled(self):
+        """Which probes are enabled: see GProbe.enabled."""
+        return ~self._any_bit(DISABLED)
 
-        Color terms for transformation from r + a1 + a2*(g-r) + a3*(g-r)**2 = ref_mag
-        a1=0.535, a2=0.506, a3=-0.0312
-        Coefficient are from Masayuki, Gunn&Strkyer stds observed through modeled
-        guider & g,r passbands
+    def good(self):
+        """Which probes have all bits except [above|below]Focus 0: see GProbe.good."""
+        return ~self._any_bit(~ABOVEFOCUS & ~BELOWFOCUS)
+
+    def atFocus(self):
+        """Which probes are at the focal plane: see GProbe.atFocus."""
+        return ~self._any_bit(ABOVEFOCUS | BELOWFOCUS)
+
+    def tooFaint(self):
+        """Which probes' stars are too faint to use for guiding: see GProbe.tooFaint."""
+        return self._any_bit(TOOFAINT)
+
+    def set_bit(self, rows, bit, value):
         """
-        self._ugriz = value
-        actorState = myGlobals.actorState
-        k0_g = 0.17
-        k0_r = 0.10
-        a1 = 0.535
-        a2 = 0.506
-        a3 = -0.0312
-
-        # get airmass from tcc only gives alt = tcc.axePos[2]
-        try:
-            zd = 90. - actorState.models['tcc'].keyVarDict['axePos'][1]
-        except TypeError:
-            zd = 90.  # if the tcc doesn't return a proper position.
-        # TBD: zd=0 never occurs for tracking, but need to test for zd=0 for simulate
-        airmass = 1. / math.cos(math.radians(zd))
-        gobs = value[1] + airmass * k0_g
-        robs = value[2] + airmass * k0_r
-        self.ref_mag = robs + a1 + a2 * (gobs - robs) + a3 * (gobs - robs)**2
-        # self.ref_mag = (gobs+robs)/2. #jkp TBD: placeholder
+        Set bit to 1 in these rows (indices or a boolean mask) where value is
+        True, and to 0 where it is False; value is one bool, or one per row.
+        """
+        bits = self.data['bits'][rows]
+        self.data['bits'][rows] = numpy.where(value, bits | bit, bits & ~bit)
+
+    def set_ugriz(self, rows, ugriz):
+        """Set the ugriz of these rows, and their ref_mag at the current airmass."""
+        self.data['ugriz'][rows] = ugriz
+        self.data['ref_mag'][rows] = _ref_mag(self.data['ugriz'][rows], _airmass())
+
+
+class RefractionTable(object):
+    """
+    The refraction offsets of all a cartridge's guide probes as a function of
+    hour angle, from their haOffsetTimes, haXOffsets and haYOffsets (the
+    plateGuideOffsets files), stacked into one array per wavelength so that
+    every probe's offset at a frame's dHA is interpolated at once.
+
+    The tables only change when a cartridge is loaded, so make one then.
+    """
+
+    def __init__(self, gprobes=None):
+        """gprobes is a dict of id:GProbe."""
+        gprobes = gprobes or {}
+        # wavelength: (id:row, npoints, times, xOffsets, yOffsets), with each
+        # probe's table in a row, padded with +inf times past its npoints.
+        self.tables = {}
+        wavelengths = set()
+        for gProbe in gprobes.values():
+            wavelengths.update(getattr(gProbe, 'haOffsetTimes', {}))
+        for wavelength in wavelengths:
+            probes = []
+            for id, gProbe in sorted(gprobes.items()):
+                times = numpy.asarray(
+                    getattr(gProbe, 'haOffsetTimes', {}).get(wavelength, ()), dtype=float)
+                # A line needs two points.
+                if times.size >= 2:
+                    ind = numpy.argsort(times)
+                    probes.append((id, times[ind],
+                                   numpy.asarray(gProbe.haXOffsets[wavelength], float)[ind],
+                                   numpy.asarray(gProbe.haYOffsets[wavelength], float)[ind]))
+            npoints = numpy.array([len(p[1]) for p in probes], dtype=int)
+            shape = (len(probes), npoints.max() if probes else 0)
+            times = numpy.full(shape, numpy.inf)
+            xOffsets = numpy.zeros(shape)
+            yOffsets = numpy.zeros(shape)
+            for row, (id, t, x, y) in enumerate(probes):
+                times[row, :len(t)] = t
+                xOffsets[row, :len(t)] = x
+                yOffsets[row, :len(t)] = y
+            rows = dict((p[0], row) for row, p in enumerate(probes))
+            self.tables[wavelength] = (rows, npoints, times, xOffsets, yOffsets)
+
+    def interpolate(self, wavelength, ids, dHA):
+        """
+        Return (haTime, xOffset, yOffset, found) for the probes ids at dHA,
+        as arrays: dHA clamped to the ends of each probe's table, the offsets
+        in mm linearly interpolated there (just as numpy.interp would), and
+        whether each probe has a table at this wavelength (haTime and the
+        offsets are 0 for those that don't).
+        """
+        n = len(ids)
+        haTime = numpy.zeros(n)
+        xOffset = numpy.zeros(n)
+        yOffset = numpy.zeros(n)
+        if wavelength not in self.tables:
+            return haTime, xOffset, yOffset, numpy.zeros(n, dtype=bool)
+        rows, npoints, times, xOffsets, yOffsets = self.tables[wavelength]
+        row = numpy.array([rows.get(id, -1) for id in ids], dtype=int)
+        found = row >= 0
+        row = row[found]
+        last = npoints[row] - 1
+        first = times[row, 0]
+        end = times[row, last]
+        # (a NaN dHA gives NaN offsets)
+        with numpy.errstate(invalid='ignore'):
+            t = numpy.where(dHA < first, first, numpy.where(dHA > end, end, dHA))
+            # The interval each t is in, and the line through its ends.
+            j = (times[row] <= t[:, numpy.newaxis]).sum(axis=1) - 1
+        j = numpy.minimum(numpy.maximum(j, 0), last - 1)
+        t0 = times[row, j]
+        t1 = times[row, j + 1]
+
+        def line(offsets):
+            y0 = offsets[row, j]
+            slope = (offsets[row, j + 1] - y0) / (t1 - t0)
+            return numpy.where(t == end, offsets[row, last], slope * (t - t0) + y0)
+
+        haTime[found] = t
+        xOffset[found] = line(xOffsets)
+        yOffset[found] = line(yOffsets)
+        return haTime, xOffset, yOffset, found
+
+
+# How many cartridges' snapshots to keep: more than are plugged in a night.
+DEFAULT_MAX_SNAPSHOTS = 8
+
+
+class CartridgeSnapshot(object):
+    """
+    What loadCartridge built for one plugging of a cartridge: the values it
+    sent to the master thread, and the probe tables, refraction tables and
+    plugmap that the master thread built from them.
+
+    validation holds everything that decided that plugging, from the command,
+    the platedb loadCartridge reply and the plugging's fscanMJD and fscanID;
+    a later loadCartridge with the same validation can be restored from the
+    snapshot without asking the platedb for anything else.
+    """
+
+    def __init__(self, cartridge, pointing, validation, loadArgs, guideWavelength,
+                 refractionBalance):
+        self.cartridge = cartridge
+        self.pointing = pointing
+        self.validation = validation
+        # The LOAD_CARTRIDGE Msg's values, except the gprobes and cmd.
+        self.loadArgs = loadArgs
+        self.guideWavelength = guideWavelength
+        self.refractionBalance = refractionBalance
+        # The plateGuideOffsets file that was read, and its plugmapCache.file_version.
+        self.offsetsFile = None
+        self.offsetsVersion = None
+        # Filled in by the master thread once the cartridge is loaded.
+        self.gprobes = None
+        self.refractionTable = None
+        self.allProbes = None
+
+    @property
+    def plate(self):
+        return self.loadArgs['plate']
+
+    def matches(self, validation):
+        """True if a load with this validation would build this snapshot again."""
+        return (validation == self.validation and
+                (self.offsetsFile is None or
+                 plugmapCache.file_version(self.offsetsFile) == self.offsetsVersion))
+
+    def save(self, gState):
+        """Keep copies of gState's probe tables, which must not be modified afterwards."""
+        self.gprobes = gState.gprobes.copy()
+        self.refractionTable = gState.refractionTable
+        self.allProbes = gState.allProbes
+
+    def restore(self, gState):
+        """Put a copy of the saved probe tables in gState."""
+        gState.gprobes = self.gprobes.copy()
+        gState.refractionTable = self.refractionTable
+        gState.allProbes = self.allProbes
+
+
+class CartridgeSnapshots(object):
+    """
+    The CartridgeSnapshots of the last maxSnapshots cartridges loaded, keyed by
+    (cartridge, pointing), evicted least-recently-used first.
+
+    GuiderCmd looks them up, and the master thread adds and clears them, so
+    they are protected by a lock.
+    """
+
+    def __init__(self, maxSnapshots=DEFAULT_MAX_SNAPSHOTS):
+        self.maxSnapshots = maxSnapshots
+        self._snapshots = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def get(self, cartridge, pointing):
+        """Return the snapshot of this cartridge and pointing, or None."""
+        with self._lock:
+            snapshot = self._snapshots.pop((cartridge, pointing), None)
+            if snapshot is None:
+                return None
+            # re-insert, to mark it as the most recently used.
+            self._snapshots[(cartridge, pointing)] = snapshot
+            return snapshot
+
+    def put(self, snapshot):
+        """Add snapshot, replacing any older one of its cartridge, and drop the least recently used."""
+        with self._lock:
+            key = (snapshot.cartridge, snapshot.pointing)
+            self._snapshots.pop(key, None)
+            if self.maxSnapshots <= 0:
+                return
+            self._snapshots[key] = snapshot
+            while len(self._snapshots) > self.maxSnapshots:
+                self._snapshots.popitem(last=False)
+
+    def drop(self, snapshot):
+        """Forget snapshot, if it is still kept."""
+        with self._lock:
+            key = (snapshot.cartridge, snapshot.pointing)
+            if self._snapshots.get(key) is snapshot:
+                del self._snapshots[key]
+
+    def clear(self, plate=None):
+        """Forget the snapshots of plate, or all of them; return how many were forgotten."""
+        with self._lock:
+            keys = [key for key, snapshot in self._snapshots.items()
+                    if plate is None or snapshot.plate == plate]
+            for key in keys:
+                del self._snapshots[key]
+            return len(keys)
 
 
 class GuiderState(object):
@@ -287,6 +742,18 @@ class GuiderState(object):
         self.readTime = 0
         self.stack = 1
         self.inMotion = False
+        # Number of TCC moves the guide loop has commanded, and what it was
+        # when the exposure being taken was requested: if they differ, the
+        # telescope moved during that exposure.
+        self.moveCount = 0
+        self.exposeMoveCount = 0
+        # Incremented each time guiding starts: replies to the exposures
+        # requested before then are ignored.
+        self.guideRun = 0
+        # Request the next exposure as soon as one finishes, before processing it?
+        self.pipelineExposures = False
+        # Rolling timings of the stages of the guide loop, for "guider timing".
+        self.stageTimings = stageTimer.StageTimings()
         self.centerUp = False
         self.cmd = None
         self.startFrame = None  # guider frame number to start movie at.
@@ -311,7 +778,9 @@ class GuiderState(object):
         self.diable_ti_scaling = False
 
         # Will contain [id]:gProbe pairs
-        self.gprobes = {}
+        self.gprobes = GProbeTable()
+        # Their refraction offsets, made when the cartridge is loaded.
+        self.refractionTable = RefractionTable()
 
         # PIDs for various axes, and their default, on-initialization values.
         self.pid = {}
@@ -330,12 +799,33 @@ class GuiderState(object):
         # Algorithm to use
         self.fitting_algorithm = None
 
+        # Memory budget for processed darks and flats held by GuiderImageAnalysis.
+        self.calibCacheMB = calibCache.DEFAULT_MAX_MB
+        # Only calibrate the pixels inside the fibers when finding stars?
+        self.sparseProcessing = False
+        # Size of the queue of proc- files to write in the background (0: no writer thread),
+        # and whether to 'block' or 'drop' the oldest file when it is full.
+        self.procWriterQueue = 0
+        self.procWriterPolicy = 'block'
+        # Whether proc- files are whole-file 'gzip' or 'tile' compressed, and the
+        # quantization level for tile-compressed float images.
+        self.procFormat = 'gzip'
+        self.procQuantizeLevel = 16
+        # Find stars with 'gfindstars' or 'numpy', and also run the other one to compare?
+        self.starFinder = 'gfindstars'
+        self.starFinderShadow = False
+        # Parsed plugmaps and guide offsets of the plates already loaded (no directory: not cached).
+        self.plugmapCache = plugmapCache.PlugmapCache()
+        # What was built for the last few cartridges loaded, to switch back to them quickly.
+        self.cartridgeSnapshots = CartridgeSnapshots()
+
         # reset the decenter positions.
         self.clearDecenter()
 
     def deleteAllGprobes(self):
         """Delete all fibers """
-        self.gprobes = {}
+        self.gprobes = GProbeTable()
+        self.refractionTable = RefractionTable()
 
     def setGprobeState(self, fiber, enable=True):
         """
@@ -345,10 +835,7 @@ class GuiderState(object):
         If an integer, must refer to a currently loaded probe.
         """
         if fiber in ('ACQUIRE', 'GUIDE', 'TRITIUM'):
-            fiber_type = fiber
-            for gp in self.gprobes.values():
-                if gp.info.fiber_type == fiber_type:
-                    gp.enabled = enable
+            self.gprobes.set_bit(self.gprobes.data['fiber_type'] == fiber, DISABLED, not enable)
         else:
             self.gprobes[fiber].enabled = enable
 
@@ -582,8 +1069,9 @@ class FrameInfo(object):
 
         self.fittingAlgorithm = 'NA'
 
-        self.A = numpy.matrix(numpy.zeros(3 * 3).reshape([3, 3]))
-        self.b = numpy.matrix(numpy.zeros(3).reshape([3, 1]))
+        # The standard fitting algorithm's normal equations.
+        self.A = numpy.zeros((3, 3))
+        self.b = numpy.zeros(3)
         self.b3 = 0
         self.nStar = 0
         self.pos_error = numpy.nan
@@ -592,6 +1080,11 @@ class FrameInfo(object):
         self.guideFocus = False
         self.guideScale = False
 
+        # True if the telescope moved during the exposure, so it wasn't guided on.
+        self.inMotion = False
+        # The stageTimer.FrameTimer of this frame's processing.
+        self.timing = None
+
     def setGuideMode(self, gState=None):
         """Save the guide* values from gState, or reset them to False."""
         self.guideAxes = gState.guideAxes
@@ -53,6 +53,12 @@ class Msg(object):
     class STATUS():
         pass
 
+    class TIMING():
+        pass
+
+    class PLUGMAP_CACHE():
+        pass
+
     class ABORT_EXPOSURE():
         pass
 
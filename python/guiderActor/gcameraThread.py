@@ -19,8 +19,13 @@ def expose(cmd,
            stack=1,
            cartridge=None,
            expType='expose',
-           camera='gcamera'):
-    """Take an exposure with the e/gcamera, and succeed/fail as appropriate."""
+           camera='gcamera',
+           guideRun=None):
+    """
+    Take an exposure with the e/gcamera, and succeed/fail as appropriate.
+    guideRun is passed back in the reply, so the master thread can tell which
+    run of the guide loop the exposure was for.
+    """
     cmd.respond('text="starting %s exposure"' % camera)
     filenameKey = actorState.models[camera].keyVarDict['filename']
 
@@ -56,7 +61,7 @@ def expose(cmd,
             cmd.warn(
                 'text="{0} expose command exceeded time limit: {1}."'.format(
                     camera, timeLim))
-        replyQueue.put(Msg(responseMsg, cmd=cmd, success=False))
+        replyQueue.put(Msg(responseMsg, cmd=cmd, guideRun=guideRun, success=False))
         return
 
     filename = cmdVar.getLastKeyVarData(filenameKey)[0]
@@ -65,6 +70,7 @@ def expose(cmd,
             cmd=cmd,
             filename=filename,
             camera=camera,
+            guideRun=guideRun,
             success=True))
 
 
@@ -93,6 +99,7 @@ def main(actor, queues):
                 expType = getattr(msg, 'expType', 'expose')
                 cartridge = getattr(msg, 'cartridge', None)
                 stack = getattr(msg, 'stack', 1)
+                guideRun = getattr(msg, 'guideRun', None)
                 expose(
                     msg.cmd,
                     myGlobals.actorState,
@@ -101,7 +108,8 @@ def main(actor, queues):
                     stack=stack,
                     cartridge=cartridge,
                     expType=expType,
-                    camera=camera)
+                    camera=camera,
+                    guideRun=guideRun)
 
             elif msg.type == Msg.ABORT_EXPOSURE:
                 if not msg.quiet:
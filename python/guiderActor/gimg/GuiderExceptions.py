@@ -1,6 +1,6 @@
 __all__ = [
     'GuiderError', 'BadDarkError', 'FlatError', 'NoFibersFoundError',
-    'BadReadError'
+    'BadReadError', 'LibguideError'
 ]
 
 
@@ -28,3 +28,8 @@ class NoFibersFoundError(FlatError):
 class BadReadError(GuiderError):
     """An exception due to an incorrectly read guider image."""
     pass
+
+
+class LibguideError(GuiderError):
+    """An exception due to a missing or mismatched libguide.so."""
+    pass
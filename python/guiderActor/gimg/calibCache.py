@@ -0,0 +1,215 @@
+"""
+A bounded, least-recently-used cache of processed guider calibrations, and
+the per-exposure-time calibration products built from them.
+
+Reading a processed dark or flat means gunzipping a proc- file and, for flats,
+rebuilding the fiber geometry from its table. Switching cartridges, or
+reprocessing frames that point at different calibrations, used to pay that cost
+every time, since GuiderImageAnalysis only remembered the last dark and flat.
+
+Entries are keyed by the processed file name and its modification time, so a
+regenerated proc- file is never confused with the one it replaced.
+"""
+
+import collections
+import os.path
+import threading
+
+import numpy as np
+
+# Default memory budget, in megabytes: a binned dark and flat with its mask
+# take a few MB, so this holds the calibrations of every cartridge for a night.
+DEFAULT_MAX_MB = 256
+# How many CalibrationProducts to keep: enough for the exposure times used
+# with one dark and flat (e.g. alternating guiding and acquisition exposures).
+DEFAULT_MAX_PRODUCTS = 4
+
+
+def _nbytes(value):
+    """Return the number of bytes held by the numpy arrays in value."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(x) for x in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(x) for x in value.values())
+    # Other objects holding arrays (e.g. a flat's FiberTable) say how big they are.
+    return getattr(value, 'nbytes', 0)
+
+
+class CalibrationCache(object):
+    """
+    Processed calibrations, keyed by (filename, mtime), evicted least-recently-used
+    first once the arrays they hold exceed maxMB megabytes.
+
+    Cached values are shared with their users, and must not be modified in place.
+    The proc- file writer thread adds the calibrations it has written, so
+    the entries are protected by a lock.
+    """
+
+    def __init__(self, maxMB=DEFAULT_MAX_MB):
+        self.maxBytes = int(maxMB * 2**20)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, filename):
+        try:
+            key = self._key(filename)
+        except OSError:
+            return False
+        with self._lock:
+            return key in self._entries
+
+    def _key(self, filename):
+        return (filename, os.path.getmtime(filename))
+
+    def get(self, filename):
+        """Return the value cached for the current version of filename, or None."""
+        with self._lock:
+            try:
+                key = self._key(filename)
+                value, nbytes = self._entries.pop(key)
+            except (OSError, KeyError):
+                self.misses += 1
+                return None
+            # re-insert, to mark it as the most recently used.
+            self._entries[key] = (value, nbytes)
+            self.hits += 1
+            return value
+
+    def put(self, filename, value):
+        """
+        Cache value for the current version of filename, dropping any older
+        versions of it and then the least recently used entries, to stay in budget.
+        Values bigger than the whole budget are not cached at all.
+        """
+        try:
+            key = self._key(filename)
+        except OSError:
+            return
+        with self._lock:
+            for old in [k for k in self._entries if k[0] == filename]:
+                self._drop(old)
+
+            nbytes = _nbytes(value)
+            if nbytes > self.maxBytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.maxBytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        value, nbytes = self._entries.pop(key)
+        self.nbytes -= nbytes
+
+    def clear(self):
+        """Empty the cache, keeping the hit/miss counters."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def status(self):
+        """Return (nEntries, MB used, MB budget, hits, misses, evictions), for status output."""
+        with self._lock:
+            return (len(self._entries), self.nbytes / 2.**20, self.maxBytes / 2.**20,
+                    self.hits, self.misses, self.evictions)
+
+
+class CalibrationProduct(object):
+    """
+    The arrays needed to calibrate one guider frame, precomposed from a
+    processed dark and flat for one exposure time and binning: the dark scaled
+    to the exposure time, the reciprocal of the flat and the flat's mask.
+
+    These only change when the dark, flat or exposure time does, so building
+    them once means calibrating each frame needs no full-frame temporaries.
+    """
+
+    def __init__(self, key, dark, flat, mask, exptime):
+        """
+        key identifies the (dark, flat, exptime, binning) this was built for.
+        dark is the processed 1-second dark, or None to skip dark subtraction.
+        """
+        self.key = key
+        self._sources = (dark, flat)
+        self.dark = None if dark is None else dark * exptime
+        # Pixels where the flat is zero (outside the fibers) are left unchanged.
+        self.invFlat = 1.0 / np.where(flat == 0, 1, flat)
+        self.mask = mask
+        self._roi = None
+
+    def matches(self, key, dark, flat):
+        """True if this was built for key, from these dark and flat arrays."""
+        return key == self.key and self._sources[0] is dark and self._sources[1] is flat
+
+    def apply(self, image):
+        """Dark subtract and flatfield image in place, and return it."""
+        return self.divide_flat(self.subtract_dark(image))
+
+    def subtract_dark(self, image):
+        """Dark subtract image in place (if there is a dark), and return it."""
+        if self.dark is not None:
+            image -= self.dark
+        return image
+
+    def divide_flat(self, image):
+        """Flatfield image in place, and return it."""
+        image *= self.invFlat
+        return image
+
+    def get_roi(self):
+        """
+        Return (indices, dark, invFlat) for the unmasked pixels (i.e. the
+        fibers): their flat indices, and the scaled dark (None if there is no
+        dark) and inverse flat at them. Computed on first use.
+        """
+        if self._roi is None:
+            roi = np.flatnonzero(self.mask == 0)
+            dark = None if self.dark is None else self.dark.ravel()[roi]
+            self._roi = (roi, dark, self.invFlat.ravel()[roi])
+        return self._roi
+
+    def apply_roi(self, values):
+        """Dark subtract and flatfield, in place, the values at the get_roi() indices."""
+        roi, dark, invFlat = self.get_roi()
+        if dark is not None:
+            values -= dark
+        values *= invFlat
+        return values
+
+
+class CalibrationProducts(object):
+    """
+    The most recently used CalibrationProducts, keyed by (dark name, flat name,
+    exptime, binning), so switching between exposure times doesn't rebuild them.
+    """
+
+    def __init__(self, maxProducts=DEFAULT_MAX_PRODUCTS):
+        self.maxProducts = maxProducts
+        self._products = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._products)
+
+    def get(self, key, dark, flat, mask, exptime):
+        """
+        Return the CalibrationProduct for key, building it from dark, flat and
+        mask unless the one kept for key was built from these same arrays.
+        """
+        product = self._products.pop(key, None)
+        if product is None or not product.matches(key, dark, flat):
+            product = CalibrationProduct(key, dark, flat, mask, exptime)
+        # (re-)insert, to mark it as the most recently used.
+        self._products[key] = product
+        while len(self._products) > self.maxProducts:
+            self._products.popitem(last=False)
+        return product
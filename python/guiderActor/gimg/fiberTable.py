@@ -0,0 +1,198 @@
+"""
+The guider fibers, and the stars seen through them, as one numpy structured
+array with a row per fiber.
+
+A FiberTable is made from each processed flat (the fiber geometry), and
+findStars() fills in a copy of it with each frame's star measurements, which
+the guide loop then adds the dRA/dDec offsets to. The proc- file's fiber
+table is written straight from its columns. Fiber is a view of one row, for
+the code that deals with one fiber at a time.
+"""
+
+import numpy as np
+
+FIBER_DTYPE = np.dtype([
+    # geometry, from the flat.
+    ('fiberid', np.int32),
+    ('xcen', np.float64),
+    ('ycen', np.float64),
+    ('radius', np.float64),
+    ('illrad', np.float64),
+    # The label of this fiber in the labeled, masked flat (from scipy.ndimage.label)
+    ('label', np.int32),
+    # the star, measured by findStars().
+    ('xs', np.float64),
+    ('ys', np.float64),
+    ('xyserr', np.float64),
+    ('fwhm', np.float64),
+    ('sky', np.float64),
+    ('skymag', np.float64),
+    ('flux', np.float64),
+    ('mag', np.float64),
+    ('fwhmErr', np.float64),
+    # offsets, from the guide loop.
+    ('dx', np.float64),
+    ('dy', np.float64),
+    ('dRA', np.float64),
+    ('dDec', np.float64),
+])
+
+
+class FiberTable(object):
+    """
+    A table of fibers: data is a FIBER_DTYPE array, and gprobes the GProbe
+    (or None) of each row. Indexing or iterating over it gives Fiber views.
+    """
+
+    def __init__(self, n=0):
+        """A table of n fibers, with fiberid and label -1 and everything else NaN."""
+        self.data = np.empty(n, FIBER_DTYPE)
+        for name in FIBER_DTYPE.names:
+            self.data[name] = np.nan if FIBER_DTYPE[name].kind == 'f' else -1
+        self.gprobes = [None] * n
+
+    @classmethod
+    def from_columns(cls, fiberid, xcen, ycen, radius, illrad=np.nan, label=-1, gprobes=None):
+        """A table of fibers with this geometry (sequences, or one value for all)."""
+        table = cls(len(fiberid))
+        table.data['fiberid'] = fiberid
+        table.data['xcen'] = xcen
+        table.data['ycen'] = ycen
+        table.data['radius'] = radius
+        table.data['illrad'] = illrad
+        table.data['label'] = label
+        if gprobes is not None:
+            table.gprobes = [gprobes.get(fid) for fid in table.data['fiberid']]
+        return table
+
+    @classmethod
+    def from_fibers(cls, fibers):
+        """A new table with a copy of each of these Fibers (or a copy of a FiberTable)."""
+        if isinstance(fibers, FiberTable):
+            return fibers.take(slice(None))
+        table = cls(len(fibers))
+        for i, f in enumerate(fibers):
+            table.data[i] = f.table.data[f.row]
+            table.gprobes[i] = f.gProbe
+        return table
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        """The size of the table's array, for CalibrationCache's memory budget."""
+        return self.data.nbytes
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('fiber table index %d out of range' % i)
+        return Fiber.view(self, i)
+
+    def __iter__(self):
+        return (Fiber.view(self, i) for i in range(len(self)))
+
+    def take(self, rows):
+        """A new table with a copy of these rows (indices, a boolean mask or a slice)."""
+        table = FiberTable()
+        table.data = self.data[rows].copy()
+        table.gprobes = [self.gprobes[i] for i in np.arange(len(self))[rows]]
+        return table
+
+    def fake(self):
+        """Which fibers were not found in the flat: see Fiber.is_fake()."""
+        return np.isnan(self.data['xcen'])
+
+    def by_fiberid(self, fiberids):
+        """
+        A new table with a row for each of fiberids, copied from this one, and
+        NaN for the fibers (as from Fiber.set_fake()) that aren't in it.
+        """
+        table = FiberTable(len(fiberids))
+        table.data['fiberid'] = fiberids
+        order = np.argsort(self.data['fiberid'], kind='mergesort')
+        pos = np.searchsorted(self.data['fiberid'], fiberids, sorter=order)
+        found = pos < len(self)
+        found[found] = self.data['fiberid'][order[pos[found]]] == table.data['fiberid'][found]
+        rows = order[pos[found]]
+        table.data[found] = self.data[rows]
+        for i, row in zip(np.flatnonzero(found), rows):
+            table.gprobes[i] = self.gprobes[row]
+        return table
+
+
+def _column(name):
+    """A property for the FiberTable column name, in a Fiber's row."""
+
+    def get(self):
+        return self.table.data[name][self.row]
+
+    def set(self, value):
+        self.table.data[name][self.row] = value
+
+    return property(get, set)
+
+
+class Fiber(object):
+    """A guider fiber and the star image seen through it: a row of a FiberTable."""
+    __slots__ = ('table', 'row')
+
+    def __init__(self,
+                 fiberid,
+                 xc=np.nan,
+                 yc=np.nan,
+                 r=np.nan,
+                 illr=np.nan,
+                 label=-1):
+        """A fiber in a table of its own."""
+        self.table = FiberTable.from_columns([fiberid], xc, yc, r, illr, label)
+        self.row = 0
+
+    @classmethod
+    def view(cls, table, row):
+        """The Fiber for row of table."""
+        fiber = cls.__new__(cls)
+        fiber.table = table
+        fiber.row = row
+        return fiber
+
+    fiberid = _column('fiberid')
+    xcen = _column('xcen')
+    ycen = _column('ycen')
+    radius = _column('radius')
+    illrad = _column('illrad')
+    label = _column('label')
+    xs = _column('xs')
+    ys = _column('ys')
+    xyserr = _column('xyserr')
+    fwhm = _column('fwhm')
+    sky = _column('sky')
+    skymag = _column('skymag')
+    flux = _column('flux')
+    mag = _column('mag')
+    fwhmErr = _column('fwhmErr')
+    dx = _column('dx')
+    dy = _column('dy')
+    dRA = _column('dRA')
+    dDec = _column('dDec')
+
+    @property
+    def gProbe(self):
+        return self.table.gprobes[self.row]
+
+    @gProbe.setter
+    def gProbe(self, gProbe):
+        self.table.gprobes[self.row] = gProbe
+
+    def __str__(self):
+        return ('Fiber id %i: center %g,%g; star %g,%g; radius %g' %
+                (self.fiberid, self.xcen, self.ycen, self.xs, self.ys,
+                 self.radius))
+
+    def set_fake(self):
+        self.xcen = np.nan
+
+    def is_fake(self):
+        return np.isnan(self.xcen)
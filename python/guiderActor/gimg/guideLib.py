@@ -0,0 +1,205 @@
+"""
+The ctypes interface to libguide.so, the C code in src/gimg that finds the
+stars in the fibers (and rotates the postage stamps).
+
+The library is loaded, and its interface checked against this one, once per
+process: see load(). Images are passed to it as one int16 buffer and a row
+stride, and the fiber inputs and outputs as numpy arrays that C reads and
+writes in place (see FiberData), so there's nothing to convert per row or
+per fiber on each frame.
+"""
+
+import ctypes
+import os.path
+import threading
+
+import numpy as np
+
+import GuiderExceptions
+
+# Must match ipGguide.h
+ABI_VERSION = 1
+FWHM_BAD = 99.99
+# What gfindstars() returns on success.
+SH_SUCCESS = 0x8001c009
+
+
+# The following are ctypes classes for interaction with the ipGguide.c code.
+class REGION(ctypes.Structure):
+    _fields_ = [('nrow', ctypes.c_int), ('ncol', ctypes.c_int),
+                ('rows_s16', ctypes.POINTER(ctypes.POINTER(ctypes.c_int16)))]
+
+
+class MASK(ctypes.Structure):
+    _fields_ = [('nrow', ctypes.c_int), ('ncol', ctypes.c_int),
+                ('rows', ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte)))]
+
+
+class FIBERDATA(ctypes.Structure):
+    _fields_ = [('g_nfibers', ctypes.c_int),
+                ('g_fid', ctypes.POINTER(ctypes.c_int)),
+                ('g_xcen', ctypes.POINTER(ctypes.c_double)),
+                ('g_ycen', ctypes.POINTER(ctypes.c_double)),
+                ('g_fibrad', ctypes.POINTER(ctypes.c_double)),
+                ('g_illrad', ctypes.POINTER(ctypes.c_double)),
+                ('g_xs', ctypes.POINTER(ctypes.c_double)),
+                ('g_ys', ctypes.POINTER(ctypes.c_double)),
+                ('flux', ctypes.POINTER(ctypes.c_double)),
+                ('sky', ctypes.POINTER(ctypes.c_double)),
+                ('fwhm', ctypes.POINTER(ctypes.c_double)),
+                ('poserr', ctypes.POINTER(ctypes.c_double)),
+                ('g_readnoise', ctypes.c_double),
+                ('g_npixmask', ctypes.c_int)]
+
+
+def np_array_to_REGION(A):
+    H, W = A.shape
+    ptrtype = ctypes.POINTER(ctypes.c_int16)
+    rows = (ptrtype * H)(*[row.ctypes.data_as(ptrtype) for row in A])
+    return REGION(H, W, rows)
+
+
+def np_array_to_MASK(A):
+    H, W = A.shape
+    ptrtype = ctypes.POINTER(ctypes.c_uint8)
+    rows = (ptrtype * H)(*[row.ctypes.data_as(ptrtype) for row in A])
+    return MASK(H, W, rows)
+
+
+_libguide = None
+_lock = threading.Lock()
+
+
+def default_path():
+    return os.path.expandvars('$GUIDERACTOR_DIR/lib/libguide.so')
+
+
+def load(path=None):
+    """
+    Return the libguide CDLL, loading it from path (default:
+    $GUIDERACTOR_DIR/lib/libguide.so) the first time this is called in the
+    process, and the same one every time after that.
+
+    Raises LibguideError if it can't be loaded, or was built from a
+    different version of ipGguide.h than this module expects.
+    """
+    global _libguide
+    if _libguide is None:
+        with _lock:
+            if _libguide is None:
+                _libguide = _load(path or default_path())
+    return _libguide
+
+
+def _load(path):
+    try:
+        libguide = ctypes.CDLL(path)
+    except OSError as e:
+        raise GuiderExceptions.LibguideError(
+            'Failed to load "libguide.so" from %s ($GUIDERACTOR_DIR/lib/libguide.so): %s' %
+            (path, e))
+
+    if not hasattr(libguide, 'guide_abi_version'):
+        raise GuiderExceptions.LibguideError(
+            '%s is out of date (it has no guide_abi_version()): rebuild it.' % path)
+    libguide.guide_abi_version.argtypes = []
+    libguide.guide_abi_version.restype = ctypes.c_int
+    version = libguide.guide_abi_version()
+    if version != ABI_VERSION:
+        raise GuiderExceptions.LibguideError(
+            '%s has interface version %d, but guideLib expects %d: rebuild it.' %
+            (path, version, ABI_VERSION))
+    libguide.guide_struct_sizes.argtypes = [ctypes.POINTER(ctypes.c_int)]
+    libguide.guide_struct_sizes.restype = None
+    sizes = (ctypes.c_int * 3)()
+    libguide.guide_struct_sizes(sizes)
+    expected = (ctypes.sizeof(REGION), ctypes.sizeof(MASK), ctypes.sizeof(FIBERDATA))
+    if tuple(sizes) != expected:
+        raise GuiderExceptions.LibguideError(
+            '%s has REGION, MASK, FIBERDATA sizes %s, but guideLib has %s.' %
+            (path, tuple(sizes), expected))
+
+    libguide.gfindstars.argtypes = [
+        ctypes.POINTER(REGION),
+        ctypes.POINTER(FIBERDATA), ctypes.c_int
+    ]
+    libguide.gfindstars.restype = ctypes.c_int
+    libguide.gfindstars_buffer.argtypes = [
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(FIBERDATA), ctypes.c_int
+    ]
+    libguide.gfindstars_buffer.restype = ctypes.c_int
+    libguide.fiberdata_new.argtypes = [ctypes.c_int]
+    libguide.fiberdata_new.restype = ctypes.POINTER(FIBERDATA)
+    libguide.fiberdata_free.argtypes = [ctypes.POINTER(FIBERDATA)]
+    libguide.fiberdata_free.restype = None
+    libguide.rotate_region.argtypes = [
+        ctypes.POINTER(REGION),
+        ctypes.POINTER(REGION), ctypes.c_float
+    ]
+    libguide.rotate_region.restype = None
+    libguide.rotate_mask.argtypes = [
+        ctypes.POINTER(MASK),
+        ctypes.POINTER(MASK), ctypes.c_float
+    ]
+    libguide.rotate_mask.restype = None
+    return libguide
+
+
+class FiberData(object):
+    """
+    The gfindstars() inputs and outputs for a set of fibers, as numpy arrays
+    that a FIBERDATA struct points to. The inputs are fixed for a flat, so
+    make one of these per flat and pass it to find_stars() for each frame.
+    """
+
+    def __init__(self, fiberid, xcen, ycen, fibrad, illrad):
+        """The inputs are sequences with one entry per fiber."""
+        self.fiberid = np.array(fiberid, dtype=np.intc)
+        self.xcen = np.array(xcen, dtype=np.float64)
+        self.ycen = np.array(ycen, dtype=np.float64)
+        self.fibrad = np.array(fibrad, dtype=np.float64)
+        self.illrad = np.array(illrad, dtype=np.float64)
+        n = len(self.fiberid)
+        # Outputs.
+        self.xs = np.empty(n)
+        self.ys = np.empty(n)
+        self.flux = np.empty(n)
+        self.sky = np.empty(n)
+        self.fwhm = np.empty(n)
+        self.poserr = np.empty(n)
+
+        def ptr(A, ctype=ctypes.c_double):
+            return A.ctypes.data_as(ctypes.POINTER(ctype))
+
+        # readnoise and npixmask are zero, as from fiberdata_new().
+        self.struct = FIBERDATA(n, ptr(self.fiberid, ctypes.c_int), ptr(self.xcen),
+                                ptr(self.ycen), ptr(self.fibrad), ptr(self.illrad), ptr(self.xs),
+                                ptr(self.ys), ptr(self.flux), ptr(self.sky), ptr(self.fwhm),
+                                ptr(self.poserr), 0., 0)
+
+    def __len__(self):
+        return len(self.fiberid)
+
+    def copy(self):
+        """Return a new FiberData for the same fibers, with its own outputs."""
+        return FiberData(self.fiberid, self.xcen, self.ycen, self.fibrad, self.illrad)
+
+
+def find_stars(image, fiberData, mode=1):
+    """
+    Run gfindstars() on the int16 image (whose rows must each be contiguous)
+    for the fibers in fiberData, filling in its outputs, and return its
+    result code (SH_SUCCESS if all went well). mode is 1 for data frames,
+    0 for spot frames. Outputs that gfindstars() doesn't set, because it
+    gave up on a fiber, are NaN.
+    """
+    if image.dtype != np.int16 or image.strides[1] != image.itemsize:
+        raise ValueError('gfindstars needs an int16 image with contiguous rows.')
+    for output in (fiberData.xs, fiberData.ys, fiberData.flux, fiberData.sky, fiberData.fwhm,
+                   fiberData.poserr):
+        output.fill(np.nan)
+    nrow, ncol = image.shape
+    return load().gfindstars_buffer(image.ctypes.data, nrow, ncol,
+                                    image.strides[0] // image.itemsize,
+                                    ctypes.byref(fiberData.struct), mode)
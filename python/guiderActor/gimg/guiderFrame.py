@@ -0,0 +1,70 @@
+"""
+A raw guider-camera exposure, read from disk exactly once.
+
+guideStep needs the header of each new gimg file to decide whether it can be
+guided on, and GuiderImageAnalysis needs its pixels. Reading the file into a
+GuiderFrame lets both share one gunzip of the (compressed) exposure.
+"""
+
+import os.path
+import re
+
+import pyfits
+
+import GuiderExceptions
+from guiderActor.stageTimer import FrameTimer
+
+
+def frame_number(filename):
+    """Return the exposure sequence number from a [ge]img-####.fits[.gz] filename."""
+    # need ".*" in the regex, because we may or may not have gzipped files.
+    return int(re.search(r'([0-9]+)\.fits.*$', filename).group(1))
+
+
+class GuiderFrame(object):
+    """
+    The decoded pixels and header of one raw e/gcamera exposure.
+
+    The pixels should be treated as read-only: anything that needs to process
+    them in place must work on a copy, so the frame can be handed on unchanged.
+    """
+
+    def __init__(self, filename, image, header):
+        self.filename = filename
+        self.image = image
+        self.header = header
+        self.frameNo = frame_number(filename)
+
+        # The exposure metadata we look at for every frame.
+        self.imageType = header.get('IMAGETYP', None)
+        self.exptime = header.get('EXPTIME', 0)
+        self.ccdtemp = header.get('CCDTEMP', None)
+        self.darkFile = header.get('DARKFILE', None)
+        self.flatFile = header.get('FLATFILE', None)
+        self.flatCart = header.get('FLATCART', None)
+
+    def __str__(self):
+        return 'GuiderFrame %d (%s, %gs): %s' % (self.frameNo, self.imageType,
+                                                 self.exptime, self.filename)
+
+    @classmethod
+    def read(cls, filename, timer=None):
+        """
+        Read the primary HDU of filename (or filename.gz) into a new GuiderFrame.
+        If given, timer is a FrameTimer for the header and decompress stages.
+        """
+        if timer is None:
+            timer = FrameTimer()
+        # files prior to MJD 56465 have the dark/flat without .gz in the header.
+        if not os.path.exists(filename):
+            filename += '.gz'
+        try:
+            with timer.stage('header'):
+                hdulist = pyfits.open(filename, memmap=False)
+                header = hdulist[0].header
+            with timer.stage('decompress'):
+                image = hdulist[0].data
+            hdulist.close()
+        except IOError:
+            raise GuiderExceptions.GuiderError('File not found: %s' % filename)
+        return cls(filename, image, header)
@@ -5,123 +5,34 @@ Can be used to batch-process old guider images to extract more information
 from them in bulk.
 """
 
-import ctypes
 import datetime
 import os.path
-import re
 from operator import attrgetter
 
 import numpy as np
 import pyfits
 from scipy.ndimage.measurements import center_of_mass, label
+from scipy.ndimage.measurements import median as label_median
 from scipy.ndimage.morphology import binary_closing, binary_dilation, binary_erosion
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
 
 import actorcore.utility.fits as actorFits
 import GuiderExceptions
 import PyGuide
+import guideLib
+import starFinder
+from calibCache import CalibrationCache, CalibrationProducts
+from fiberTable import Fiber, FiberTable
+from guiderActor.GuiderState import GProbeTable
+from guiderActor.stageTimer import FrameTimer
+from guiderActor.writerThread import ProcFileJob
+from guideLib import FWHM_BAD, SH_SUCCESS
+from guiderFrame import GuiderFrame
 from opscore.utility.qstr import qstr
 from opscore.utility.tback import tback
 
 
-class Fiber(object):
-    """A guider fiber and the star image seen through it."""
-
-    def __init__(self,
-                 fiberid,
-                 xc=np.nan,
-                 yc=np.nan,
-                 r=np.nan,
-                 illr=np.nan,
-                 label=-1):
-        self.fiberid = fiberid
-        self.xcen = xc
-        self.ycen = yc
-        self.radius = r
-        self.illrad = illr
-
-        self.xs = np.nan
-        self.ys = np.nan
-        self.xyserr = np.nan
-        self.fwhm = np.nan
-        self.sky = np.nan
-        self.skymag = np.nan
-        self.flux = np.nan
-        self.mag = np.nan
-
-        self.fwhmErr = np.nan
-        self.dx = np.nan
-        self.dy = np.nan
-        self.dRA = np.nan
-        self.dDec = np.nan
-
-        self.gProbe = None
-
-        # The label of this fiber in the labeled, masked image (from scipy.ndimage.label)
-        self.label = label
-
-    def __str__(self):
-        return ('Fiber id %i: center %g,%g; star %g,%g; radius %g' %
-                (self.fiberid, self.xcen, self.ycen, self.xs, self.ys,
-                 self.radius))
-
-    def set_fake(self):
-        self.xcen = np.nan
-
-    def is_fake(self):
-        return np.isnan(self.xcen)
-
-
-# The following are ctypes classes for interaction with the ipGguide.c code.
-class REGION(ctypes.Structure):
-    _fields_ = [('nrow', ctypes.c_int), ('ncol', ctypes.c_int),
-                ('rows_s16', ctypes.POINTER(ctypes.POINTER(ctypes.c_int16)))]
-
-
-class MASK(ctypes.Structure):
-    _fields_ = [('nrow', ctypes.c_int), ('ncol', ctypes.c_int),
-                ('rows', ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte)))]
-
-
-class FIBERDATA(ctypes.Structure):
-    _fields_ = [('g_nfibers', ctypes.c_int), ('g_fid',
-                                              ctypes.POINTER(ctypes.c_int32)),
-                ('g_xcen',
-                 ctypes.POINTER(ctypes.c_double)), ('g_ycen',
-                                                    ctypes.POINTER(
-                                                        ctypes.c_double)),
-                ('g_fibrad',
-                 ctypes.POINTER(ctypes.c_double)), ('g_illrad',
-                                                    ctypes.POINTER(
-                                                        ctypes.c_double)),
-                ('g_xs', ctypes.POINTER(
-                    ctypes.c_double)), ('g_ys', ctypes.POINTER(
-                        ctypes.c_double)), ('flux',
-                                            ctypes.POINTER(ctypes.c_double)),
-                ('sky', ctypes.POINTER(
-                    ctypes.c_double)), ('fwhm', ctypes.POINTER(
-                        ctypes.c_double)), ('poserr',
-                                            ctypes.POINTER(ctypes.c_double)),
-                ('g_readnoise', ctypes.c_double), ('g_npixmask', ctypes.c_int)]
-
-
-# Must match ipGguide.h
-FWHM_BAD = 99.99
-
-
-def np_array_to_REGION(A):
-    H, W = A.shape
-    ptrtype = ctypes.POINTER(ctypes.c_int16)
-    rows = (ptrtype * H)(*[row.ctypes.data_as(ptrtype) for row in A])
-    return REGION(H, W, rows)
-
-
-def np_array_to_MASK(A):
-    H, W = A.shape
-    ptrtype = ctypes.POINTER(ctypes.c_uint8)
-    rows = (ptrtype * H)(*[row.ctypes.data_as(ptrtype) for row in A])
-    return MASK(H, W, rows)
-
-
 def bin_image(img, BIN):
     """Return an image rebinned by BINxBIN pixels."""
     binned = np.zeros((img.shape[0] / BIN, img.shape[1] / BIN), np.float32)
@@ -132,15 +43,204 @@ def bin_image(img, BIN):
     return binned
 
 
+def match_fibers(fiberXY, fiberRadius, probeXY, width, height, prior=None, maxPoints=1000000):
+    """
+    Find the x,y translation that puts the most probes on fibers, and match them up.
+
+    fiberXY is an (nFiber, 2) array of the fiber centres found in a flat,
+    fiberRadius their radii, and probeXY an (nProbe, 2) array of the probe
+    positions from the plugmap, all in binned pixels. Each translation that
+    takes a probe onto a fiber, and keeps all the probes inside the
+    width x height image, is scored by the number of probes it puts within
+    the radius of their nearest fiber, using a KD-tree of the fibers. If
+    prior (a previous flat's translation) already matches all it can, it is
+    used without searching. Conflicts are resolved by matching the probes
+    to fibers with the least total distance.
+
+    Returns (dx, dy, matches), with the mean translation of the matched
+    probes and a list of (fiber index, probe index), or None if no
+    translation matches any probe.
+    """
+    tree = cKDTree(fiberXY)
+
+    def score(shifts):
+        points = (probeXY[np.newaxis, :, :] + shifts[:, np.newaxis, :]).reshape(-1, 2)
+        distance, nearest = tree.query(points)
+        return (distance < fiberRadius[nearest]).reshape(len(shifts), -1).sum(axis=1)
+
+    best = None
+    if prior is not None:
+        shift = np.array([prior], dtype=float)
+        if score(shift)[0] == min(len(fiberXY), len(probeXY)):
+            best = shift[0]
+    if best is None:
+        # All the fiber-probe pairs, fiber by fiber.
+        shifts = (fiberXY[:, np.newaxis, :] - probeXY[np.newaxis, :, :]).reshape(-1, 2)
+        low = probeXY.min(axis=0) + shifts
+        high = probeXY.max(axis=0) + shifts
+        shifts = shifts[(low >= 0).all(axis=1) & (high[:, 0] <= width) & (high[:, 1] <= height)]
+        if len(shifts) == 0:
+            return None
+        # Score them in chunks of at most maxPoints shifted probes.
+        step = max(1, maxPoints // len(probeXY))
+        hits = np.concatenate([score(shifts[i:i + step]) for i in range(0, len(shifts), step)])
+        if hits.max() == 0:
+            return None
+        best = shifts[np.argmax(hits)]
+
+    predicted = probeXY + best
+    distance = np.hypot(predicted[:, np.newaxis, 0] - fiberXY[np.newaxis, :, 0],
+                        predicted[:, np.newaxis, 1] - fiberXY[np.newaxis, :, 1])
+    near = distance < fiberRadius[np.newaxis, :]
+    probes, fibers = linear_sum_assignment(np.where(near, distance, 1e9))
+    keep = near[probes, fibers]
+    probes, fibers = probes[keep], fibers[keep]
+    dx, dy = best + (fiberXY[fibers] - predicted[probes]).mean(axis=0)
+    return dx, dy, zip(fibers, probes)
+
+
+def _rotation_grid(size, theta, scale):
+    """
+    Return the fixed-point (x, y) source coordinates, and whether they are
+    inside the stamp, of each pixel of a size x size stamp rotated
+    counterclockwise by theta degrees, exactly as grot() (scale=8192) and
+    maskrot() (scale=256) in src/gimg/gutils.c compute them.
+    """
+    # theta is passed to C as a float, and the trig factors truncated to int.
+    thetrad = np.pi * float(np.float32(theta)) / 180.
+    cthet = int(scale * np.cos(thetrad))
+    sthet = int(scale * np.sin(thetrad))
+    half = size // 2
+    i, j = np.mgrid[:size, :size] - half
+    xrf = j * cthet + i * sthet + half * scale
+    yrf = i * cthet - j * sthet + half * scale
+    limit = (size - 1) * scale
+    inside = (xrf >= 0) & (xrf < limit) & (yrf >= 0) & (yrf < limit)
+    return np.where(inside, xrf, 0), np.where(inside, yrf, 0), inside
+
+
+class StampRemap(object):
+    """
+    The source pixels of each pixel of a set of fibers' rotated postage
+    stamps, so that all the stamps can be cut out of a frame with one gather.
+
+    The fibers' stamps are (2r+1)x(2r+1) pixels, centred on their rounded
+    centres and rotated by -rotStar2Sky, which are fixed for a flat: build
+    this once per flat and call it for each frame. The stamps are
+    bit-identical to rotating each one with libguide's rotate_region() and
+    rotate_mask() (bilinear and nearest-pixel interpolation respectively),
+    except that fibers with no rotation yet are not rotated.
+    """
+
+    def __init__(self, fibers, r, shape):
+        """fibers is a list of Fibers, r the stamp radius and shape the frame's."""
+        size = 2 * r + 1
+        height, width = shape
+        n = len(fibers)
+        self.shape = shape
+        # the 4 source pixels and their weights (summing to 65536) of each
+        # stamp pixel, and nearest source pixel of each mask stamp pixel.
+        self.index = np.zeros((4, n, size, size), np.intp)
+        self.weight = np.zeros((4, n, size, size), np.int32)
+        self.maskIndex = np.zeros((n, size, size), np.intp)
+        self.maskInside = np.zeros((n, size, size), bool)
+        for k, f in enumerate(fibers):
+            x0 = int(f.xcen + 0.5) - r
+            y0 = int(f.ycen + 0.5) - r
+            rot = -f.gProbe.rotStar2Sky
+            # e.g. in a flat, before the guide loop has set rotStar2Sky:
+            # rotate_region() made a checkerboard of the centre pixel.
+            if np.isnan(rot):
+                rot = 0.
+
+            xrf, yrf, inside = _rotation_grid(size, rot, 8192)
+            xr = x0 + (xrf >> 13)
+            yr = y0 + (yrf >> 13)
+            # stamps that go over the edge of the frame are blank there.
+            inside &= (xr >= 0) & (xr + 1 < width) & (yr >= 0) & (yr + 1 < height)
+            xrem = (xrf & 8191) >> 5
+            yrem = (yrf & 8191) >> 5
+            base = np.where(inside, yr * width + xr, 0)
+            self.index[:, k] = (base, base + width, base + 1, base + width + 1)
+            self.weight[:, k] = inside * np.array(((256 - xrem) * (256 - yrem),
+                                                   (256 - xrem) * yrem,
+                                                   xrem * (256 - yrem),
+                                                   xrem * yrem))
+
+            xrf, yrf, inside = _rotation_grid(size, rot, 256)
+            # round half-pixels up.
+            xr = x0 + ((xrf >> 7) + 1) // 2
+            yr = y0 + ((yrf >> 7) + 1) // 2
+            inside &= (xr >= 0) & (xr < width) & (yr >= 0) & (yr < height)
+            self.maskIndex[k] = np.where(inside, yr * width + xr, 0)
+            self.maskInside[k] = inside
+
+        # The stamps are stored flipped top to bottom, and stacked vertically.
+        self.index = self.index[:, :, ::-1].reshape(4, n * size, size)
+        self.weight = self.weight[:, :, ::-1].reshape(4, n * size, size)
+        self.maskIndex = self.maskIndex[:, ::-1].reshape(n * size, size)
+        self.maskInside = self.maskInside[:, ::-1].reshape(n * size, size)
+
+    def __call__(self, image, mask):
+        """
+        Return the stacked int16 image and uint8 mask stamps of image and mask.
+        Pixels rotated in from outside a stamp are 0 in the image stamp, and
+        mask_masked in the mask stamp.
+        """
+        # int16 before interpolating, like the stamps handed to rotate_region().
+        pixels = image.take(self.index).astype(np.int16)
+        stamps = (pixels * self.weight).sum(axis=0) >> 16
+        stamps = stamps.astype(np.int16)
+        maskstamps = mask.take(self.maskIndex).astype(np.uint8)
+        maskstamps[~self.maskInside] = GuiderImageAnalysis.mask_masked
+        return stamps, maskstamps
+
+
+# star finders: libguide's gfindstars(), or starFinder.find_stars().
+STAR_FINDER_GFINDSTARS = 'gfindstars'
+STAR_FINDER_NUMPY = 'numpy'
+
+
+# proc- file formats: whole-file gzip, or FITS tile-compressed extensions.
+PROC_GZIP = 'gzip'
+PROC_TILE = 'tile'
+
+
+def tile_compress(hdulist, quantizeLevel=16):
+    """
+    Return a copy of hdulist with its image extensions Rice tile-compressed.
+
+    Integer images are compressed losslessly; float images are quantized,
+    keeping quantizeLevel levels per standard deviation of their noise.
+    The primary HDU cannot be compressed (FITS only allows that for
+    extensions), and is kept as it is, as are empty images and tables,
+    so the HDUs stay in the same order as described by SDSSFMT.
+    uint8 images (the masks) are not compressed either, since pyfits reads
+    tile-compressed uint8 back as int8 (with a bad checksum), and readers of
+    proc- files expect uint8 masks.
+    """
+    compressed = pyfits.HDUList()
+    for hdu in hdulist:
+        if (isinstance(hdu, pyfits.ImageHDU) and hdu.data is not None and hdu.data.size > 0 and
+                hdu.data.dtype != np.uint8):
+            hdu = pyfits.CompImageHDU(
+                hdu.data,
+                header=hdu.header,
+                compression_type='RICE_1',
+                quantize_level=quantizeLevel)
+        compressed.append(hdu)
+    return compressed
+
+
 class GuiderImageAnalysis(object):
     '''
     A class for analyzing the images taken by the guiding camera.
 
     guiderImageAnalysis = GuiderImageAnalysis()
     # for each new exposure:
-        gimg_filename = 'gimg-0400.fits'
+        frame = GuiderFrame.read('gimg-0400.fits')
         # cmd must have methods "inform(string)", "warn(string)".
-        fibers = guiderImageAnalysis(gimg_filename, gState.gprobes, cmd)
+        fibers = guiderImageAnalysis(cmd, frame, gState.gprobes, setPoint)
         # run guider control loop...
         guiderImageAnalyze.writeFITS(actorState.models, guideCmd, frameInfo, gState.gprobes)
     '''
@@ -152,14 +252,19 @@ class GuiderImageAnalysis(object):
     mask_badpixels = 2
     mask_masked = 4  # ie, outside the guide fiber
 
-    def __init__(self, setPoint):
+    def __init__(self, setPoint, calibCache=None, sparse=False):
         """
         New GuiderImageAnalysis instances are ready to accept files for processing.
         setPoint is the current gcamera temperature set point.
+        calibCache is a CalibrationCache for the processed darks and flats;
+        a default-sized one is created if it is not given.
+        If sparse, findStars only calibrates the pixels inside the fibers.
         """
         self.setPoint = setPoint
         self.outputDir = ''
         self.camera = 'gcamera'
+        # the GuiderFrame currently being processed, set by __call__().
+        self.frame = None
         # set during findStars():
         self.fibers = None
         self.guiderImage = None
@@ -173,6 +278,34 @@ class GuiderImageAnalysis(object):
         self.processedDark = None
         self.processedFlat = None
         self.darkTemperature = None
+        # Recently used processed darks and flats, so that switching between
+        # them doesn't mean re-reading their proc- files.
+        self.calibCache = calibCache if calibCache is not None else CalibrationCache()
+        # The scaled dark, inverse flat and mask for the current exposures,
+        # and for the last few exposure times, darks and flats used.
+        self.calibProduct = None
+        self.calibProducts = CalibrationProducts()
+        # The x,y offset of each cartridge's fibers from its probe positions in
+        # its last flat, to start looking for them in the next one.
+        self.flatOffsets = {}
+        # The StampRemaps for the current flat's fibers: see getStampHDUs().
+        self._stampRemaps = {}
+        # The (fibers, guideLib.FiberData) for gfindstars: see _get_fiber_data().
+        self._fiberData = None
+        # Per-frame work arrays, reused from one frame to the next: see _buffer().
+        self._buffers = {}
+        self.sparse = sparse
+        # If set, a writerThread.ProcFileWriter that writes the proc- files.
+        self.writer = None
+        # The stageTimer.FrameTimer for the frame being processed: see __call__().
+        self.timer = FrameTimer()
+        # PROC_GZIP or PROC_TILE, and the float quantization level for PROC_TILE.
+        self.procFormat = PROC_GZIP
+        self.procQuantizeLevel = 16
+        # STAR_FINDER_GFINDSTARS or STAR_FINDER_NUMPY, and whether to also run
+        # the other one on each frame and report how their results differ.
+        self.starFinder = STAR_FINDER_GFINDSTARS
+        self.starFinderShadow = False
 
         # Print debugging?
         self.printDebug = False
@@ -220,26 +353,36 @@ class GuiderImageAnalysis(object):
                  gprobes,
                  setPoint,
                  bypassDark=False,
-                 camera='gcamera'):
+                 camera='gcamera',
+                 timer=None):
         """
         Calls findStars to process gimgfn/gprobes and return found fibers.
 
-        gimgfn is the unprocessed gcamera file to process.
+        gimgfn is the unprocessed gcamera exposure to process: either a
+        GuiderFrame that has already been read, or the name of the file.
         gprobes is from GuiderState: it's a dict of probeId to GProbe object.
         cmd is a Commander object, to allow messaging (diag/inform/warn).
         setPoint is the current gcamera temperature set point.
         set bypassDark to ignore guider dark frames, and not do dark subtraction.
         camera can be either 'gcamera' to find fibers for guiding, or
         'ecamera' to find the brightest star for a pointing model.
+        timer is the stageTimer.FrameTimer to time the processing stages with
+        (a new one if not given), which writeFITS() also uses.
         """
-        self.gimgfn = gimgfn
-        # don't like the re, but it works (stolen from masterThread.guideStep)
-        self.frameNo = int(re.search(r"([0-9]+)\.fits.*$", gimgfn).group(1))
+        self.timer = timer if timer is not None else FrameTimer()
         self.setPoint = setPoint
         self.bypassDark = bypassDark
         self.cmd = cmd
         self.camera = camera
 
+        if isinstance(gimgfn, GuiderFrame):
+            self.frame = gimgfn
+        else:
+            self.cmd.diag('text=%s' % qstr('Reading guider-cam image %s' % gimgfn))
+            self.frame = GuiderFrame.read(gimgfn, timer=self.timer)
+        self.gimgfn = self.frame.filename
+        self.frameNo = self.frame.frameNo
+
         return self.findStars(gprobes)
 
     def pixels2arcsec(self, pix):
@@ -252,6 +395,18 @@ class GuiderImageAnalysis(object):
             return -99
         return -2.5 * np.log10(flux / exptime) + self.zeropoint
 
+    def _buffer(self, name, shape, dtype):
+        """
+        Return the work array called name, allocating it only if this is the
+        first time through or its shape or dtype changed. Its contents are
+        whatever the last frame left in it.
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self._buffers[name] = buf
+        return buf
+
     def find_bias_level(self, image, binning=1):
         """
         Find the bias level of the image.
@@ -275,42 +430,21 @@ class GuiderImageAnalysis(object):
             self.cmd.warn(
                 'text=%s' %
                 qstr('Cheating with bais level! No overscan was found!'))
-            ir = image.ravel()
-            II = np.argsort(ir)
-            bias = ir[II[int(0.3 * len(ir))]]
+            # partition a scratch copy: we only need the one order statistic.
+            ir = self._buffer('bias', (image.size, ), image.dtype)
+            ir[:] = image.ravel()
+            k = int(0.3 * len(ir))
+            ir.partition(k)
+            bias = ir[k]
         self.imageBias = bias
 
     def ensureLibraryLoaded(self):
         """
         Load C library that does the fluxing, etc.: lib/libguide.so -> self.libguide
-        See src/ipGguide.c for the actual calculations.
+        See src/ipGguide.c for the actual calculations, and guideLib for the
+        interface to it, which only loads it the first time.
         """
-        path = os.path.expandvars('$GUIDERACTOR_DIR/lib/libguide.so')
-        libguide = ctypes.CDLL(path)
-        if not libguide:
-            self.cmd.error('text=%s' % qstr(
-                'Failed to load "libguide.so" from %s ($GUIDERACTOR_DIR/lib/libguide.so)'
-                % path))
-        libguide.gfindstars.argtypes = [
-            ctypes.POINTER(REGION),
-            ctypes.POINTER(FIBERDATA), ctypes.c_int
-        ]
-        libguide.gfindstars.restype = ctypes.c_int
-        libguide.fiberdata_new.argtypes = [ctypes.c_int]
-        libguide.fiberdata_new.restype = ctypes.POINTER(FIBERDATA)
-        libguide.fiberdata_free.argtypes = [ctypes.POINTER(FIBERDATA)]
-        libguide.fiberdata_free.restype = None
-        libguide.rotate_region.argtypes = [
-            ctypes.POINTER(REGION),
-            ctypes.POINTER(REGION), ctypes.c_float
-        ]
-        libguide.rotate_region.restype = None
-        libguide.rotate_mask.argtypes = [
-            ctypes.POINTER(MASK),
-            ctypes.POINTER(MASK), ctypes.c_float
-        ]
-        libguide.rotate_mask.restype = None
-        self.libguide = libguide
+        self.libguide = guideLib.load()
 
     def findDarkAndFlat(self, gimgfn, fitsheader):
         """ findDarkAndFlat(...)
@@ -431,6 +565,7 @@ class GuiderImageAnalysis(object):
             ('decenterScale', 'dcnScle', 'applied user supplied scale offset, %'),
             ('wavelength', 'wavelgth', 'wavelength at which guiding has been optimised, Angstrom'),
             ('refractionBalance', 'refrBal', 'specified refraction balance between (0,1)'),
+            ('inMotion', 'inMotion', 'telescope moved during exposure?'),
         )
         # TBD: FIXME PH --- do we change to 1e6 units for scale
         cards = []
@@ -456,43 +591,19 @@ class GuiderImageAnalysis(object):
                 pyfits.ImageHDU(np.array([[]]).astype(np.int16)),
                 pyfits.ImageHDU(np.array([[]]).astype(np.uint8))
             ]
-        self.ensureLibraryLoaded()
         r = int(np.ceil(max([f.radius for f in fibers])))
-        stamps = []
-        maskstamps = []
-        for f in fibers:
-            xc = int(f.xcen + 0.5)
-            yc = int(f.ycen + 0.5)
-            rot = -f.gProbe.rotStar2Sky
-            self.cmd.diag('text=%s' % qstr(
-                'rotating fiber %d at (%d,%d) by %0.1f degrees' %
-                (f.fiberid, xc, yc, rot)))
-            # Rotate the fiber image...
-            stamp = image[yc - r:yc + r + 1, xc - r:xc + r + 1].astype(
-                np.int16)
-            rstamp = np.zeros_like(stamp)
-            self.libguide.rotate_region(
-                np_array_to_REGION(stamp), np_array_to_REGION(rstamp), rot)
-            stamps.append(np.flipud(rstamp))
-            # Rotate the mask image...
-            stamp = mask[yc - r:yc + r + 1, xc - r:xc + r + 1].astype(np.uint8)
-            # print 'stamp values:', unique(stamp.ravel())
-            # Replace zeros by 255 so that after rotate_region (which puts
-            # zeroes in the "blank" regions) we can replace them.
-            stamp[stamp == 0] = 255
-            rstamp = np.zeros_like(stamp)
-            self.libguide.rotate_mask(
-                np_array_to_MASK(stamp), np_array_to_MASK(rstamp), rot)
-            # "blank" regions become masked-out pixels.
-            rstamp[rstamp == 0] = GuiderImageAnalysis.mask_masked
-            # Reinstate the zeroes.
-            rstamp[rstamp == 255] = 0
-            # print 'rotated stamp values:', unique(rstamp.ravel())
-            maskstamps.append(np.flipud(rstamp))
-
-        # Stack the stamps into one image.
-        stamps = np.vstack(stamps)
-        maskstamps = np.vstack(maskstamps)
+        key = (image.shape, r, tuple((f.fiberid, f.xcen, f.ycen, f.gProbe.rotStar2Sky)
+                                     for f in fibers))
+        remap = self._stampRemaps.get(key)
+        if remap is None:
+            for f in fibers:
+                self.cmd.diag('text=%s' % qstr(
+                    'rotating fiber %d at (%d,%d) by %0.1f degrees' %
+                    (f.fiberid, int(f.xcen + 0.5), int(f.ycen + 0.5), -f.gProbe.rotStar2Sky)))
+            remap = StampRemap(fibers, r, image.shape)
+            self._stampRemaps[key] = remap
+        stamps, maskstamps = remap(image, mask)
+
         # Replace zeroes by bg
         stamps[stamps == 0] = bg
         # Also replace masked regions by bg.
@@ -530,40 +641,26 @@ class GuiderImageAnalysis(object):
 
         try:
             # List the fibers by fiber id.
+            if not isinstance(fibers, FiberTable):
+                fibers = FiberTable.from_fibers(fibers)
             fiberids = sorted(gprobes.keys())
-            sfibers = []
-            myfibs = dict([(f.fiberid, f) for f in fibers])
-            for fid in fiberids:
-                if fid in myfibs:
-                    sfibers.append(myfibs[fid])
-                else:
-                    # Put in NaN fake fibers for ones that weren't found.
-                    fake = Fiber(fid)
-                    fake.gProbe = gprobes[fid]
-                    fake.gProbe.disabled = True
-                    sfibers.append(fake)
-            fibers = sfibers
+            missing = ~np.in1d(fiberids, fibers.data['fiberid'])
+            fibers = fibers.by_fiberid(fiberids)
+            # The NaN fake fibers for ones that weren't found.
+            for i in np.flatnonzero(missing):
+                fibers.gprobes[i] = gprobes[fiberids[i]]
+                fibers.gprobes[i].disabled = True
 
             # Split into small and big fibers.
             # Also create the columns "stampInds" and "stampSizes"
             # for the output table.
-            smalls = []
-            bigs = []
-            stampInds = []
-            stampSizes = []
-            for f in fibers:
-                if f.is_fake():
-                    stampSizes.append(0)
-                    stampInds.append(-1)
-                elif f.radius < self.bigFiberRadius:
-                    # must do this before appending to smalls!
-                    stampInds.append(len(smalls))
-                    stampSizes.append(1)
-                    smalls.append(f)
-                else:
-                    stampInds.append(len(bigs))
-                    stampSizes.append(2)
-                    bigs.append(f)
+            fake = fibers.fake()
+            small = ~fake & (fibers.data['radius'] < self.bigFiberRadius)
+            big = ~fake & ~small
+            stampSizes = np.where(small, 1, np.where(big, 2, 0))
+            stampInds = np.where(small, np.cumsum(small) - 1, np.where(big, np.cumsum(big) - 1, -1))
+            smalls = [fibers[i] for i in np.flatnonzero(small)]
+            bigs = [fibers[i] for i in np.flatnonzero(big)]
 
             hdulist.append(pyfits.ImageHDU(mask))
             hdulist += self.getStampHDUs(smalls, bg, stampImage, mask)
@@ -572,22 +669,21 @@ class GuiderImageAnalysis(object):
             # jkp TBD: rework this to make it more legible/easily extensible.
             pixunit = 'guidercam pixels (binned)'
             gpinfofields = [
-                # python attr, FITScol (if diff), FITStype, NIL val, unit
-                ('exists', None, 'L', np.nan, None),
-                ('enabled', None, 'L', np.nan, None),
-                ('gprobebits', None, 'B', np.nan, None),
-                ('xFocal', None, 'E', np.nan, 'plate mm'),
-                ('yFocal', None, 'E', np.nan, 'plate mm'),
-                ('radius', None, 'E', np.nan, pixunit),
-                ('xFerruleOffset', None, 'E', np.nan, None),
-                ('yFerruleOffset', None, 'E', np.nan, None),
-                ('rotation', None, 'E', np.nan, None),
-                ('rotStar2Sky', None, 'E', np.nan, None),
-                ('focusOffset', None, 'E', np.nan, 'micrometers'),
-                ('fiber_type', None, 'A20', np.nan, None),
-                ('ugriz', None, '5E', [np.nan] * 5, 'mag'),
-                ('ref_mag', None, 'E', np.nan,
-                 'synthetic predicted fiber mag'),
+                # GProbeTable column, FITScol (if diff), FITStype, unit
+                ('exists', None, 'L', None),
+                ('enabled', None, 'L', None),
+                ('bits', 'gprobebits', 'B', None),
+                ('xFocal', None, 'E', 'plate mm'),
+                ('yFocal', None, 'E', 'plate mm'),
+                ('radius', None, 'E', pixunit),
+                ('xFerruleOffset', None, 'E', None),
+                ('yFerruleOffset', None, 'E', None),
+                ('rotation', None, 'E', None),
+                ('rotStar2Sky', None, 'E', None),
+                ('focusOffset', None, 'E', 'micrometers'),
+                ('fiber_type', None, 'A20', None),
+                ('ugriz', None, '5E', 'mag'),
+                ('ref_mag', None, 'E', 'synthetic predicted fiber mag'),
             ]
 
             ffields = [
@@ -609,31 +705,33 @@ class GuiderImageAnalysis(object):
                 ('poserr', 'xyserr', 'E', pixunit),
             ]
 
-            # TBD: FIXME -- rotStar2Sky -- should check with "hasattr"...
+            # The fibers' probes (UNKNOWN bits and NaN for those that have none).
+            probes = GProbeTable.from_probes(fibers.gprobes)
+            probeData = dict((name, probes.data[name]) for name in probes.data.dtype.names)
+            probeData['exists'] = probes.exists()
+            probeData['enabled'] = probes.enabled()
             cols = []
-            for name, fitsname, fitstype, nilval, units in gpinfofields:
-                if fitsname is None:
-                    fitsname = name
+            for name, fitsname, fitstype, units in gpinfofields:
                 cols.append(
                     pyfits.Column(
-                        name=fitsname,
+                        name=fitsname or name,
                         format=fitstype,
                         unit=units,
-                        array=np.array([getattr(f.gProbe, name, nilval) for f in fibers])))
+                        array=probeData[name]))
             for name, atname, fitstype, units in ffields:
                 cols.append(
                     pyfits.Column(
                         name=name,
                         format=fitstype,
                         unit=units,
-                        array=np.array([getattr(f, atname or name) for f in fibers])))
+                        array=fibers.data[atname or name]))
 
             cols.append(
                 pyfits.Column(
-                    name='stampSize', format='I', array=np.array(stampSizes)))
+                    name='stampSize', format='I', array=stampSizes))
             cols.append(
                 pyfits.Column(
-                    name='stampIdx', format='I', array=np.array(stampInds)))
+                    name='stampIdx', format='I', array=stampInds))
 
             hdulist.append(pyfits.new_table(cols))
         except Exception as e:
@@ -646,40 +744,98 @@ class GuiderImageAnalysis(object):
     def writeFITS(self, models, cmd, frameInfo, gprobes, output_verify='warn'):
         """
         Write a fits file containing the processed results for this exposure.
+
+        If self.writer is set, the file is only built here, from copies of the
+        per-frame arrays, and the writer's thread compresses and writes it.
+
+        With procFormat PROC_TILE, the image extensions are tile-compressed
+        instead of gzipping the whole file, and the name loses its .gz.
+
+        Filling in the primary header is timed as the cards stage, and the
+        rest as the write stage (just queueing the file, if there is a writer).
         """
         if not self.fibers and self.camera != 'ecamera':
             raise Exception('must call findStars() before writeFITS()')
-        image = self.guiderImage
+        with self.timer.stage('write'):
+            image, maskImage = self.getFullImage()
+            if self.writer is not None:
+                # the next frame will reuse these arrays.
+                image, maskImage = image.copy(), maskImage.copy()
         hdr = self.guiderHeader
 
         procpath = self.getProcessedOutputName(self.gimgfn)
         objectname = os.path.splitext(self.gimgfn)[0]
 
         try:
-            if self.camera == 'gcamera':
-                hdulist = self._getProcGimgHDUList(hdr, gprobes, self.fibers,
-                                                   image, self.maskImage)
-            elif self.camera == 'ecamera':
-                bg = np.median(image)  # TBD: this is a poor choice for star-filled ecam images!
-                hdulist = self._get_basic_hdulist(image, hdr, bg)
-                hdulist.append(pyfits.ImageHDU(self.maskImage))
+            with self.timer.stage('write'):
+                if self.camera == 'gcamera':
+                    hdulist = self._getProcGimgHDUList(hdr, gprobes, self.fibers,
+                                                       image, maskImage)
+                elif self.camera == 'ecamera':
+                    bg = np.median(image)  # TBD: this is a poor choice for star-filled ecam images!
+                    hdulist = self._get_basic_hdulist(image, hdr, bg)
+                    hdulist.append(pyfits.ImageHDU(maskImage))
             imageHDU = hdulist[0]
-            self.fillPrimaryHDU(cmd, models, imageHDU, frameInfo, objectname)
-            directory, filename = os.path.split(procpath)
-            actorFits.writeFits(
-                cmd,
-                hdulist,
-                directory,
-                filename,
-                doCompress=True,
-                chmod=0644,
-                checksum=True,
-                output_verify=output_verify)
-            self.cmd.inform('file=%s/,%s' % (directory, filename))
+            with self.timer.stage('cards'):
+                self.fillPrimaryHDU(cmd, models, imageHDU, frameInfo, objectname)
+            with self.timer.stage('write'):
+                self._write_proc_file(cmd, hdulist, procpath, output_verify)
         except Exception as e:
             cmd.error('text="failed to write FITS file %s: %r"' % (procpath, e))
             raise e
 
+    def _write_proc_file(self, cmd, hdulist, procpath, output_verify):
+        """Compress and write hdulist to procpath, or queue it for the writer."""
+        directory, filename = os.path.split(procpath)
+        doCompress = self.procFormat != PROC_TILE
+        if not doCompress:
+            hdulist = tile_compress(hdulist, self.procQuantizeLevel)
+            if filename.endswith('.gz'):
+                filename = filename[:-len('.gz')]
+        if self.writer is not None:
+            self.writer.put(ProcFileJob(self.cmd, hdulist, directory, filename,
+                                        doCompress=doCompress,
+                                        output_verify=output_verify))
+            return
+        actorFits.writeFits(
+            cmd,
+            hdulist,
+            directory,
+            filename,
+            doCompress=doCompress,
+            chmod=0644,
+            checksum=True,
+            output_verify=output_verify)
+        self.cmd.inform('file=%s/,%s' % (directory, filename))
+
+    def _write_calibration(self, hdulist, procpath, cached):
+        """
+        Write a processed dark or flat hdulist to procpath, in the background
+        if we have a writer, and once it is written cache its arrays, cached,
+        under the version of procpath that was written. We keep using hdulist's
+        arrays (which writing can byteswap in place), so the writer gets a copy
+        of them; the writer never drops it, even when it is behind.
+        """
+        directory, filename = os.path.split(procpath)
+
+        def cache():
+            self.calibCache.put(procpath, cached)
+
+        if self.writer is not None:
+            hdulist = pyfits.HDUList([hdu.copy() for hdu in hdulist])
+            self.writer.put(ProcFileJob(self.cmd, hdulist, directory, filename,
+                                        checksum=False, announce=False,
+                                        droppable=False, onWritten=cache))
+            return
+        actorFits.writeFits(
+            self.cmd, hdulist, directory, filename, doCompress=True, chmod=0644)
+        cache()
+
+    def flush(self):
+        """Wait until all the proc- files from writeFITS() have been written."""
+        if self.writer is not None:
+            self.writer.flush()
+
     def _check_ccd_temp(self, header):
         """Return True if gcamera CCDTEMP is within deltaTemp of setPoint and darkTemperature."""
 
@@ -713,31 +869,44 @@ class GuiderImageAnalysis(object):
             result = False
         return result
 
-    def _pre_process(self, filename, binning=1):
+    def _pre_process(self, frame, binning=1, reuseBuffers=False):
         """
         Initial checks and processing on any kind of exposure.
 
+        frame is a GuiderFrame, or the name of a file to read one from.
         Returns image,hdr,sat if everything goes well, raises exceptions if not.
+        The returned image is a processed float32 copy: frame.image is left untouched.
+        If reuseBuffers, image and sat are the per-frame work arrays, which
+        the next frame will overwrite: calibrations must not set it.
         """
-        assert (filename)
+        assert (frame)
         self.ensureLibraryLoaded()
 
-        # files prior to MJD 56465 have the dark/flat without .gz in the header.
-        if not os.path.exists(filename):
-            filename += '.gz'
-        # Load guider-cam image.
-        self.cmd.diag(
-            'text=%s' % qstr('Reading guider-cam image %s' % filename))
-        try:
-            image, hdr = pyfits.getdata(filename, 0, header=True)
-        except IOError:
-            raise GuiderExceptions.GuiderError('File not found: %s' % filename)
+        if not isinstance(frame, GuiderFrame):
+            # Load guider-cam image.
+            self.cmd.diag('text=%s' % qstr('Reading guider-cam image %s' % frame))
+            frame = GuiderFrame.read(frame)
+        hdr = frame.header
+        if reuseBuffers:
+            image = self._buffer('image', frame.image.shape, np.float32)
+            sat = self._buffer('sat', frame.image.shape, np.bool_)
+            image[...] = frame.image
+        else:
+            image = np.array(frame.image, dtype=np.float32)
+            sat = np.empty(image.shape, np.bool_)
 
         # Find saturation level pre-bias.
-        sat = (image.astype(int) >= self.saturationLevel)
-        nSat = sat.sum()
+        np.greater_equal(image, self.saturationLevel, out=sat)
+        nSat = np.count_nonzero(sat)
 
         image = self.applyBias(image, binning)
+        self._check_read(nSat)
+        np.copyto(image, self.saturationReplacement, where=sat)
+
+        return image, hdr, sat
+
+    def _check_read(self, nSat):
+        """Raise if the bias level or the nSat saturated pixels mean the exposure is unusable."""
         # Occasionally there is a bad read from the camera.
         # In this case, the bias level is ~35,000, and the stddev is low.
         # We can just reject such frames, as they are useless.
@@ -753,9 +922,6 @@ class GuiderImageAnalysis(object):
             self.cmd.error('text=%s' % qstr('Fully saturated! Please reduce exposure time '
                                             'or wait for the excess light to go away.'))
             raise GuiderExceptions.GuiderError
-        image[sat] = self.saturationReplacement
-
-        return image, hdr, sat
 
     def _find_stars_ecam(self, image, mask):
         """Find the stars in a processed ecamera image."""
@@ -786,7 +952,7 @@ class GuiderImageAnalysis(object):
     def findStars(self, gprobes):
         """
         Identify the centers of the stars in the fibers.
-        Assumes self.gimgfn is set to the correct file name.
+        Assumes self.frame is set to the GuiderFrame to process (see __call__).
 
         gState is a GuiderState instance, containing a gprobes dict.
 
@@ -797,62 +963,49 @@ class GuiderImageAnalysis(object):
         flat.  Since this flat is shared by many guider-cam images, the
         results of analyzing it are cached in a "proc-gimg-" file for the flat.
 
-        Returns a list of fibers; also sets several fields in this object.
+        In sparse mode, only the pixels inside the fibers are calibrated here:
+        the full guiderImage and maskImage are left as None until
+        getFullImage() is called (e.g. by writeFITS).
 
-        The list of fibers contains an entry for each fiber found.
+        Returns a FiberTable of the fibers; also sets several fields in this object.
+
+        The table has a row for each fiber found in the flat.
         """
-        image, hdr, sat = self._pre_process(self.gimgfn, binning=self.binning)
+        hdr = self.frame.header
+        sparse = self.sparse and self.camera == 'gcamera'
+        if not sparse:
+            with self.timer.stage('bias'):
+                image, hdr, sat = self._pre_process(self.frame, binning=self.binning,
+                                                    reuseBuffers=True)
 
-        exptime = hdr.get('EXPTIME', 0)
+        exptime = self.frame.exptime
 
         (darkFileName, flatFileName) = self.findDarkAndFlat(self.gimgfn, hdr)
-        image = self.applyDark(image, darkFileName, exptime)
+        with self.timer.stage('dark'):
+            self.loadDark(darkFileName)
 
         # Check after we've loaded the dark, to ensure the dark temperature was set.
         self._check_ccd_temp(hdr)
         self.cmd.diag('text=%s' % qstr('Using flat image: %s' % flatFileName))
-        if flatFileName != self.currentFlatName:
-            try:
-                self.analyzeFlat(flatFileName, gprobes)
-            except GuiderExceptions.FlatError as e:
-                # e.g.: no fibers could be found in the flat
-                self.cmd.warn('text=%s' % qstr('Error processsing flat!'))
-                raise e
-        fibers = [f for f in self.flatFibers if not f.is_fake()]
-        # mask the saturated pixels with the appropriate value.
-        mask = self.flatMask.copy()
-        mask[sat] |= GuiderImageAnalysis.mask_saturated
-
-        # Divide by the flat (avoiding NaN where the flat is zero)
-        image /= (self.flatImage + (self.flatImage == 0) * 1)
-        self.cmd.diag(
-            'text=%s' % qstr('After flattening: image range: %g to %g' %
-                             (image.min(), image.max())))
+        with self.timer.stage('flat'):
+            if flatFileName != self.currentFlatName:
+                try:
+                    self.analyzeFlat(flatFileName, gprobes)
+                except GuiderExceptions.FlatError as e:
+                    # e.g.: no fibers could be found in the flat
+                    self.cmd.warn('text=%s' % qstr('Error processsing flat!'))
+                    raise e
+            product = self.getCalibrationProduct(darkFileName, flatFileName, exptime)
+        # This frame's measurements go in a copy of the flat's fibers.
+        fibers = self.flatFibers.take(~self.flatFibers.fake())
 
-        # NOTE: jkp: post-flat fielding, we need to re-check for saturated pixels and remask them
-        sat_flat = (image.astype(int) >= self.saturationLevel)
-        image[sat_flat] = self.saturationReplacement
-        mask[sat_flat] |= GuiderImageAnalysis.mask_saturated
-
-        # Save the processed image
-        self.guiderImage = image / 2.0  # PH***quick Kluge needs to be corrected
         self.guiderHeader = hdr
-        self.maskImage = mask
-
-        # TBD: once we've converted to use PyGuide, we can get rid of these kludges!
-
-        # Prepare image for Gunn C code PSF fitting in "gfindstars"...
-        # PH..Kluge to conserve full dynamic range, scale image to fit into signed int in C code.
-        # Have to scale up the outputs.
-        img = image[:] / 2.0  #
-
-        # Zero out parts of the image that are masked out.
-        # In this mask convention, 0 = good, >0 is bad.
-        # Mark negative pixels
-        badpixels = (img < 0) & (mask == 0)
-        mask[badpixels] |= GuiderImageAnalysis.mask_badpixels
-        # Blank out masked pixels.
-        img[mask > 0] = 0
+        if sparse:
+            self.guiderImage = None
+            self.maskImage = None
+            img16 = self._calibrate_fiber_pixels(product)
+        else:
+            mask = self._calibrate(image, sat, product)
 
         if self.camera == 'ecamera':
             # mask the overscan too, since we're keeping it around for monitoring.
@@ -873,56 +1026,214 @@ class GuiderImageAnalysis(object):
                     shape.bkgnd, shape.ampl))
             return []  # no fibers to return
         else:
-            # The "img16" object must live until after gfindstars() !
-            img16 = img.astype(np.int16)
-            c_image = np_array_to_REGION(img16)
-
-            goodfibers = [f for f in fibers if not f.is_fake()]
-            c_fibers = self.libguide.fiberdata_new(len(goodfibers))
-
-            for i, f in enumerate(goodfibers):
-                c_fibers[0].g_fid[i] = f.fiberid
-                c_fibers[0].g_xcen[i] = f.xcen
-                c_fibers[0].g_ycen[i] = f.ycen
-                c_fibers[0].g_fibrad[i] = f.radius
-                # FIXME ??
-                c_fibers[0].g_illrad[i] = f.radius
-            # TBD: FIXME --
-            # c_fibers.readnoise = ...
-
-            # mode=1: data frame; 0=spot frame
-            mode = 1
-            res = self.libguide.gfindstars(
-                ctypes.byref(c_image), c_fibers, mode)
-            # SH_SUCCESS is this following nutty number...
-            if np.uint32(res) == np.uint32(0x8001c009):
-                self.cmd.diag(
-                    'text=%s' % qstr('gfindstars returned successfully.'))
-            else:
-                self.cmd.warn('text=%s' % qstr(
-                    'gfindstars() returned an error code: %08x (%08x; success=%08x)'
-                    % (res, np.uint32(res), np.uint32(0x8001c009))))
-
-            # pull star positions out of c_fibers, stuff outputs...
-            for i, f in enumerate(goodfibers):
-                f.xs = c_fibers[0].g_xs[i]
-                f.ys = c_fibers[0].g_ys[i]
-                f.xyserr = c_fibers[0].poserr[i]
-                fwhm = c_fibers[0].fwhm[i]
-                if fwhm != FWHM_BAD:
-                    f.fwhm = self.pixels2arcsec(fwhm)
+            with self.timer.stage('gfindstars'):
+                if not sparse:
+                    # The "img16" object must live until after gfindstars() !
+                    # Blank out masked pixels.
+                    img16 = self._buffer('img16', image.shape, np.int16)
+                    np.copyto(img16, self.guiderImage, casting='unsafe')
+                    masked = self._buffer('masked', image.shape, np.bool_)
+                    np.copyto(img16, 0, where=np.not_equal(mask, 0, out=masked))
+
+                fiberData = self._get_fiber_data(fibers)
+
+                self._find_stars(self.starFinder, img16, fiberData)
+
+                # pull star positions out of fiberData, stuff outputs...
+                data = fibers.data
+                data['xs'] = fiberData.xs
+                data['ys'] = fiberData.ys
+                data['xyserr'] = fiberData.poserr
+                found = fiberData.fwhm != FWHM_BAD
+                data['fwhm'][found] = self.pixels2arcsec(fiberData.fwhm[found])
                 # else leave fwhm = nan.
                 # TBD: FIXME -- figure out good units -- mag/(pix^2)?
-                f.sky = (c_fibers[0].sky[i]) * 2.0  # correct for image div by 2 for Ggcode
-                f.flux = (c_fibers[0].flux[i]) * 2.0
-                if f.flux > 0:
-                    f.mag = self.flux2mag(f.flux, exptime)
-                # else leave f.mag = nan.
-            self.libguide.fiberdata_free(c_fibers)
-
+                data['sky'] = fiberData.sky * 2.0  # correct for image div by 2 for Ggcode
+                data['flux'] = fiberData.flux * 2.0
+                with np.errstate(invalid='ignore'):
+                    bright = data['flux'] > 0
+                data['mag'][bright] = self.flux2mag(data['flux'][bright], exptime)
+                # else leave mag = nan.
+
+            if self.starFinderShadow:
+                self._compare_star_finders(img16, fiberData)
             self.fibers = fibers
             return fibers
 
+    def _find_stars(self, finder, img16, fiberData):
+        """Find the stars in img16 with finder, filling in fiberData's outputs."""
+        if finder == STAR_FINDER_NUMPY:
+            starFinder.find_stars(img16, fiberData)
+            return
+        # mode=1: data frame; 0=spot frame
+        mode = 1
+        res = guideLib.find_stars(img16, fiberData, mode)
+        if np.uint32(res) == np.uint32(SH_SUCCESS):
+            self.cmd.diag(
+                'text=%s' % qstr('gfindstars returned successfully.'))
+        else:
+            self.cmd.warn('text=%s' % qstr(
+                'gfindstars() returned an error code: %08x (%08x; success=%08x)'
+                % (res, np.uint32(res), np.uint32(SH_SUCCESS))))
+
+    def _compare_star_finders(self, img16, fiberData):
+        """
+        Run the star finder we aren't guiding with on img16, and report how
+        its results for each fiber differ from fiberData's (other - ours):
+        the star position and FWHM in pixels, and the ratio of the fluxes.
+        """
+        other = STAR_FINDER_NUMPY if self.starFinder != STAR_FINDER_NUMPY \
+            else STAR_FINDER_GFINDSTARS
+        shadow = fiberData.copy()
+        self._find_stars(other, img16, shadow)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fluxRatio = shadow.flux / fiberData.flux
+        diffs = ['%d:%.3f,%.3f,%.3f,%.3f' % (fiberid, shadow.xs[i] - fiberData.xs[i],
+                                             shadow.ys[i] - fiberData.ys[i],
+                                             shadow.fwhm[i] - fiberData.fwhm[i], fluxRatio[i])
+                 for i, fiberid in enumerate(fiberData.fiberid)]
+        self.cmd.diag('text=%s' % qstr(
+            'frame %s: %s - %s star finder (fiber:dx,dy,dfwhm,flux ratio): %s' %
+            (self.frameNo, other, self.starFinder, ' '.join(diffs))))
+
+    def _get_fiber_data(self, fibers):
+        """
+        Return the guideLib.FiberData for gfindstars on these fibers (a
+        FiberTable), making a new one only when they differ from the last
+        ones (i.e. a new flat).
+        """
+        data = fibers.data
+        key = tuple(data[name].tostring() for name in ('fiberid', 'xcen', 'ycen', 'radius'))
+        if self._fiberData is None or self._fiberData[0] != key:
+            # FIXME ?? the illuminated radius is the fiber radius.
+            fiberData = guideLib.FiberData(data['fiberid'], data['xcen'], data['ycen'],
+                                           data['radius'], data['radius'])
+            self._fiberData = (key, fiberData)
+        return self._fiberData[1]
+
+    def _calibrate(self, image, sat, product):
+        """
+        Dark subtract, flatfield and mask the bias-subtracted image in place,
+        given its pre-bias saturated pixels sat. Sets self.guiderImage and
+        self.maskImage, and returns the mask.
+        """
+        # Dark subtract and divide by the flat, in place.
+        with self.timer.stage('dark'):
+            product.subtract_dark(image)
+        with self.timer.stage('flat'):
+            product.divide_flat(image)
+            return self._mask_calibrated(image, sat, product)
+
+    def _mask_calibrated(self, image, sat, product):
+        """
+        The rest of _calibrate(), once the image is flatfielded: mask the
+        saturated and negative pixels and make guiderImage.
+        """
+        # mask the saturated pixels with the appropriate value.
+        mask = self._buffer('mask', image.shape, product.mask.dtype)
+        mask[...] = product.mask
+        np.bitwise_or(mask, GuiderImageAnalysis.mask_saturated, out=mask, where=sat)
+        self.cmd.diag(
+            'text=%s' % qstr('After flattening: image range: %g to %g' %
+                             (image.min(), image.max())))
+
+        # NOTE: jkp: post-flat fielding, we need to re-check for saturated pixels and remask them
+        # (sat is done with, so reuse it for this)
+        sat_flat = np.greater_equal(image, self.saturationLevel, out=sat)
+        np.copyto(image, self.saturationReplacement, where=sat_flat)
+        np.bitwise_or(mask, GuiderImageAnalysis.mask_saturated, out=mask, where=sat_flat)
+
+        # Save the processed image
+        # PH***quick Kluge needs to be corrected
+        self.guiderImage = np.multiply(image, 0.5, out=self._buffer('half', image.shape, image.dtype))
+        self.maskImage = mask
+
+        # TBD: once we've converted to use PyGuide, we can get rid of these kludges!
+
+        # Prepare image for Gunn C code PSF fitting in "gfindstars"...
+        # PH..Kluge to conserve full dynamic range, scale image to fit into signed int in C code.
+        # Have to scale up the outputs.
+        # The int16 image is the halved image, so it's made from guiderImage.
+
+        # Zero out parts of the image that are masked out.
+        # In this mask convention, 0 = good, >0 is bad.
+        # Mark negative pixels
+        badpixels = np.less(self.guiderImage, 0, out=sat)
+        masked = np.not_equal(mask, 0, out=self._buffer('masked', image.shape, np.bool_))
+        np.logical_and(badpixels, np.logical_not(masked, out=masked), out=badpixels)
+        np.bitwise_or(mask, GuiderImageAnalysis.mask_badpixels, out=mask, where=badpixels)
+        return mask
+
+    def _calibrate_fiber_pixels(self, product):
+        """
+        Sparse version of _pre_process and _calibrate: bias subtract, dark
+        subtract, flatfield and mask only the unmasked pixels of product (those
+        inside the fibers), and return the int16 image for gfindstars, which is
+        zero everywhere else, exactly as when the whole frame is calibrated.
+        The saturation check only counts pixels inside the fibers.
+        """
+        self.ensureLibraryLoaded()
+        raw = self.frame.image
+        roi, roiDark, roiInvFlat = product.get_roi()
+
+        values = self._buffer('roi', roi.shape, np.float32)
+        sat = self._buffer('roiSat', roi.shape, np.bool_)
+        mask = self._buffer('roiMask', roi.shape, np.uint8)
+        with self.timer.stage('bias'):
+            values[...] = raw.ravel()[roi]
+            np.greater_equal(values, self.saturationLevel, out=sat)
+            nSat = np.count_nonzero(sat)
+
+            # The bias comes from the overscan, so needs the whole raw frame.
+            self.find_bias_level(raw, binning=self.binning)
+            self.cmd.diag('text=%s' % qstr('subtracting bias level: %g' % self.imageBias))
+            self._check_read(nSat)
+            values -= self.imageBias
+            np.copyto(values, self.saturationReplacement, where=sat)
+
+        # (the dark subtraction of these few pixels is timed with the flat)
+        with self.timer.stage('flat'):
+            product.apply_roi(values)
+        # These are all unmasked in the flat.
+        mask[...] = 0
+        np.bitwise_or(mask, GuiderImageAnalysis.mask_saturated, out=mask, where=sat)
+        self.cmd.diag(
+            'text=%s' % qstr('After flattening: fiber pixel range: %g to %g' %
+                             (values.min(), values.max())))
+
+        np.greater_equal(values, self.saturationLevel, out=sat)
+        np.copyto(values, self.saturationReplacement, where=sat)
+        np.bitwise_or(mask, GuiderImageAnalysis.mask_saturated, out=mask, where=sat)
+
+        # halve, as for guiderImage, and mark the negative pixels.
+        values *= 0.5
+        badpixels = np.less(values, 0, out=sat)
+        np.logical_and(badpixels, mask == 0, out=badpixels)
+        np.bitwise_or(mask, GuiderImageAnalysis.mask_badpixels, out=mask, where=badpixels)
+
+        roi16 = self._buffer('roi16', roi.shape, np.int16)
+        np.copyto(roi16, values, casting='unsafe')
+        np.copyto(roi16, 0, where=mask != 0)
+        img16 = self._buffer('img16', raw.shape, np.int16)
+        img16.fill(0)
+        img16.ravel()[roi] = roi16
+        return img16
+
+    def getFullImage(self):
+        """
+        Return the processed (guiderImage, maskImage) for the current frame,
+        calibrating the whole frame first if findStars() only did the fibers.
+        """
+        if self.guiderImage is None:
+            image = self._buffer('image', self.frame.image.shape, np.float32)
+            sat = self._buffer('sat', self.frame.image.shape, np.bool_)
+            image[...] = self.frame.image
+            np.greater_equal(image, self.saturationLevel, out=sat)
+            image -= self.imageBias
+            np.copyto(image, self.saturationReplacement, where=sat)
+            self._calibrate(image, sat, self.calibProduct)
+        return self.guiderImage, self.maskImage
+
     def applyBias(self, image, binning):
         """Apply a bias correction to the image, and return the image and bias level."""
         self.find_bias_level(image, binning=binning)
@@ -931,34 +1242,44 @@ class GuiderImageAnalysis(object):
         image -= self.imageBias
         return image
 
-    def applyDark(self, image, darkFileName, exptime):
-        """Dark subtract the current image, and return the result"""
+    def loadDark(self, darkFileName):
+        """Make darkFileName the current processed dark, unless we are bypassing darks."""
         # Create and process the dark image if this is the
         # first time through, or a new dark exposure
         self.cmd.diag('text=%s' % qstr('Using dark image: %s' % darkFileName))
-        if darkFileName != self.currentDarkName and not self.bypassDark:
+        if self.bypassDark:
+            self.cmd.inform('text=%s' % qstr('Bypassing dark subtraction.'))
+        elif darkFileName != self.currentDarkName:
             self.analyzeDark(darkFileName)
 
-        # scale and subtract the dark
-        if not self.bypassDark:
-            image -= self.processedDark * exptime
-        else:
-            self.cmd.inform('text=%s' % qstr('Bypassing dark subtraction.'))
-        return image
+    def getCalibrationProduct(self, darkFileName, flatFileName, exptime):
+        """
+        Return the CalibrationProduct for the current processed dark and flat
+        at this exposure time, only building a new one if we haven't used this
+        combination recently.
+        """
+        dark = None if self.bypassDark else self.processedDark
+        key = (None if self.bypassDark else darkFileName, flatFileName, exptime, self.binning)
+        self.calibProduct = self.calibProducts.get(key, dark, self.flatImage,
+                                                   self.flatMask, exptime)
+        return self.calibProduct
 
     def readProcessedFlat(self, flatFileName, gprobes):
         """
         Read processed flatFileName and return (flat, mask, fibers).
-        NOTE, returns a list of fibers the same length as 'gprobes';
-        some will have xcen=ycen=NaN; test with fiber.is_fake()
+        NOTE, returns a FiberTable the same length as 'gprobes';
+        some will have xcen=ycen=NaN; test with fiber.is_fake() or fibers.fake()
         """
-        flatfits = pyfits.open(flatFileName)
+        return self._get_processed_flat(pyfits.open(flatFileName), gprobes)
+
+    def _get_processed_flat(self, flatfits, gprobes):
+        """Return (flat, mask, fibers) from a processed flat HDUList: see readProcessedFlat()."""
         flat = flatfits[0].data
         if self.camera == 'ecamera':
             # TBD: eventually we'll actually compute a mask for the ecam flats
             # for now, just assume all pixels are good.
             mask = np.zeros_like(flat, np.uint8)
-            return flat, mask, []
+            return flat, mask, FiberTable()
 
         mask = flatfits[1].data
         table = flatfits[6].data
@@ -966,12 +1287,9 @@ class GuiderImageAnalysis(object):
         y = table.field('ycenter')
         radius = table.field('radius')
         fiberid = table.field('fiberid')
-        fibers = []
+        fibers = FiberTable()
         if gprobes is not None:
-            for xi, yi, ri, fi in zip(x, y, radius, fiberid):
-                f = Fiber(fi, xi, yi, ri, 0)
-                f.gProbe = gprobes.get(fi)
-                fibers.append(f)
+            fibers = FiberTable.from_columns(fiberid, x, y, radius, 0, gprobes=gprobes)
 
         return (flat, mask, fibers)
 
@@ -992,11 +1310,20 @@ class GuiderImageAnalysis(object):
             self.setPoint = setPoint
 
         darkout = self.getProcessedOutputName(darkFileName)
+        cached = self.calibCache.get(darkout)
+        if cached is not None:
+            self.cmd.diag('text=%s' % qstr(
+                'Using cached processed dark-field from %s' % darkout))
+            self.processedDark, self.darkTemperature = cached
+            self.currentDarkName = darkFileName
+            return
         if os.path.exists(darkout):
             self.cmd.inform('text=%s' % qstr(
                 'Reading processed dark-field from %s' % darkout))
             try:
                 self.processedDark = self.readProcessedDark(darkout)
+                self.currentDarkName = darkFileName
+                self.calibCache.put(darkout, (self.processedDark, self.darkTemperature))
                 return
             except Exception:
                 self.cmd.warn('text=%s' % qstr(
@@ -1049,15 +1376,13 @@ class GuiderImageAnalysis(object):
         hdr.update('EXPTIME', 1.,
                    'dark scaled to 1 second equivalent exposure.')
 
-        # Write the dark image
-        directory, filename = os.path.split(darkout)
-        hdu = pyfits.PrimaryHDU(image, hdr)
-        actorFits.writeFits(
-            cmd, hdu, directory, filename, doCompress=True, chmod=0644)
-
         self.processedDark = image
         self.currentDarkName = darkFileName
 
+        # Write the dark image
+        self._write_calibration(pyfits.HDUList([pyfits.PrimaryHDU(image, hdr)]), darkout,
+                                (self.processedDark, self.darkTemperature))
+
     def _find_fibers_in_flat(self, image, flatFileName, gprobes, hdr):
         """Identify the fibers in a flat image."""
         # TBD: FIXME -- we KNOW the area (ie, the number of pixels) of the
@@ -1065,16 +1390,17 @@ class GuiderImageAnalysis(object):
         # NOTE, that's not always true, we sometimes lose fibers, even
         # acquisition fibers which are pretty big.
 
-        # HACK -- find threshold level inefficiently.
         # This is the threshold level that was used in "gfindfibers".
+        # Partition a copy, since we only need two order statistics.
         i2 = image.copy().ravel()
-        II = np.argsort(i2)
+        kmed, kpk = len(i2) / 2, int(len(i2) * 0.998)
+        i2.partition((kmed, kpk))
         # median
-        med = i2[II[len(II) / 2]]
-        # pk == 99th percentile
-        # pk = i2[I[int(len(II)*0.99)]]
-        pk = i2[II[int(len(II) * 0.998)]]
-        # pk = i2[I[int(len(I)*0.998)]]  # change percentile based on N big fibers, N small fibers
+        med = i2[kmed]
+        # pk == 99.8th percentile
+        # pk = i2[int(len(i2)*0.99)]
+        pk = i2[kpk]
+        # change the percentile based on N big fibers, N small fibers?
         thresh = (med + pk) / 2.
 
         # Threshold image
@@ -1098,21 +1424,17 @@ class GuiderImageAnalysis(object):
         # Label connected components.
         (fiber_labels, nlabels) = label(T)
 
-        # TBD: FIXME -- the following could be made a bit quicker by using:
-        #    objs = find_objects(fiber_albels, nlabels)
-        # ==> "objs" is a list of (slice-rows, slice-cols)
-
         BIN = self.binning
 
+        # Measure all the components in one pass over the labels.
+        index = np.arange(1, nlabels + 1)
+        allNpix = np.bincount(fiber_labels.ravel(), minlength=nlabels + 1)[1:]
+        centers = center_of_mass(T, fiber_labels, index)
+
         fibers = []
         self.cmd.diag('text=%s' % qstr('%d components' % (nlabels)))
-        for i in range(1, nlabels + 1):
-            # find pixels labelled as belonging to object i.
-            obji = (fiber_labels == i)
-            # ri,ci = nonzero(obji)
-            npix = obji.sum()
+        for i, npix, (yc, xc) in zip(index, allNpix, centers):
             # center_of_mass returns row,column... swap to x,y
-            (yc, xc) = center_of_mass(obji)
             # x,y,radius / BIN because the flat is unbinned pixels, but we want
             # to report in binned pixels.
             # The 0.25 pixel offset makes these centroids agree with gfindstar's
@@ -1153,71 +1475,28 @@ class GuiderImageAnalysis(object):
                 'text=%s' % qstr('Failed to find any fibers in guider flat!'))
             raise GuiderExceptions.NoFibersFoundError
 
-        # Find a single x,y offset by testing possibly corresponding
-        # pairs of fibers/probes and checking how many fibers are
-        # where you expect them to be.
-        maxhits = 0
-        best = None
-        FX = np.array([f.xcen for f in fibers])
-        FY = np.array([f.ycen for f in fibers])
-        PX = np.array([p.xCenter for p in gprobes.values()])
-        PY = np.array([p.yCenter for p in gprobes.values()])
+        # Find the single x,y offset of the fibers from the probe positions
+        # that puts the most fibers where we expect them, starting from this
+        # cartridge's last flat, and match the fibers to the probes.
+        cartridge = hdr.get('FLATCART', None)
+        probeids = list(gprobes.keys())
+        fiberXY = np.array([(f.xcen, f.ycen) for f in fibers])
+        fiberRadius = np.array([f.radius for f in fibers])
+        probeXY = np.array([(gprobes[k].xCenter, gprobes[k].yCenter) for k in probeids])
         (H, W) = image.shape
-        for i, f in enumerate(fibers):
-            for j, (px, py) in enumerate(zip(PX, PY)):
-                dx, dy = f.xcen - px, f.ycen - py
-                # If this (dx,dy) would put some of the expected probes outside the image, skip it.
-                if (min(PX + dx) < 0 or min(PY + dy) < 0 or
-                        max(PX + dx) > W / BIN or max(PY + dy) > H / BIN):
-                    continue
-                # Look for matches...
-                fmatch = []
-                for k, pp in gprobes.items():
-                    # Find the distance from this probe to each fiber...
-                    D = np.sqrt(((pp.yCenter + dy) - FY)**2 + ((pp.xCenter + dx) - FX)**2)
-                    a = np.argmin(D)
-                    # If the nearest one is within range...
-                    if D[a] < fibers[a].radius:
-                        # Fiber "a" is probe id "k".
-                        # Compute the dx,dy implied by this match...
-                        mydx = FX[a] - (pp.xCenter + dx)
-                        mydy = FY[a] - (pp.yCenter + dy)
-                        fmatch.append((a, k, mydx, mydy))
-
-                nhits = len(fmatch)
-                if nhits > maxhits:
-                    # FIXME -- check for conflicts in 'fmatch' here?
-                    maxhits = nhits
-                    best = fmatch
-                if nhits == len(gprobes):
-                    break
-
-        if best is None:
+        result = match_fibers(fiberXY, fiberRadius, probeXY, W / BIN, H / BIN,
+                              prior=self.flatOffsets.get(cartridge))
+
+        if result is None:
             # How can this happen?  No fibers or no probes...
             self.cmd.warn(
                 'text=%s' %
                 qstr("This can't happen?  No matched fibers/probes."))
             raise GuiderExceptions.FlatError
 
-        fmatch = best
-        # Check for duplicates...
-        fmap = {}
-        finvmap = {}
-        for fi, probei, dx, dy in fmatch:
-            if fi in fmap:
-                self.cmd.warn('text=%s' % qstr(
-                    'Fiber %i wants to match to probe %i and %i.' %
-                    (fi, fmap[fi], probei)))
-                continue
-            if probei in fmap.values():
-                self.cmd.warn('text=%s' % qstr(
-                    'Fiber %i wants to be matched to already-matched probe %i.'
-                    % (fi, probei)))
-                continue
-            fmap[fi] = probei
-            finvmap[int(probei)] = fi
-        dx = np.mean([x for fi, probei, x, y in fmatch])
-        dy = np.mean([y for fi, probei, x, y in fmatch])
+        dx, dy, matches = result
+        self.flatOffsets[cartridge] = (dx, dy)
+        fmap = dict((int(fi), probeids[pi]) for fi, pi in matches)
         self.cmd.inform(
             'text=%s' % qstr('Matched %i fibers, with dx,dy = (%g,%g)' %
                              (len(fmap), dx, dy)))
@@ -1250,7 +1529,6 @@ class GuiderImageAnalysis(object):
         # Create the processed flat image.
         # NOTE: jkp: using float32 to keep the fits header happier.
         flat = np.zeros_like(image).astype(np.float32)
-        all_median = np.empty(len(fibers), dtype=np.float32)
 
         # TBD: Paul Harding
         # For consistent mags of the guide stars independent of cartridges or fibers
@@ -1263,18 +1541,18 @@ class GuiderImageAnalysis(object):
 
         # PH to be strictly correct we should use a local bkg around the fiber
 
-        # find the median of each fiber
-        # have to enumerate, because we could be missing fibers,
-        for i, fiber in enumerate(fibers):
-            obji = (fiber_labels == fiber.label
-                    )  # find pixels belonging to object i.
-            objflat = (image[obji] - background)  # should calc a local bkg here using ring mask
-            flat[obji] += objflat
-            # Do not use acquisition fibers, which have higher throughput than guide fibers.
-            if fiber.gProbe.fiber_type != 'GUIDE':
-                continue
-            # so can't use fiberid as an index.
-            all_median[i] = np.median(objflat)
+        # find the pixels belonging to the matched fibers.
+        matched = np.zeros(nlabels + 1, dtype=bool)
+        matched[[f.label for f in fibers]] = True
+        inFibers = matched[fiber_labels]
+        # should calc a local bkg here using ring mask
+        flat[inFibers] = image[inFibers] - background
+
+        # find the median of each fiber.
+        # Do not use acquisition fibers, which have higher throughput than guide fibers,
+        # unless there are no guide fibers.
+        guideLabels = [f.label for f in fibers if f.gProbe.fiber_type == 'GUIDE']
+        all_median = label_median(flat, fiber_labels, guideLabels or [f.label for f in fibers])
 
         flatscale = np.median(all_median)
         flat /= flatscale
@@ -1343,19 +1621,31 @@ class GuiderImageAnalysis(object):
             self.cmd = cmd
         if setPoint is not None:
             self.setPoint = setPoint
+        self._stampRemaps = {}
 
         flatout = self.getProcessedOutputName(flatFileName)
         if self.camera == 'ecamera':
             # TBD: kludge, since we don't gzip unprocessed ecam files, because IRAF.
             flatout = flatout + '.gz'
-        directory, filename = os.path.split(flatout)
 
+        cached = self.calibCache.get(flatout)
+        if cached is not None:
+            self.cmd.diag('text=%s' % qstr(
+                'Using cached processed flat-field from %s' % flatout))
+            self.flatImage, self.flatMask, self.flatFibers = cached
+            # The cached fibers may predate the currently loaded gprobes.
+            if gprobes is not None:
+                self.flatFibers.gprobes = [gprobes.get(fid) for fid in self.flatFibers.data['fiberid']]
+            self.currentFlatName = flatFileName
+            return
         if os.path.exists(flatout):
             self.cmd.inform('text=%s' % qstr(
                 'Reading processed flat-field from %s' % flatout))
             try:
                 self.flatImage, self.flatMask, self.flatFibers = self.readProcessedFlat(
                     flatout, gprobes)
+                self.currentFlatName = flatFileName
+                self.calibCache.put(flatout, (self.flatImage, self.flatMask, self.flatFibers))
                 return
             except Exception:
                 self.cmd.warn('text=%s' % qstr(
@@ -1375,9 +1665,9 @@ class GuiderImageAnalysis(object):
             hdulist = self._process_ecam_flat(image, flatFileName, hdr)
             gprobes = None
 
-        actorFits.writeFits(
-            cmd, hdulist, directory, filename, doCompress=True, chmod=0644)
-        # Now read that file we just wrote...
-        self.flatImage, self.flatMask, self.flatFibers = self.readProcessedFlat(
-            flatout, gprobes)
+        # Use the processed flat as it will be read back from the file we write.
+        self.flatImage, self.flatMask, self.flatFibers = self._get_processed_flat(
+            hdulist, gprobes)
         self.currentFlatName = flatFileName
+        self._write_calibration(hdulist, flatout,
+                                (self.flatImage, self.flatMask, self.flatFibers))
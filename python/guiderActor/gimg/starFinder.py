@@ -0,0 +1,161 @@
+"""
+Find the stars in all the fibers of a guider frame at once, with numpy.
+
+An alternative to libguide's gfindstars(), which walks a double-Gaussian
+profile fit to each fiber in turn: here every fiber is cut out into one
+(nFiber, size, size) array of stamps, and the sky, centroid, width and flux
+of all of them are measured together with Gaussian-weighted (adaptive)
+moments. Set starFinder = numpy in [general] to guide with it, or
+starFinderShadow = True to run it alongside gfindstars (or vice versa) and
+log how they differ.
+
+find_stars() takes the same int16 image (0 = masked) and fills in the same
+guideLib.FiberData outputs, in the same units, as guideLib.find_stars(), so
+the two can be swapped and compared like for like.
+"""
+
+import numpy as np
+from scipy.ndimage.filters import gaussian_filter
+
+from guideLib import FWHM_BAD
+
+# Must match ipGguide.h
+CCDGAIN = 1.4
+
+# sigma (pixels) of the first guess at the star, and of the filter used to find its peak.
+SIGMA_GUESS = 1.5
+# number of iterations of the adaptive moments.
+N_ITER = 10
+# pixels further than this many sigma from the star are used to refine the sky.
+SKY_NSIGMA = 3.
+SKY_MIN_PIXELS = 20
+
+FWHM_PER_SIGMA = 2 * np.sqrt(2 * np.log(2))
+
+
+def cut_stamps(image, good, xcen, ycen, r):
+    """
+    Return (stamps, good, x, y) for (2r+1)x(2r+1) pixel stamps of image
+    centred on the pixels nearest each xcen, ycen: stamps and good are
+    (nFiber, 2r+1, 2r+1) arrays of the pixel values and whether they are
+    usable (good, and inside the image); x and y are the pixel coordinates
+    of the stamps' columns (nFiber, 1, 2r+1) and rows (nFiber, 2r+1, 1).
+    """
+    height, width = image.shape
+    offsets = np.arange(-r, r + 1)
+    cols = (xcen + 0.5).astype(int)[:, np.newaxis] + offsets
+    rows = (ycen + 0.5).astype(int)[:, np.newaxis] + offsets
+    inside = (((rows >= 0) & (rows < height))[:, :, np.newaxis] &
+              ((cols >= 0) & (cols < width))[:, np.newaxis, :])
+    rowIndex = rows.clip(0, height - 1)[:, :, np.newaxis]
+    colIndex = cols.clip(0, width - 1)[:, np.newaxis, :]
+    stamps = image[rowIndex, colIndex].astype(np.float64)
+    good = good[rowIndex, colIndex] & inside
+    return stamps, good, cols[:, np.newaxis, :], rows[:, :, np.newaxis]
+
+
+def masked_median(values, mask, default=0.):
+    """The median of values where mask, over all but the first axis (default where there are none)."""
+    with np.errstate(invalid='ignore'):
+        flat = np.where(mask, values, np.nan).reshape(len(values), -1)
+        # sort the nans to the end, and take the middle of the rest.
+        flat.sort(axis=1)
+        count = mask.reshape(len(mask), -1).sum(axis=1)
+        rows = np.arange(len(values))
+        low = flat[rows, np.maximum((count - 1) // 2, 0)]
+        high = flat[rows, np.maximum(count // 2, 0)]
+        return np.where(count > 0, 0.5 * (low + high), default)
+
+
+def find_stars(image, fiberData, good=None, readnoise=0.):
+    """
+    Find the star in each fiber of fiberData (a guideLib.FiberData) in the
+    int16 image, and fill in fiberData's outputs as gfindstars() does:
+    xs, ys (pixels), flux (DN), sky (DN/pixel), fwhm (pixels, or FWHM_BAD if
+    the star is off the fiber or there's no star) and poserr (pixels).
+
+    good is a boolean image of the pixels to use: by default, the non-zero
+    ones, since gfindstars is handed images with the masked pixels zeroed.
+    readnoise is in DN, as in FIBERDATA.
+    """
+    n = len(fiberData)
+    if n == 0:
+        return
+    if good is None:
+        good = image != 0
+    xcen = fiberData.xcen
+    ycen = fiberData.ycen
+    fibrad = fiberData.fibrad
+    illrad = fiberData.illrad
+    r = int(np.ceil(fibrad.max()))
+    stamps, good, x, y = cut_stamps(image, good, xcen, ycen, r)
+
+    # (nFiber, 1, 1) views of the per-fiber values, to broadcast against the stamps.
+    def each(values):
+        return values[:, np.newaxis, np.newaxis]
+
+    r2 = (x - each(xcen))**2 + (y - each(ycen))**2
+    inFiber = good & (r2 <= each(fibrad)**2)
+    sky = masked_median(stamps, inFiber)
+    signal = np.where(inFiber, stamps - each(sky), 0.)
+
+    # The first guess is the peak of the smoothed stamp, at least 2 pixels
+    # inside the fiber, as in gfindstar.
+    smoothed = gaussian_filter(signal, (0, SIGMA_GUESS, SIGMA_GUESS), mode='constant')
+    smoothed[~(inFiber & (r2 <= each(np.maximum(fibrad - 2, 0))**2))] = -np.inf
+    peak = smoothed.reshape(n, -1).argmax(axis=1)
+    xs = x[:, 0, :][np.arange(n), peak % x.shape[2]].astype(np.float64)
+    ys = y[:, :, 0][np.arange(n), peak // x.shape[2]].astype(np.float64)
+
+    # Gaussian-weighted moments, with the weight's sigma iterated to match
+    # the star's: its centroid is then unbiased, its sigma the star's, and
+    # twice its weighted sum the star's total flux.
+    var = np.full(n, SIGMA_GUESS**2)
+    for i in range(N_ITER):
+        dx = x - each(xs)
+        dy = y - each(ys)
+        weighted = signal * np.exp(-(dx**2 + dy**2) / (2 * each(var)))
+        wsum = weighted.sum(axis=(1, 2))
+        ok = wsum > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mx = (weighted * dx).sum(axis=(1, 2)) / wsum
+            my = (weighted * dy).sum(axis=(1, 2)) / wsum
+            # half the radial second moment, about the new centre.
+            moment = ((weighted * (dx**2 + dy**2)).sum(axis=(1, 2)) / wsum - mx**2 - my**2) / 2
+        xs = np.where(ok, xs + mx, xs)
+        ys = np.where(ok, ys + my, ys)
+        var = np.where(ok, np.clip(2 * moment, 0.25, fibrad**2 / 4), var)
+
+        if i == 0:
+            # Refine the sky from the pixels well away from the star, if there are enough.
+            away = inFiber & ((x - each(xs))**2 + (y - each(ys))**2 > each(SKY_NSIGMA**2 * var))
+            enough = away.sum(axis=(1, 2)) >= SKY_MIN_PIXELS
+            sky = np.where(enough, masked_median(stamps, away), sky)
+            signal = np.where(inFiber, stamps - each(sky), 0.)
+
+    sigma = np.sqrt(var)
+    flux = 2 * wsum
+    found = flux > 0
+    fwhm = np.where(found, FWHM_PER_SIGMA * sigma, FWHM_BAD)
+
+    # The same error model as gfindstar: a Gaussian star, with the centroid
+    # error multiplied by 5 at the centre of the fiber, rising as r^6.
+    xoff = xs - xcen
+    yoff = ys - ycen
+    roff = np.hypot(xoff, yoff)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ampl = flux / (2 * np.pi * var)
+        pixnoise = readnoise**2 + ampl / CCDGAIN
+        pixnoise = np.where(pixnoise > 0, np.sqrt(np.maximum(pixnoise, 0)), 99.)
+        sigmax = pixnoise * sigma * 2 * np.sqrt(2 * np.pi) / flux
+        rsq = roff**2 / illrad**2
+        poserr = np.where((pixnoise == 99.) | ~found, 99.99, sigmax * 5 * (1 + 5 * rsq**3))
+
+    # a peak off the fiber's edge.
+    offFiber = roff > illrad
+    fiberData.xs[:] = xs
+    fiberData.ys[:] = ys
+    fiberData.sky[:] = sky
+    fiberData.flux[:] = np.where(found & ~offFiber, flux, 0.)
+    fiberData.fwhm[:] = np.where(offFiber, FWHM_BAD, fwhm)
+    fiberData.poserr[:] = poserr
@@ -16,16 +16,19 @@ import time
 
 import numpy
 import pyfits
-import scipy.interpolate
 
 import guiderActor.myGlobals
 import opscore.utility.tback as tback
 import opscore.utility.YPF as YPF
 import RO
 from gimg import GuiderExceptions
+from gimg.calibCache import CalibrationCache
+from gimg.guiderFrame import GuiderFrame
 from gimg.guiderImage import GuiderImageAnalysis
 from gimg.umeyama import umeyama
 from guiderActor import GCAMERA, MASTER, GuiderState, Msg
+from guiderActor.stageTimer import FrameTimer
+from guiderActor.writerThread import ProcFileWriter
 from opscore.utility.qstr import qstr
 
 
@@ -133,23 +136,39 @@ def scale_pid_with_alt(cmd, gState, actorState):
     gState.output_pid()
 
 
-def _check_fiber(fiber, gState, guideCmd):
-    """Check whether the current fiber should currently be enabled."""
-    # necessary?
-    if fiber.gProbe is None:
-        guideCmd.warn(
-            'text="Gprobe %d was not listed in plugmap info"' % fiber.fiberid)
-        return False
+def _probe_rows(fibers, rows, gState):
+    """The row in gState.gprobes of the probe of each of these rows of fibers, or -1 if none."""
+    return gState.gprobes.rows(fibers.data['fiberid'][rows])
+
 
+def _check_fibers(fibers, gState, guideCmd):
+    """Return which of fibers (a FiberTable) should currently be enabled."""
+    probes = gState.gprobes
+    probeRows = _probe_rows(fibers, slice(None), gState)
+    # necessary?
+    listed = probeRows >= 0
+    enabled = numpy.zeros(len(fibers), dtype=bool)
+    enabled[listed] = probes.enabled()[probeRows[listed]]
     # Center up on acquisition fibers only.
-    if gState.centerUp and fiber.gProbe.fiber_type != 'ACQUIRE':
-        guideCmd.diag(
-            'text="Gprobe %d is disabled during Center Up."' % fiber.fiberid)
-        return False
-    else:
-        if fiber.gProbe.disabled:
-            guideCmd.diag('text="Gprobe %d is not enabled."' % fiber.fiberid)
-        return fiber.gProbe.enabled
+    centerUpOnly = numpy.zeros(len(fibers), dtype=bool)
+    if gState.centerUp:
+        centerUpOnly[listed] = probes.data['fiber_type'][probeRows[listed]] != 'ACQUIRE'
+
+    for fiberid, isListed, isCenterUpOnly, isEnabled in zip(fibers.data['fiberid'], listed,
+                                                            centerUpOnly, enabled):
+        if not isListed:
+            guideCmd.warn('text="Gprobe %d was not listed in plugmap info"' % fiberid)
+        elif isCenterUpOnly:
+            guideCmd.diag('text="Gprobe %d is disabled during Center Up."' % fiberid)
+        elif not isEnabled:
+            guideCmd.diag('text="Gprobe %d is not enabled."' % fiberid)
+
+    return enabled & ~centerUpOnly
+
+
+def _check_fiber(fiber, gState, guideCmd):
+    """Check whether the current fiber should currently be enabled."""
+    return _check_fibers(fiber.table.take([fiber.row]), gState, guideCmd)[0]
 
 
 def prep_for_flat(cmd, gState, actorState):
@@ -194,127 +213,90 @@ def prep_for_flat(cmd, gState, actorState):
     return True
 
 
-def get_fiber_dra_ddec(fiber, gState, cmd, frameInfo, haLimWarn):
-    """Returns dRA and dDec for a given fibre.
+def _accumulate(total, values):
+    """
+    Return total plus each of values in turn, rounded just as a loop of
+    total += value would round it (numpy's sum() adds pairwise instead).
+    """
+    return numpy.add.accumulate(numpy.concatenate(([total], values)))[-1]
+
+
+def _square(values):
+    """values**2, computed as the scalar ** does (numpy squares arrays as x*x)."""
+    return numpy.power(values, 2)
+
+
+def get_fibers_dra_ddec(fibers, rows, gState, cmd, frameInfo):
+    """Computes dRA and dDec for the given rows of fibers (a FiberTable).
 
     - Derotates to sky.
     - Applies refraction correction.
     - Applies decentering.
 
+    Fills in the rows' dx, dy, dRA and dDec columns, and returns a boolean
+    array of which of them have a usable dRA, dDec. Sets their probes'
+    rotStar2Sky and tooFaint in gState.gprobes, which must have them all.
     """
 
-    gProbe = fiber.gProbe
+    rows = numpy.asarray(rows, dtype=int)
+    data = fibers.data
+    probes = gState.gprobes
+    probeRows = _probe_rows(fibers, rows, gState)
+    probeData = probes.data[probeRows]
 
     # dx, dy are the offsets on the ALTA guider image
-    fiber.dx = frameInfo.guideCameraScale * \
-        (fiber.xs - fiber.xcen) + (gProbe.xFerruleOffset / 1000.)
-    fiber.dy = frameInfo.guideCameraScale * \
-        (fiber.ys - fiber.ycen) + (gProbe.yFerruleOffset / 1000.)
-    poserr = fiber.xyserr
+    dx = frameInfo.guideCameraScale * \
+        (data['xs'][rows] - data['xcen'][rows]) + (probeData['xFerruleOffset'] / 1000.)
+    dy = frameInfo.guideCameraScale * \
+        (data['ys'][rows] - data['ycen'][rows]) + (probeData['yFerruleOffset'] / 1000.)
+    data['dx'][rows] = dx
+    data['dy'][rows] = dy
+    poserr = data['xyserr'][rows]
+    flux = data['flux'][rows]
 
     # theta is the angle to rotate (x, y) on the ALTA to (ra, alt)
     # phi is the orientation of the alignment hole measured clockwise from N
     # rotation is the anticlockwise rotation from x on the ALTA to the pin
+    philess = numpy.isnan(probeData['phi'])
     theta = 90  # allow for 90 deg rot of camera view, should be -90
-    theta += gProbe.rotation  # allow for intrinsic fibre rotation
-    try:
-        theta -= gProbe.phi  # allow for orientation of alignment hole
-    except Exception as e:
-        cmd.warn('text="skipping phi-less probe %s"' % (fiber.fiberid))
-        return
-
-    gProbe.rotStar2Sky = theta  # Squirrel the real angle away.
+    theta += probeData['rotation']  # allow for intrinsic fibre rotation
+    theta -= probeData['phi']
 
     # FIXME PH -- We should ignore gprobes not present on plate/pointing (MARVELS dual pointing)
     #             and ignore fibers not found in flat.
     #             However we probably want to record values of disabled fibers for diagnosis
-    if numpy.isnan(fiber.dx) or numpy.isnan(fiber.dy) or numpy.isnan(poserr):
-        cmd.warn('text=%s' %
-                 qstr('NaN in analysis for gprobe %d star=(%g, %g) fiber '
-                      'measured=(%g, %g), nominal=(%g,%g)' %
-                      (fiber.fiberid, fiber.xs, fiber.ys, fiber.xcen,
-                       fiber.ycen, gProbe.xCenter, gProbe.yCenter)))
-        return
+    bad = numpy.isnan(dx) | numpy.isnan(dy) | numpy.isnan(poserr)
+    with numpy.errstate(invalid='ignore'):
+        tooFaint = flux < frameInfo.minStarFlux
+    ok = ~philess & ~bad & (poserr != 0)
 
-    if fiber.flux < frameInfo.minStarFlux:
-        cmd.warn('text=%s' % qstr('Star in gprobe %d too faint for guiding '
-                                  'flux %g < %g minimum flux' %
-                                  (fiber.fiberid, fiber.flux,
-                                   frameInfo.minStarFlux)))
-        gProbe.tooFaint = True
-    else:
-        gProbe.tooFaint = False
+    probes.data['rotStar2Sky'][probeRows[~philess]] = theta[~philess]  # Squirrel the real angle away.
+    probes.set_bit(probeRows[~philess & ~bad], GuiderState.TOOFAINT, tooFaint[~philess & ~bad])
 
-    if poserr == 0:
-        cmd.warn(
-            'text=%s' % qstr('position error is 0 for gprobe %d star=(%g, %g) '
-                             'fiber=(%g, %g) nominal=(%g,%g)' %
-                             (fiber.fiberid, fiber.xs, fiber.ys, fiber.xcen,
-                              fiber.ycen, gProbe.xCenter, gProbe.yCenter)))
-        return
-
-    theta = math.radians(theta)
-    ct, st = math.cos(theta), math.sin(theta)
+    rad = numpy.radians(theta)
+    ct, st = numpy.cos(rad), numpy.sin(rad)
     # error in guide star position; n.b. still in mm here
-    dRA = fiber.dx * ct + fiber.dy * st
-    dDec = -fiber.dx * st + fiber.dy * ct
+    dRA = dx * ct + dy * st
+    dDec = -dx * st + dy * ct
     dDec *= -1
 
     # FIXME PH -- calc dAlt and dAz for guiding diagnostics,(output as part of fiber?)
 
-    # Apply refraction correction
-    xRefractCorr = 0.0
-    yRefractCorr = 0.0
-    haTime = 0.0
-    try:
-        if gState.refractionBalance > 0:
-
-            if frameInfo.wavelength in gProbe.haOffsetTimes:
-                haTimes = gProbe.haOffsetTimes[frameInfo.wavelength]
-                if frameInfo.dHA < haTimes[0]:
-                    if not haLimWarn:
-                        cmd.warn(
-                            'text="dHA (%0.1f) is below interpolation table; '
-                            'using limit (%0.1f)"' % (frameInfo.dHA,
-                                                      haTimes[0]))
-                        haLimWarn = True
-                    haTime = haTimes[0]
-                elif frameInfo.dHA > haTimes[-1]:
-                    if not haLimWarn:
-                        cmd.warn(
-                            'text="dHA (%0.1f) is above interpolation table; '
-                            'using limit (%0.1f)"' % (frameInfo.dHA,
-                                                      haTimes[-1]))
-                        haLimWarn = True
-                    haTime = haTimes[-1]
-                else:
-                    haTime = frameInfo.dHA
-
-                # I'm now assuming 0...offset, but it should be offset1...offset2
-                xInterp = scipy.interpolate.interp1d(
-                    haTimes, gProbe.haXOffsets[frameInfo.wavelength])
-                xRefractCorr = gState.refractionBalance * xInterp(haTime)
-                yInterp = scipy.interpolate.interp1d(
-                    haTimes, gProbe.haYOffsets[frameInfo.wavelength])
-                yRefractCorr = gState.refractionBalance * yInterp(haTime)
-            else:
-                # JKP: TODO: these warnings might be excessive?
-                cmd.warn(
-                    'text="No HA Offset Time available for probe %d at wavelength %d. '
-                    'No refraction offset calculated."' %
-                    (gProbe.id, frameInfo.wavelength))
-        else:
-            # Don't do anything if the refraction balance is 0.
-            pass
-    except Exception as e:
-        cmd.diag('text="failed to calc refraction offsets for %s: %s"' %
-                 (frameInfo.wavelength, e))
-        pass
-
-    cmd.inform('refractionOffset=%d,%d,%0.1f,%0.4f,%0.6f,%0.6f' %
-               (frameInfo.frameNo, fiber.fiberid, gState.refractionBalance,
-                haTime, xRefractCorr * frameInfo.arcsecPerMM,
-                yRefractCorr * frameInfo.arcsecPerMM))
+    # Apply refraction correction, from the tables made when the cartridge was loaded.
+    n = len(rows)
+    haTime = numpy.zeros(n)
+    xRefractCorr = numpy.zeros(n)
+    yRefractCorr = numpy.zeros(n)
+    noTable = numpy.zeros(n, dtype=bool)
+    # Don't do anything if the refraction balance is 0.
+    refract = gState.refractionBalance > 0
+    if refract:
+        use = numpy.flatnonzero(ok)
+        haTime[use], xOffset, yOffset, found = gState.refractionTable.interpolate(
+            frameInfo.wavelength, probeData['id'][use], frameInfo.dHA)
+        xRefractCorr[use] = gState.refractionBalance * xOffset
+        yRefractCorr[use] = gState.refractionBalance * yOffset
+        noTable[use] = ~found
 
     dRA -= xRefractCorr
     dDec -= yRefractCorr
@@ -327,17 +309,62 @@ def get_fiber_dra_ddec(fiber, gState, cmd, frameInfo, haLimWarn):
         dDec += gState.decenterDec / frameInfo.arcsecPerMM
         # decenterRot applied after guide solution
 
-    fiber.dRA = dRA
-    fiber.dDec = dDec
-
-    cmd.inform(
-        'probe=%d,%2d,0x%02x, %7.2f,%7.2f, %7.3f,%4.0f, %7.2f,%6.2f,%6.2f, %7.2f,%6.2f'
-        % (frameInfo.frameNo, fiber.fiberid, gProbe.gprobebits,
-           fiber.dRA * frameInfo.arcsecPerMM,
-           fiber.dDec * frameInfo.arcsecPerMM, fiber.fwhm, gProbe.focusOffset,
-           fiber.flux, fiber.mag, gProbe.ref_mag, fiber.sky, fiber.skymag))
-
-    return dRA, dDec
+    data['dRA'][rows[ok]] = dRA[ok]
+    data['dDec'][rows[ok]] = dDec[ok]
+
+    # Report on each fiber, in the order the checks above were made.
+    for k, i in enumerate(rows):
+        gProbe = GuiderState.GProbe.view(probes, probeRows[k])
+        fiber = fibers[i]
+        if philess[k]:
+            cmd.warn('text="skipping phi-less probe %s"' % (fiber.fiberid))
+            continue
+
+        if bad[k]:
+            cmd.warn('text=%s' %
+                     qstr('NaN in analysis for gprobe %d star=(%g, %g) fiber '
+                          'measured=(%g, %g), nominal=(%g,%g)' %
+                          (fiber.fiberid, fiber.xs, fiber.ys, fiber.xcen,
+                           fiber.ycen, gProbe.xCenter, gProbe.yCenter)))
+            continue
+
+        if tooFaint[k]:
+            cmd.warn('text=%s' % qstr('Star in gprobe %d too faint for guiding '
+                                      'flux %g < %g minimum flux' %
+                                      (fiber.fiberid, fiber.flux,
+                                       frameInfo.minStarFlux)))
+
+        if not ok[k]:
+            cmd.warn(
+                'text=%s' % qstr('position error is 0 for gprobe %d star=(%g, %g) '
+                                 'fiber=(%g, %g) nominal=(%g,%g)' %
+                                 (fiber.fiberid, fiber.xs, fiber.ys, fiber.xcen,
+                                  fiber.ycen, gProbe.xCenter, gProbe.yCenter)))
+            continue
+
+        if refract and noTable[k]:
+            # JKP: TODO: these warnings might be excessive?
+            cmd.warn('text="No HA Offset Time available for probe %d at wavelength %d. '
+                     'No refraction offset calculated."' % (gProbe.id, frameInfo.wavelength))
+        elif refract and frameInfo.dHA < haTime[k]:
+            cmd.warn('text="dHA (%0.1f) is below interpolation table; using limit (%0.1f)"' %
+                     (frameInfo.dHA, haTime[k]))
+        elif refract and frameInfo.dHA > haTime[k]:
+            cmd.warn('text="dHA (%0.1f) is above interpolation table; using limit (%0.1f)"' %
+                     (frameInfo.dHA, haTime[k]))
+        cmd.inform('refractionOffset=%d,%d,%0.1f,%0.4f,%0.6f,%0.6f' %
+                   (frameInfo.frameNo, fiber.fiberid, gState.refractionBalance,
+                    haTime[k], xRefractCorr[k] * frameInfo.arcsecPerMM,
+                    yRefractCorr[k] * frameInfo.arcsecPerMM))
+
+        cmd.inform(
+            'probe=%d,%2d,0x%02x, %7.2f,%7.2f, %7.3f,%4.0f, %7.2f,%6.2f,%6.2f, %7.2f,%6.2f'
+            % (frameInfo.frameNo, fiber.fiberid, gProbe.gprobebits,
+               fiber.dRA * frameInfo.arcsecPerMM,
+               fiber.dDec * frameInfo.arcsecPerMM, fiber.fwhm, gProbe.focusOffset,
+               fiber.flux, fiber.mag, gProbe.ref_mag, fiber.sky, fiber.skymag))
+
+    return ok
 
 
 def get_position_error(X, Y, trans, rot, scale):
@@ -345,11 +372,10 @@ def get_position_error(X, Y, trans, rot, scale):
 
     theta = numpy.deg2rad(rot)
 
-    rot_matrix = numpy.matrix([[numpy.cos(theta), -numpy.sin(theta)],
-                               [numpy.sin(theta),
-                                numpy.cos(theta)]])
+    rot_matrix = numpy.array([[numpy.cos(theta), -numpy.sin(theta)],
+                              [numpy.sin(theta), numpy.cos(theta)]])
 
-    rotated = numpy.array((scale * rot_matrix) * numpy.matrix(X).T)
+    rotated = (scale * rot_matrix).dot(numpy.asarray(X).T)
 
     pos_error = Y - (rotated.T + trans)
     n_points = X.shape[0]
@@ -357,76 +383,74 @@ def get_position_error(X, Y, trans, rot, scale):
     return numpy.sqrt((pos_error**2).sum(axis=1).sum()) / n_points
 
 
-def _do_one_fiber(fiber, gState, cmd, frameInfo, haLimWarn):
-    """Process one single fiber, computing various scales and corrections."""
-
-    gProbe = fiber.gProbe
-
-    result = get_fiber_dra_ddec(fiber, gState, cmd, frameInfo, haLimWarn)
-    if result is None:
-        return
-
-    dRA, dDec = result
-
-    fiber.dRA = dRA
-    fiber.dDec = dDec
-    raCenter = gProbe.xFocal
-    decCenter = gProbe.yFocal
-
-    if gProbe.tooFaint:
-        return
+def _accumulate_fibers(fibers, rows, gState, frameInfo):
+    """
+    Add the guiding errors and normal equations of these rows of fibers, with
+    dRA, dDec computed, to frameInfo's sums for the standard fitting algorithm.
+    """
+    data = fibers.data
+    probes = gState.gprobes
+    probeRows = _probe_rows(fibers, rows, gState)
+    dRA = data['dRA'][rows]
+    dDec = data['dDec'][rows]
+    dx = data['dx'][rows]
+    dy = data['dy'][rows]
+    raCenter = probes.data['xFocal'][probeRows]
+    decCenter = probes.data['yFocal'][probeRows]
+    n = len(rows)
 
     # Collect fwhms for good in focus stars
-    if gProbe.atFocus and gProbe.good:
-        frameInfo.inFocusFwhm.append(fiber.fwhm)
+    atFocus = (probes.atFocus() & probes.good())[probeRows]
+    frameInfo.inFocusFwhm.extend(data['fwhm'][rows][atFocus])
 
     # accumulate guiding errors for good stars used in fit
-    frameInfo.guideRMS += fiber.dx**2 + fiber.dy**2
-    frameInfo.guideXRMS += fiber.dx**2
-    frameInfo.guideYRMS += fiber.dy**2
-    frameInfo.nguideRMS += 1
-    frameInfo.guideRaRMS += dRA**2
-    frameInfo.guideDecRMS += dDec**2
+    frameInfo.guideRMS = _accumulate(frameInfo.guideRMS, _square(dx) + _square(dy))
+    frameInfo.guideXRMS = _accumulate(frameInfo.guideXRMS, _square(dx))
+    frameInfo.guideYRMS = _accumulate(frameInfo.guideYRMS, _square(dy))
+    frameInfo.nguideRMS += n
+    frameInfo.guideRaRMS = _accumulate(frameInfo.guideRaRMS, _square(dRA))
+    frameInfo.guideDecRMS = _accumulate(frameInfo.guideDecRMS, _square(dDec))
     # guideAzRMS += fiber.dAz**2
     # guideAltRMS += fiber.dAlt**2
 
-    frameInfo.nStar += 1
+    frameInfo.nStar += n
 
-    frameInfo.b[0] += dRA
-    frameInfo.b[1] += dDec
-    frameInfo.b[2] += raCenter * dDec - decCenter * dRA
+    b = frameInfo.b
+    b[0] = _accumulate(b[0], dRA)
+    b[1] = _accumulate(b[1], dDec)
+    b[2] = _accumulate(b[2], raCenter * dDec - decCenter * dRA)
 
-    frameInfo.A[0, 0] += 1
-    frameInfo.A[0, 1] += 0
-    frameInfo.A[0, 2] += -decCenter
+    A = frameInfo.A
+    A[0, 0] += n
+    A[0, 2] = _accumulate(A[0, 2], -decCenter)
 
-    frameInfo.A[1, 0] += 0
-    frameInfo.A[1, 1] += 1
-    frameInfo.A[1, 2] += raCenter
+    A[1, 1] += n
+    A[1, 2] = _accumulate(A[1, 2], raCenter)
 
-    frameInfo.A[2, 2] += raCenter * raCenter + decCenter * decCenter
+    A[2, 2] = _accumulate(A[2, 2], raCenter * raCenter + decCenter * decCenter)
 
     # Now scale.  We don't actually solve for scale and axis updates
     # simultanously, and we don't allow for the axis update when
     # estimating the scale.
-    frameInfo.b3 += raCenter * dRA + decCenter * dDec
+    frameInfo.b3 = _accumulate(frameInfo.b3, raCenter * dRA + decCenter * dDec)
+
+
+def _fiber_offsets(fibers, rows, gState):
+    """The (n, 2) plate positions and dRA, dDec offsets of these rows of a FiberTable."""
+    probeData = gState.gprobes.data[_probe_rows(fibers, rows, gState)]
+    centres = numpy.column_stack((probeData['xFocal'], probeData['yFocal']))
+    deltas = numpy.column_stack((fibers.data['dRA'][rows], fibers.data['dDec'][rows]))
+    return centres, deltas
 
 
 def standard_fitting_algorithm(guideCmd, actorState, gState, fibers,
                                frameInfo):
     """Returns measured axes offsets using the standard algorithm."""
 
-    haLimWarn = False  # So we only warn once about passing the HA limit for refraction balance
-
-    centres = []
-    deltas = []
-
-    for fiber in fibers:
-        if _check_fiber(fiber, gState, guideCmd):
-            _do_one_fiber(fiber, gState, guideCmd, frameInfo, haLimWarn)
-
-            centres.append([fiber.gProbe.xFocal, fiber.gProbe.yFocal])
-            deltas.append([fiber.dRA, fiber.dDec])
+    used = numpy.flatnonzero(_check_fibers(fibers, gState, guideCmd))
+    ok = get_fibers_dra_ddec(fibers, used, gState, guideCmd, frameInfo)
+    tooFaint = gState.gprobes.tooFaint()[_probe_rows(fibers, used, gState)]
+    _accumulate_fibers(fibers, used[ok & ~tooFaint], gState, frameInfo)
 
     frameInfo.setGuideMode(gState)
 
@@ -447,14 +471,14 @@ def standard_fitting_algorithm(guideCmd, actorState, gState, fibers,
         if nStar <= 2:
             guideCmd.warn('text="Only one star is usable"')
             x = frameInfo.b / nStar
-            x[2, 0] = 0  # no rotation
+            x[2] = 0  # no rotation
         else:
             x = numpy.linalg.solve(frameInfo.A, frameInfo.b)
 
         # convert from mm to degrees
-        dRA = x[0, 0] / gState.plugPlateScale
-        dDec = x[1, 0] / gState.plugPlateScale
-        dRot = -math.degrees(x[2, 0])  # and from radians to degrees
+        dRA = x[0] / gState.plugPlateScale
+        dDec = x[1] / gState.plugPlateScale
+        dRot = -math.degrees(x[2])  # and from radians to degrees
         dScale = frameInfo.b3 / frameInfo.A[2, 2]
 
     except numpy.linalg.LinAlgError:
@@ -468,10 +492,10 @@ def standard_fitting_algorithm(guideCmd, actorState, gState, fibers,
     frameInfo.dScale = dScale
     frameInfo.nStar = nStar
 
-    p0 = numpy.array(centres)
-    p1 = p0 + numpy.array(deltas)
+    p0, deltas = _fiber_offsets(fibers, used, gState)
+    p1 = p0 + deltas
 
-    pos_error = get_position_error(p0, p1, [x[0, 0], x[1, 0]], -dRot,
+    pos_error = get_position_error(p0, p1, [x[0], x[1]], -dRot,
                                    dScale + 1)
     pos_error /= gState.plugPlateScale
     frameInfo.pos_error = pos_error
@@ -482,31 +506,21 @@ def standard_fitting_algorithm(guideCmd, actorState, gState, fibers,
 def umeyama_fitting_algorithm(guideCmd, actorState, gState, fibers, frameInfo):
     """Returns measured axes offsets using the Umeyama fitting algorithm."""
 
-    haLimWarn = False
-
-    centres = []
-    deltas = []
-
-    for fiber in fibers:
-        if _check_fiber(fiber, gState, guideCmd):
-
-            result = get_fiber_dra_ddec(fiber, gState, guideCmd, frameInfo,
-                                        haLimWarn)
-            if result is None:
-                continue
-
-            fiber.dRA, fiber.dDec = result
-
-            centres.append([fiber.gProbe.xFocal, fiber.gProbe.yFocal])
-            deltas.append([fiber.dRA, fiber.dDec])
-
-            frameInfo.guideRMS += fiber.dx**2 + fiber.dy**2
-            frameInfo.guideXRMS += fiber.dx**2
-            frameInfo.guideYRMS += fiber.dy**2
-            frameInfo.nguideRMS += 1
-            frameInfo.guideRaRMS += fiber.dRA**2
-            frameInfo.guideDecRMS += fiber.dDec**2
-
+    checked = numpy.flatnonzero(_check_fibers(fibers, gState, guideCmd))
+    ok = get_fibers_dra_ddec(fibers, checked, gState, guideCmd, frameInfo)
+    used = checked[ok]
+
+    dx = fibers.data['dx'][used]
+    dy = fibers.data['dy'][used]
+    frameInfo.guideRMS = _accumulate(frameInfo.guideRMS, _square(dx) + _square(dy))
+    frameInfo.guideXRMS = _accumulate(frameInfo.guideXRMS, _square(dx))
+    frameInfo.guideYRMS = _accumulate(frameInfo.guideYRMS, _square(dy))
+    frameInfo.nguideRMS += len(used)
+    frameInfo.guideRaRMS = _accumulate(frameInfo.guideRaRMS, _square(fibers.data['dRA'][used]))
+    frameInfo.guideDecRMS = _accumulate(frameInfo.guideDecRMS,
+                                        _square(fibers.data['dDec'][used]))
+
+    centres, deltas = _fiber_offsets(fibers, used, gState)
     frameInfo.nStar = len(centres)
 
     if gState.inMotion:
@@ -552,40 +566,40 @@ def umeyama_fitting_algorithm(guideCmd, actorState, gState, fibers, frameInfo):
         return True
 
 
-def _find_focus_one_fiber(fiber, gState, frameInfo, C, A, b):
-    """Accumulate the focus for one fiber into A and b."""
+def _find_focus(fibers, gState, frameInfo, C):
+    """Return the focus normal equations (A, b) from the star sizes in fibers (a FiberTable)."""
+    probes = gState.gprobes
+    probeRows = _probe_rows(fibers, slice(None), gState)
     # required?
-    if fiber.gProbe is None:
-        return
-    gProbe = gState.gprobes[fiber.fiberid]
-    if not gProbe.enabled:
-        return
+    use = probeRows >= 0
+    use[use] = probes.enabled()[probeRows[use]]
 
     # FIXME -- do we want to include ACQUISITION fibers?
     # PH -- currently all valid enabled fibers are used so OK.
-    rms = fiber.fwhm / frameInfo.sigmaToFWHM
-    if numpy.isnan(rms):
-        return
+    rms = fibers.data['fwhm'][use] / frameInfo.sigmaToFWHM
+    use[use] = ~numpy.isnan(rms)
+    rms = rms[~numpy.isnan(rms)]
 
     rms *= frameInfo.micronsPerArcsec  # in microns
     rmsErr = 1
 
-    d = gProbe.focusOffset
+    d = probes.data['focusOffset'][probeRows[use]]
     x = rms * rms - C * d * d
     xErr = 2 * rms * rmsErr
 
-    try:
+    with numpy.errstate(divide='ignore'):
         ivar = 1 / (xErr * xErr)
-    except ZeroDivisionError:
-        ivar = 1e-5
 
-    b[0] += x * ivar
-    b[1] += x * d * ivar
+    A = numpy.zeros((2, 2))
+    b = numpy.zeros(2)
+    b[0] = _accumulate(b[0], x * ivar)
+    b[1] = _accumulate(b[1], x * d * ivar)
 
-    A[0, 0] += ivar
-    A[0, 1] += d * ivar
+    A[0, 0] = _accumulate(A[0, 0], ivar)
+    A[0, 1] = _accumulate(A[0, 1], d * ivar)
 
-    A[1, 1] += d * d * ivar
+    A[1, 1] = _accumulate(A[1, 1], d * d * ivar)
+    return A, b
 
 
 def apply_guide_offset(cmd, gState, actor, actorState,
@@ -641,6 +655,10 @@ def apply_guide_offset(cmd, gState, actor, actorState,
     #     exp_start = None
     #     exp_time = None
 
+    # Any exposure being taken now will straddle this move.
+    if any((offsetRA, offsetDec, offsetRot, offsetFocus)) or offsetScale is not None:
+        gState.moveCount += 1
+
     if gState.centerUp:
         # If we are in the middle of an fk5InFiber (or other TCC track/pterr),
         # adjust the calibration offsets
@@ -684,7 +702,8 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
         queues: the queue list, so we can put commands on it.
         cmd: the currently active command, for message passing.
         gState: an instance of GuiderState, holding information about the gprobes, etc.
-        inFile: the name of the current raw gcamera file.
+        inFile: the current raw gcamera exposure: a GuiderFrame, or the name
+            of the file to read one from. The file is read only once.
         oneExposure: True if we are only handling a single exposure.
         guiderImageAnalysis: an instance of that class, to process the raw image.
         output_verify: passed on to the fits writer. See the pyfits docs for more.
@@ -695,20 +714,25 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
     # in mm on the focal plane, only converting to angles to command the TCC.
     guideCameraScale = gState.gcameraMagnification * gState.gcameraPixelSize * 1e-3  # mm/pixel
     arcsecPerMM = 3600. / gState.plugPlateScale  # arcsec per mm
-    frameNo = int(re.search(r'([0-9]+)\.fits.*$', inFile).group(1))
+    timer = FrameTimer()
+    if isinstance(inFile, GuiderFrame):
+        frame = inFile
+    else:
+        frame = GuiderFrame.read(inFile, timer=timer)
 
     # Object to gather all per-frame guiding info into.
-    frameInfo = GuiderState.FrameInfo(frameNo, arcsecPerMM, guideCameraScale,
+    frameInfo = GuiderState.FrameInfo(frame.frameNo, arcsecPerMM, guideCameraScale,
                                       gState.plugPlateScale)
+    frameInfo.inMotion = gState.inMotion
+    frameInfo.timing = timer
 
     actorState = guiderActor.myGlobals.actorState
     guideCmd = gState.cmd
-    guideCmd.respond('processing=%s' % inFile)
+    guideCmd.respond('processing=%s' % frame.filename)
 
-    h = pyfits.getheader(inFile)
-    flatfile = h.get('FLATFILE', None)
-    flatcart = h.get('FLATCART', None)
-    darkfile = h.get('DARKFILE', None)
+    flatfile = frame.flatFile
+    flatcart = frame.flatCart
+    darkfile = frame.darkFile
     if not flatfile:
         guideCmd.fail('guideState="failed"; '
                       'text=%s' % qstr('No flat image available'))
@@ -738,11 +762,12 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
         guideCmd.inform('text="guideStep GuiderImageAnalysis.findStars()..."')
         fibers = guiderImageAnalysis(
             cmd,
-            inFile,
+            frame,
             gState.gprobes,
             setPoint=setPoint,
             bypassDark=actorState.bypassDark,
-            camera=camera)
+            camera=camera,
+            timer=timer)
         guideCmd.inform('text="GuiderImageAnalysis.findStars() got %i fibers"' % len(fibers))
     except GuiderExceptions.BadReadError as e:
         guideCmd.warn('text=%s' % qstr('Skipping badly formatted image.'))
@@ -828,13 +853,16 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
         gState.fitting_algorithm))
     frameInfo.fittingAlgorithm = gState.fitting_algorithm
 
-    if gState.fitting_algorithm == 'standard':
-        fit_status = standard_fitting_algorithm(guideCmd, actorState, gState, fibers, frameInfo)
-    elif gState.fitting_algorithm == 'umeyama':
-        fit_status = umeyama_fitting_algorithm(guideCmd, actorState, gState, fibers, frameInfo)
-    else:
-        raise ValueError('invalid fitting algorithm {!r}'.format(
-            gState.fitting_algorithm))
+    with timer.stage('fit'):
+        if gState.fitting_algorithm == 'standard':
+            fit_status = standard_fitting_algorithm(guideCmd, actorState, gState, fibers,
+                                                    frameInfo)
+        elif gState.fitting_algorithm == 'umeyama':
+            fit_status = umeyama_fitting_algorithm(guideCmd, actorState, gState, fibers,
+                                                   frameInfo)
+        else:
+            raise ValueError('invalid fitting algorithm {!r}'.format(
+                gState.fitting_algorithm))
 
     if fit_status is False:
         guiderImageAnalysis.writeFITS(
@@ -845,6 +873,7 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
             output_verify=output_verify)
 
         if oneExposure:
+            guiderImageAnalysis.flush()
             queues[MASTER].put(Msg(Msg.STATUS, cmd, finish=True))
             gState.cmd = None
             return frameInfo
@@ -871,16 +900,17 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
 
     # directly apply a shift for centerUp and decentering.
     # otherwise, apply the shift via the usual pid.
-    dt = gState.update_pid_time('raDec', time.time())
-    gState.update_pid_time('rot', time.time())
-    if gState.centerUp or gState.decenterCmd:
-        offsetRa = -dRA
-        offsetDec = -dDec
-        offsetRot = 0
-    else:
-        offsetRa = -gState.pid['raDec'].update(dRA, dt=dt)
-        offsetDec = -gState.pid['raDec'].update(dDec, dt=dt)
-        offsetRot = -gState.pid['rot'].update(dRot, dt=dt) if nStar > 1 else 0
+    with timer.stage('pid'):
+        dt = gState.update_pid_time('raDec', time.time())
+        gState.update_pid_time('rot', time.time())
+        if gState.centerUp or gState.decenterCmd:
+            offsetRa = -dRA
+            offsetDec = -dDec
+            offsetRot = 0
+        else:
+            offsetRa = -gState.pid['raDec'].update(dRA, dt=dt)
+            offsetDec = -gState.pid['raDec'].update(dDec, dt=dt)
+            offsetRot = -gState.pid['rot'].update(dRot, dt=dt) if nStar > 1 else 0
 
     frameInfo.filtRA = offsetRa
     frameInfo.filtDec = offsetDec
@@ -919,7 +949,7 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
     # hiKept = frameInfo.inFocusFwhm[(trimHi-1)]
 
     guideCmd.inform('fwhm=%d, %7.2f, %d, %d, %7.2f' %
-                    (frameNo, tMeanFwhm, nKept, nReject, meanFwhm))
+                    (frameInfo.frameNo, tMeanFwhm, nKept, nReject, meanFwhm))
 
     frameInfo.meanFwhm = meanFwhm
     frameInfo.tMeanFwhm = tMeanFwhm
@@ -946,6 +976,13 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
     # frameInfo.guideAltRMS = guideAltRMS
 
     if nStar <= 1 or numpy.isnan(frameInfo.dScale) or gState.centerUp:
+        # Applies corrections before returning, and before the slow file write.
+        with timer.stage('tcc'):
+            apply_guide_offset(cmd, gState, actor, actorState,
+                               offsetRA=frameInfo.offsetRA,
+                               offsetDec=frameInfo.offsetDec,
+                               offsetRot=frameInfo.offsetRot, header=frame.header)
+
         guiderImageAnalysis.writeFITS(
             actorState.models,
             guideCmd,
@@ -954,21 +991,17 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
             output_verify=output_verify)
 
         if oneExposure:
+            guiderImageAnalysis.flush()
             queues[MASTER].put(Msg(Msg.STATUS, cmd, finish=True))
             gState.cmd = None
 
-        # Applies corrections before returning
-        apply_guide_offset(cmd, gState, actor, actorState,
-                           offsetRA=frameInfo.offsetRA,
-                           offsetDec=frameInfo.offsetDec,
-                           offsetRot=frameInfo.offsetRot, header=h)
-
         return frameInfo
 
     dScale = frameInfo.dScale
 
-    dt = gState.update_pid_time('scale', time.time())
-    offsetScale = -gState.pid['scale'].update(dScale, dt=dt)
+    with timer.stage('pid'):
+        dt = gState.update_pid_time('scale', time.time())
+        offsetScale = -gState.pid['scale'].update(dScale, dt=dt)
 
     frameInfo.filtScale = offsetScale
     frameInfo.offsetScale = offsetScale if gState.guideScale else 0.0
@@ -1029,26 +1062,23 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
     focalRatio = 5.0
     C = 5 / (32.0 * focalRatio * focalRatio)
 
-    A = numpy.matrix(numpy.zeros(2 * 2).reshape([2, 2]))
-    b = numpy.matrix(numpy.zeros(2).reshape([2, 1]))
-
-    for fiber in fibers:
-        _find_focus_one_fiber(fiber, gState, frameInfo, C, A, b)
+    A, b = _find_focus(fibers, gState, frameInfo, C)
 
     A[1, 0] = A[0, 1]
     try:
         x = numpy.linalg.solve(A, b)
 
-        Delta = x[1, 0] / (2 * C)
+        Delta = x[1] / (2 * C)
         try:
-            rms0 = math.sqrt(x[0, 0] - C * Delta * Delta) / frameInfo.micronsPerArcsec
+            rms0 = math.sqrt(x[0] - C * Delta * Delta) / frameInfo.micronsPerArcsec
         except ValueError as e:
             rms0 = float('NaN')
 
         # Note sign change here.
         dFocus = -Delta * gState.dSecondary_dmm  # mm to move the secondary
-        dt = gState.update_pid_time('focus', time.time())
-        offsetFocus = -gState.pid['focus'].update(dFocus, dt=dt)
+        with timer.stage('pid'):
+            dt = gState.update_pid_time('focus', time.time())
+            offsetFocus = -gState.pid['focus'].update(dFocus, dt=dt)
 
         frameInfo.dFocus = dFocus
         frameInfo.filtFocus = offsetFocus
@@ -1082,6 +1112,16 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
 
         frameInfo.offsetFocus = 0.0
 
+    # Applies all corrections first, so they don't wait on the file write.
+    with timer.stage('tcc'):
+        apply_guide_offset(cmd, gState, actor, actorState,
+                           offsetRA=frameInfo.offsetRA,
+                           offsetDec=frameInfo.offsetDec,
+                           offsetRot=frameInfo.offsetRot,
+                           offsetScale=frameInfo.offsetScale,
+                           offsetFocus=frameInfo.offsetFocus,
+                           header=frame.header)
+
     # Write output fits file for TUI
     guiderImageAnalysis.writeFITS(
         actorState.models,
@@ -1090,42 +1130,63 @@ def guideStep(actor, queues, cmd, gState, inFile, oneExposure,
         gState.gprobes,
         output_verify=output_verify)
 
-    # Applies all corrections
-    apply_guide_offset(cmd, gState, actor, actorState,
-                       offsetRA=frameInfo.offsetRA,
-                       offsetDec=frameInfo.offsetDec,
-                       offsetRot=frameInfo.offsetRot,
-                       offsetScale=frameInfo.offsetScale,
-                       offsetFocus=frameInfo.offsetFocus,
-                       header=h)
-
     return frameInfo
 
 
+def report_timing(cmd, gState, frameInfo):
+    """Output the timing keyword for a guide frame, and add it to the rolling stage timings."""
+    timer = getattr(frameInfo, 'timing', None)
+    if timer is None:
+        return
+    cmd.inform(timer.keyword(frameInfo.frameNo))
+    gState.stageTimings.add(timer)
+
+
+def _read_plugmap(cmd, gState):
+    """Run catPlPlugMapM for the current plugging, and return its PLUGMAPOBJ array."""
+    path = 'catPlPlugMapM'
+    cmd1 = '%s -c %s -m %s -p %s -f %s %s' % (path, gState.cartridge,
+                                              gState.fscanMJD,
+                                              gState.pointing,
+                                              gState.fscanID, gState.plate)
+    try:
+        cmd.diag('text=%s' % (qstr('running: %s' % (cmd1))))
+        ret = subprocess.Popen(cmd1.split(), stdout=subprocess.PIPE)
+        plugmapBlob, errText = ret.communicate()
+    except subprocess.CalledProcessError as e:
+        cmd.warn('text="failed to load plugmap file: %s"' % (e))
+        return None
+
+    ypm = YPF.YPF(fromString=plugmapBlob)
+    return ypm.structs['PLUGMAPOBJ'].asArray()
+
+
 def loadAllProbes(cmd, gState):
     """
     Read in information about the current guide probes from the platedb.
 
     The contents of the plPlugMap table are documented in the data model here:
     http://data.sdss3.org/datamodel/files/PLATELIST_DIR/runs/PLATERUN/plPlugMap.html
+
+    The parsed plugmap is kept in gState.plugmapCache, so loading the same
+    plugging again does not need catPlPlugMapM.
     """
     gState.allProbes = None
     try:
-        path = 'catPlPlugMapM'
-        cmd1 = '%s -c %s -m %s -p %s -f %s %s' % (path, gState.cartridge,
-                                                  gState.fscanMJD,
-                                                  gState.pointing,
-                                                  gState.fscanID, gState.plate)
-        try:
-            cmd.diag('text=%s' % (qstr('running: %s' % (cmd1))))
-            ret = subprocess.Popen(cmd1.split(), stdout=subprocess.PIPE)
-            plugmapBlob, errText = ret.communicate()
-        except subprocess.CalledProcessError as e:
-            cmd.warn('text="failed to load plugmap file: %s"' % (e))
-            return
-
-        ypm = YPF.YPF(fromString=plugmapBlob)
-        pm = ypm.structs['PLUGMAPOBJ'].asArray()
+        cacheKey = (gState.cartridge, gState.plate, gState.pointing, gState.fscanMJD,
+                    gState.fscanID)
+        pm = gState.plugmapCache.get('plugmap', gState.plate, cacheKey)
+        if pm is not None:
+            pm = pm.view(numpy.recarray)
+            cmd.diag('text="plugmap for plate %d read from the plugmap cache"' % gState.plate)
+        else:
+            pm = _read_plugmap(cmd, gState)
+            if pm is None:
+                return
+            try:
+                gState.plugmapCache.put('plugmap', gState.plate, cacheKey, pm)
+            except EnvironmentError as e:
+                cmd.warn('text=%s' % (qstr('could not cache the plugmap: %s' % (e))))
 
         # output information about the science program for this plate.
         # jkp TBD: may need to conver these to strings in some way
@@ -1291,6 +1352,16 @@ def flat_finished(msg, guiderImageAnalysis, actorState, gState):
 #
 # Actual guider commands, and sub-commands.
 #
+def _set_magnitudes(gState):
+    """Set the gprobes' ugriz from the magnitudes of their GUIDE holes in allProbes."""
+    # There should only be one GUIDE hole per probe.
+    guide = gState.allProbes[gState.allProbes.holeType == 'GUIDE']
+    fiberIds, first = numpy.unique(guide.fiberId, return_index=True)
+    probeRows = gState.gprobes.rows(fiberIds)
+    found = probeRows >= 0
+    gState.gprobes.set_ugriz(probeRows[found], guide.mag[first[found]])
+
+
 def load_cartridge(msg, queues, gState, actorState):
     """
     Load cartridge information into the appropriate systems.
@@ -1307,8 +1378,24 @@ def load_cartridge(msg, queues, gState, actorState):
     gState.design_ha = msg.design_ha
     gState.plateType = msg.survey
     gState.surveyMode = msg.surveyMode
+
+    # GuiderCmd.loadCartridge's timer, for the time taken to load the cartridge.
+    timer = getattr(msg, 'timer', None) or FrameTimer()
+    # A cartridge loaded earlier tonight, whose plugging the platedb says has not changed.
+    snapshot = getattr(msg, 'snapshot', None)
+    if snapshot is not None and snapshot.gprobes is not None:
+        with timer.stage('snapshot'):
+            snapshot.restore(gState)
+            _set_magnitudes(gState)
+        msg.cmd.inform(timer.loadKeyword(gState.cartridge))
+        queues[MASTER].put(
+            Msg(Msg.STATUS, msg.cmd, finish=True, loadedNewCartridge=True))
+        return
+
     for id, gProbe in msg.gprobes.items():
         gState.gprobes[id] = gProbe
+    # Their refraction offsets were read by GuiderCmd.addGuideOffsets.
+    gState.refractionTable = GuiderState.RefractionTable(gState.gprobes)
 
     # Build and install an instrument block for this cartridge info
     # NOTE: TBD: we don't actually need to do loadTccBlock unless we want fk5infiber.
@@ -1323,12 +1410,15 @@ def load_cartridge(msg, queues, gState, actorState):
     # if cmdVar.didFail:
     #     msg.cmd.fail('text="Failed to set inst!"')
 
-    loadAllProbes(msg.cmd, gState)
-    for id, gProbe in gState.gprobes.items():
-        test = (gState.allProbes.fiberId == id) & (
-            gState.allProbes.holeType == 'GUIDE')
-        if test.any():  # should only be one
-            gProbe.ugriz = gState.allProbes.mag[test][0]
+    with timer.stage('plugmap'):
+        loadAllProbes(msg.cmd, gState)
+        _set_magnitudes(gState)
+    msg.cmd.inform(timer.loadKeyword(gState.cartridge))
+
+    # Keep what we built, to switch back to this cartridge without building it again.
+    if snapshot is not None and gState.allProbes is not None:
+        snapshot.save(gState)
+        gState.cartridgeSnapshots.put(snapshot)
 
     # TBD: SDSS4: We may have to twiddle with this for coobserved plates.
     # What to do with APOGEEMANGA? Also use the surveyMode?
@@ -1440,6 +1530,7 @@ def start_guider(cmd,
             gState.startFrame = simulating[2]
 
     gState.reset_pid_terms()
+    gState.guideRun += 1
     gState.cmd.respond('guideState=on')
 
     if gState.guideWavelength == -1:
@@ -1453,13 +1544,23 @@ def start_guider(cmd,
             'text="guiding begins. guiding at {0}A with refractionBalance={1:.2f}."'
             .format(gState.guideWavelength, gState.refractionBalance))
 
+    request_exposure(queues, gState, camera)
+
+
+def request_exposure(queues, gState, camera='gcamera'):
+    """
+    Ask for the next guide exposure, noting how many TCC moves there have been
+    so far, and which guide run it is for.
+    """
+    gState.exposeMoveCount = gState.moveCount
     queues[GCAMERA].put(
         Msg(Msg.EXPOSE,
             gState.cmd,
             replyQueue=queues[MASTER],
             expTime=gState.expTime,
             stack=gState.stack,
-            camera=camera))
+            camera=camera,
+            guideRun=gState.guideRun))
 
 
 def stop_guider(cmd, gState, actorState, queues, frameNo, success):
@@ -1511,7 +1612,16 @@ def main(actor, queues):
     time.sleep(3)
     setPoint = actorState.models['gcamera'].keyVarDict['cooler'][0]
     print 'Initial gcamera setPoint:', setPoint
-    guiderImageAnalysis = GuiderImageAnalysis(setPoint)
+    guiderImageAnalysis = GuiderImageAnalysis(
+        setPoint, calibCache=CalibrationCache(gState.calibCacheMB),
+        sparse=gState.sparseProcessing)
+    guiderImageAnalysis.procFormat = gState.procFormat
+    guiderImageAnalysis.procQuantizeLevel = gState.procQuantizeLevel
+    guiderImageAnalysis.starFinder = gState.starFinder
+    guiderImageAnalysis.starFinderShadow = gState.starFinderShadow
+    if gState.procWriterQueue > 0:
+        guiderImageAnalysis.writer = ProcFileWriter(gState.procWriterQueue,
+                                                    gState.procWriterPolicy)
 
     while True:
         try:
@@ -1527,6 +1637,9 @@ def main(actor, queues):
                     msg.cmd.inform('text="Exiting thread %s"' %
                                    (threading.current_thread().name))
 
+                # Don't lose the proc- files that are still being written.
+                if guiderImageAnalysis.writer is not None:
+                    guiderImageAnalysis.writer.stop()
                 return
 
             elif msg.type == Msg.CENTERUP:
@@ -1545,6 +1658,8 @@ def main(actor, queues):
                 success = getattr(msg, 'success',
                                   True)  # Succeed, unless told otherwise
                 frameNo = getattr(frameInfo, 'frameNo', None)
+                # finish writing this run's files before it's declared off.
+                guiderImageAnalysis.flush()
                 stop_guider(msg.cmd, gState, actorState, queues, frameNo,
                             success)
 
@@ -1579,11 +1694,18 @@ def main(actor, queues):
                     gState.inMotion = False
                     continue
 
+                # e.g. an exposure still being taken when the guider was
+                # turned off, that finished after it was turned on again.
+                if getattr(msg, 'guideRun', gState.guideRun) != gState.guideRun:
+                    gState.cmd.diag('text="ignoring an exposure from an earlier guide run"')
+                    continue
+
                 # TBD: #2230 need to check whether the telescope moved here, and
                 # ignore this frame if a "tcc offset" was issued.
                 # This requires something that monitors tccModel.moveItems[4:]
                 # changing to 'Y' so we can flag it, and clear the flag only
                 # after we get to this point and have checked it.
+                # For now, we only know about the moves we commanded ourselves.
 
                 if not msg.success:
                     gState.inMotion = False
@@ -1593,6 +1715,15 @@ def main(actor, queues):
 
                 camera = getattr(msg, 'camera', 'gcamera')
 
+                # Skip the fit if we moved the telescope during this exposure.
+                if gState.moveCount != gState.exposeMoveCount:
+                    gState.inMotion = True
+
+                # Take the next exposure while we process this one.
+                pipelined = gState.pipelineExposures and not oneExposure
+                if pipelined:
+                    request_exposure(queues, gState, camera)
+
                 frameInfo = guideStep(
                     actor,
                     queues,
@@ -1602,6 +1733,7 @@ def main(actor, queues):
                     oneExposure,
                     guiderImageAnalysis,
                     camera=camera)
+                report_timing(msg.cmd if msg.cmd.alive else actor.bcast, gState, frameInfo)
                 if not gState.cmd:
                     continue
 
@@ -1634,16 +1766,11 @@ def main(actor, queues):
                 # Start the next exposure
                 #
                 if oneExposure:
+                    guiderImageAnalysis.flush()
                     queues[MASTER].put(Msg(Msg.STATUS, msg.cmd, finish=True))
                     gState.cmd = None
-                else:
-                    queues[GCAMERA].put(
-                        Msg(Msg.EXPOSE,
-                            gState.cmd,
-                            replyQueue=queues[MASTER],
-                            expTime=gState.expTime,
-                            stack=gState.stack,
-                            camera=camera))
+                elif not pipelined:
+                    request_exposure(queues, gState, camera)
 
             elif msg.type == Msg.TAKE_FLAT:
                 if not prep_for_flat(msg.cmd, gState, actorState):
@@ -1888,6 +2015,24 @@ def main(actor, queues):
                 decenters = getattr(msg, 'decenters', {})
                 set_decenter(msg.cmd, decenters, gState, enable)
 
+            elif msg.type == Msg.TIMING:
+                # percentiles of the last frames' stage times, in milliseconds.
+                for stage in gState.stageTimings.times:
+                    nFrames, percentiles = gState.stageTimings.percentiles(stage)
+                    msg.cmd.inform('stageTiming=%s, %d, %.1f, %.1f, %.1f' %
+                                   ((stage, nFrames) + tuple(1e3 * t for t in percentiles)))
+                if msg.reset:
+                    gState.stageTimings.clear()
+                msg.cmd.finish()
+
+            elif msg.type == Msg.PLUGMAP_CACHE:
+                if msg.clear:
+                    nDeleted = gState.plugmapCache.clear(msg.plate)
+                    nSnapshots = gState.cartridgeSnapshots.clear(msg.plate)
+                    msg.cmd.inform('text="deleted %d cached plugmap files and %d cartridge snapshots"'
+                                   % (nDeleted, nSnapshots))
+                msg.cmd.finish('plugmapCache=%d, %.1f, %d, %d' % gState.plugmapCache.status())
+
             elif msg.type == Msg.STATUS:
                 # Try to generate status even after we have failed.
                 cmd = msg.cmd if msg.cmd.alive else actor.bcast
@@ -1920,16 +2065,13 @@ def main(actor, queues):
 
                 # Some fiber IDs may be absent from gprobeBits.keys(),
                 # so start them all with UNKNOWN
-                liveProbes = gState.gprobes.keys()
-                if liveProbes:
-                    gprobeBits = [
-                        GuiderState.UNKNOWN,
-                    ] * (1 + max(liveProbes))
-                    for gProbe in gState.gprobes.values():
-                        if gProbe:
-                            gprobeBits[
-                                gProbe.id] = '0x%02x' % gProbe.gprobebits
-                    cmd.respond('gprobeBits=%s' % ', '.join(gprobeBits[1:]))
+                probes = gState.gprobes
+                if len(probes):
+                    gprobeBits = numpy.full(1 + probes.data['id'].max(), GuiderState.UNKNOWN,
+                                            dtype=int)
+                    gprobeBits[probes.data['id']] = probes.data['bits']
+                    cmd.respond('gprobeBits=%s' %
+                                ', '.join('0x%02x' % bits for bits in gprobeBits[1:]))
 
                 cmd.respond('guideEnable=%s, %s, %s' %
                             (gState.guideAxes, gState.guideFocus,
@@ -1955,6 +2097,13 @@ def main(actor, queues):
                 cmd.diag('fitting_algorithm="{}"'.format(
                     gState.fitting_algorithm))
 
+                if getattr(msg, 'geek', False):
+                    cmd.diag('calibCache=%d, %.1f, %.1f, %d, %d, %d' %
+                             guiderImageAnalysis.calibCache.status())
+                    if guiderImageAnalysis.writer is not None:
+                        cmd.diag('procWriter=%d, %d, %d, %d, %d, %.3f, %.3f, %.3f' %
+                                 guiderImageAnalysis.writer.status())
+
                 if msg.finish:
                     cmd.finish()
             else:
@@ -0,0 +1,112 @@
+"""
+An on-disk cache of the parsed plugmaps and plateGuideOffsets tables of the
+plates the guider has loaded.
+
+Every loadCartridge used to fork catPlPlugMapM and parse its output with YPF,
+and re-read the plate's plateGuideOffsets-*.par file with yanny, although for a
+given plugging they are always the same tables. The parsed arrays are saved as
+.npy files whose names are a hash of what identifies them (plate, pointing,
+fscanMJD, fscanID and, for guide offsets, the wavelength and the version of the
+.par file), so loading the same plugging again memory-maps them instead.
+
+A new plugging has a new fscanMJD/fscanID, and a regenerated .par file a new
+modification time, so entries are never found for the wrong data; but if a
+plugmap is corrected in the platedb in place, use ``guider plugmapCache clear``.
+"""
+
+import glob
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+# Bump this when the layout of the cached arrays changes, so old files are
+# never read as new ones.
+CACHE_VERSION = 1
+
+
+def file_version(path):
+    """Return (modification time, size) of path, which change when it is rewritten, or None."""
+    try:
+        return (os.path.getmtime(path), os.path.getsize(path))
+    except OSError:
+        return None
+
+
+class PlugmapCache(object):
+    """
+    Parsed plugmap and guide offset arrays, stored as .npy files in cacheDir.
+
+    The arrays returned by get() are read-only memory maps of those files.
+    With no cacheDir, nothing is cached and every get() is a miss.
+    """
+
+    def __init__(self, cacheDir=None):
+        self.cacheDir = os.path.expanduser(cacheDir) if cacheDir else None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, kind, plate, key):
+        """Return the file holding the kind of array for plate identified by key."""
+        digest = hashlib.sha1('\0'.join(str(k) for k in (CACHE_VERSION, ) + tuple(key)))
+        return os.path.join(self.cacheDir,
+                            '%s-%06d-%s.npy' % (kind, plate, digest.hexdigest()))
+
+    def get(self, kind, plate, key):
+        """Return the kind of array cached for plate and key, or None."""
+        if self.cacheDir is None:
+            self.misses += 1
+            return None
+        try:
+            array = np.load(self.path(kind, plate, key), mmap_mode='r')
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return array
+
+    def put(self, kind, plate, key, array):
+        """
+        Save array as the kind of array for plate and key.
+
+        The file is written under a temporary name and renamed, so a reader
+        never sees it half-written. Arrays holding python objects cannot be
+        memory-mapped, and are not cached. Raises EnvironmentError if the file
+        cannot be written.
+        """
+        if self.cacheDir is None or array.dtype.hasobject:
+            return
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        fd, tempName = tempfile.mkstemp(suffix='.tmp', dir=self.cacheDir)
+        try:
+            with os.fdopen(fd, 'wb') as outFile:
+                np.save(outFile, np.ascontiguousarray(array))
+            os.rename(tempName, self.path(kind, plate, key))
+        except EnvironmentError:
+            os.remove(tempName)
+            raise
+
+    def _files(self, plate=None):
+        if self.cacheDir is None:
+            return []
+        pattern = '*-*-*.npy' if plate is None else '*-%06d-*.npy' % plate
+        return glob.glob(os.path.join(self.cacheDir, pattern))
+
+    def clear(self, plate=None):
+        """Delete the cached arrays of plate, or of every plate; return how many were deleted."""
+        nDeleted = 0
+        for filename in self._files(plate):
+            try:
+                os.remove(filename)
+                nDeleted += 1
+            except OSError:
+                pass
+        return nDeleted
+
+    def status(self):
+        """Return (nFiles, MB on disk, hits, misses), for status output."""
+        files = self._files()
+        nbytes = sum(os.path.getsize(f) for f in files if os.path.exists(f))
+        return (len(files), nbytes / 2.**20, self.hits, self.misses)
@@ -0,0 +1,134 @@
+"""
+Per-stage timing of the guide loop.
+
+guideStep and GuiderImageAnalysis time each stage of processing a frame with
+a FrameTimer, which is reported for each frame as the timing keyword. The
+master thread keeps the last few hundred frames' timings in a StageTimings,
+whose percentiles "guider timing" reports, so we can tell which stage is
+eating into the cadence budget.
+
+loadCartridge times its platedb queries, guide offset read and plugmap load
+(or the restore of a cartridge snapshot) with a FrameTimer too, and reports
+them as the loadCartridgeTiming keyword: the time to load a cartridge delays
+the start of the science exposures.
+"""
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import sys
+import time
+
+import numpy as np
+
+# The stages of processing a frame, in the order they are output in the timing keyword.
+STAGES = ('header', 'decompress', 'bias', 'dark', 'flat', 'gfindstars', 'fit', 'pid',
+          'cards', 'write', 'tcc')
+# the wall time from the start of the frame's first stage to when it is reported.
+TOTAL = 'total'
+# The stages of loading a cartridge, in the order they are output in the
+# loadCartridgeTiming keyword. Some of them run concurrently, so they can add up
+# to more than the total.
+LOAD_STAGES = ('mcp', 'platedb', 'gprobes', 'geometry', 'offsets', 'plugmap', 'snapshot')
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_clock_gettime():
+    """Return libc/librt's clock_gettime, or None if we can't find it."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                          use_errno=True)
+        return lib.clock_gettime
+    except (OSError, AttributeError):
+        return None
+
+
+# python 2 has no time.monotonic(), so get the monotonic clock from libc on linux,
+# falling back on the wall clock (which can jump) elsewhere.
+_CLOCK_MONOTONIC = 1  # from linux's <time.h>
+_clock_gettime = _load_clock_gettime()
+
+
+def monotonic():
+    """Return the time in seconds from a clock that never goes backwards."""
+    if _clock_gettime is None:
+        return time.time()
+    t = _timespec()
+    if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class FrameTimer(object):
+    """The time spent in each stage of processing one frame, or of loading a cartridge."""
+
+    def __init__(self):
+        self.start = monotonic()
+        self.times = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block, adding it to any time already spent in stage name."""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + monotonic() - start
+
+    def elapsed(self):
+        """Seconds since this timer was created."""
+        return monotonic() - self.start
+
+    def _values(self, stages):
+        """The milliseconds spent in each of stages (nan for stages that didn't run), then the total."""
+        values = ['%.1f' % (1e3 * self.times[name]) if name in self.times else 'nan'
+                  for name in stages]
+        values.append('%.1f' % (1e3 * self.elapsed()))
+        return ','.join(values)
+
+    def keyword(self, frameNo):
+        """
+        Return the timing keyword for frame frameNo: the milliseconds spent in
+        each of STAGES (nan for stages that didn't run), then the total.
+        """
+        return 'timing=%d,%s' % (frameNo, self._values(STAGES))
+
+    def loadKeyword(self, cartridge):
+        """
+        Return the loadCartridgeTiming keyword for cartridge: the milliseconds
+        spent in each of LOAD_STAGES (nan for stages that didn't run), then the total.
+        """
+        return 'loadCartridgeTiming=%d,%s' % (cartridge, self._values(LOAD_STAGES))
+
+
+class StageTimings(object):
+    """Rolling timings of each stage over the last nFrames frames."""
+
+    def __init__(self, nFrames=500):
+        self.nFrames = nFrames
+        self.clear()
+
+    def clear(self):
+        self.times = collections.OrderedDict(
+            (name, collections.deque(maxlen=self.nFrames)) for name in STAGES + (TOTAL, ))
+
+    def add(self, timer):
+        """Add the stage times, and the total so far, of a FrameTimer."""
+        for name, seconds in timer.times.items():
+            if name in self.times:
+                self.times[name].append(seconds)
+        self.times[TOTAL].append(timer.elapsed())
+
+    def percentiles(self, name, q=(50, 95, 99)):
+        """Return (number of frames, the q percentiles in seconds) for stage name."""
+        times = self.times[name]
+        if not times:
+            return 0, tuple(np.nan for x in q)
+        return len(times), tuple(np.percentile(times, q))
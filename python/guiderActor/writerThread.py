@@ -0,0 +1,174 @@
+"""
+Thread for writing processed guider (proc-gimg) files.
+
+Compressing and checksumming a proc- file is the slowest part of handling a
+frame, and used to block the master thread (and so both the guide loop and
+command handling) while it ran. The master thread now only builds each
+file's HDUList, from copies of the frame's arrays, and hands it to a
+ProcFileWriter, whose thread writes the files in the order they were queued.
+
+Unlike the other guider threads, the writer owns its queue, since the queue
+has to be bounded: when it is full, put() either blocks the guide loop until
+there is room, or drops the oldest unwritten frame, depending on the policy.
+Processed darks and flats are never dropped, since every later run would
+have to regenerate them.
+"""
+import collections
+import Queue
+import threading
+import time
+
+import actorcore.utility.fits as actorFits
+import opscore.utility.tback as tback
+from opscore.utility.qstr import qstr
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop'
+
+
+class ProcFileJob(object):
+    """
+    One proc- file to write: an HDUList that nothing else holds on to.
+    If announce, output the file keyword once it is written, and if onWritten
+    is set, call it then. Unless droppable, the DROP_OLDEST policy never drops it.
+    """
+
+    def __init__(self, cmd, hdulist, directory, filename, doCompress=True,
+                 output_verify='warn', checksum=True, announce=True,
+                 droppable=True, onWritten=None):
+        self.cmd = cmd
+        self.hdulist = hdulist
+        self.directory = directory
+        self.filename = filename
+        self.doCompress = doCompress
+        self.output_verify = output_verify
+        self.checksum = checksum
+        self.announce = announce
+        self.droppable = droppable
+        self.onWritten = onWritten
+        self.queued = None  # set by ProcFileWriter.put()
+
+    def write(self):
+        """Write the file, gzipped if doCompress, and announce it."""
+        actorFits.writeFits(
+            self.cmd,
+            self.hdulist,
+            self.directory,
+            self.filename,
+            doCompress=self.doCompress,
+            chmod=0644,
+            checksum=self.checksum,
+            output_verify=self.output_verify)
+        if self.announce:
+            self.cmd.inform('file=%s/,%s' % (self.directory, self.filename))
+        if self.onWritten is not None:
+            self.onWritten()
+
+
+class _JobQueue(Queue.Queue):
+    """A Queue of ProcFileJobs, from which the oldest droppable one can be removed."""
+
+    def drop_oldest(self):
+        """Remove and return the oldest job that can be dropped, or None if there isn't one."""
+        with self.mutex:
+            for job in self.queue:
+                if job is not None and job.droppable:
+                    self.queue.remove(job)
+                    self.unfinished_tasks -= 1
+                    if self.unfinished_tasks == 0:
+                        self.all_tasks_done.notify_all()
+                    self.not_full.notify()
+                    return job
+        return None
+
+
+class ProcFileWriter(object):
+    """Writes ProcFileJobs in a background thread, from a bounded FIFO queue."""
+
+    def __init__(self, maxQueue=4, policy=BLOCK, nLatencies=100):
+        """
+        maxQueue is the number of files that can be waiting to be written.
+        policy is BLOCK or DROP_OLDEST, for what put() does when that is reached.
+        The write latency statistics cover the last nLatencies files.
+        """
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError('invalid proc- file writer policy {!r}'.format(policy))
+        self.policy = policy
+        self.queue = _JobQueue(maxQueue)
+        self.lock = threading.Lock()
+        self.nWritten = 0
+        self.nDropped = 0
+        self.nFailed = 0
+        # seconds from put() to the file being written, and just for the write.
+        self.latencies = collections.deque(maxlen=nLatencies)
+        self.writeTimes = collections.deque(maxlen=nLatencies)
+
+        self.thread = threading.Thread(target=self._run, name='procWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, job):
+        """Queue job to be written, applying the backpressure policy if the queue is full."""
+        job.queued = time.time()
+        if self.policy == BLOCK or not job.droppable:
+            self.queue.put(job)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(job)
+                return
+            except Queue.Full:
+                dropped = self.queue.drop_oldest()
+                if dropped is None:
+                    # Only calibrations are waiting: wait for one of them to be written.
+                    self.queue.put(job)
+                    return
+                with self.lock:
+                    self.nDropped += 1
+                dropped.cmd.warn('text=%s' % qstr(
+                    'proc- file writer is behind: not writing %s' % dropped.filename))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                start = time.time()
+                job.write()
+                end = time.time()
+                with self.lock:
+                    self.nWritten += 1
+                    self.latencies.append(end - job.queued)
+                    self.writeTimes.append(end - start)
+            except Exception as e:
+                with self.lock:
+                    self.nFailed += 1
+                job.cmd.error('text="failed to write FITS file %s: %r"' % (job.filename, e))
+                tback.tback('procWriter', e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until every queued file has been written."""
+        self.queue.join()
+
+    def stop(self):
+        """Write everything that is queued, then stop the thread."""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def status(self):
+        """
+        Return (queued, maxQueue, nWritten, nDropped, nFailed, mean latency,
+        max latency, mean write time), with times in seconds.
+        """
+        with self.lock:
+            latencies = list(self.latencies)
+            writeTimes = list(self.writeTimes)
+            counts = (self.nWritten, self.nDropped, self.nFailed)
+        mean = lambda x: sum(x) / len(x) if x else 0.0
+        return ((self.queue.qsize(), self.queue.maxsize) + counts +
+                (mean(latencies), max(latencies) if latencies else 0.0, mean(writeTimes)))
@@ -593,6 +593,42 @@ void fiberdata_free(FIBERDATA* f) {
 	free(f);
 }
 
+int guide_abi_version(void) {
+	return GUIDE_ABI_VERSION;
+}
+
+/* sizes[] = the sizes of REGION, MASK and FIBERDATA, to check against python's. */
+void guide_struct_sizes(int *sizes) {
+	sizes[0] = sizeof(REGION);
+	sizes[1] = sizeof(MASK);
+	sizes[2] = sizeof(FIBERDATA);
+}
+
+/*
+ * gfindstars() on an image in one buffer, with its rows rowstride elements
+ * apart, so the caller doesn't have to make a REGION of row pointers.
+ */
+int gfindstars_buffer(S16 *data, int nrow, int ncol, int rowstride,
+					  FIBERDATA *ptr, int mode) {
+	REGION reg;
+	int i;
+	int res;
+	S16 **rows = malloc(nrow * sizeof(S16*));
+
+	if (rows == NULL) {
+		return SH_GENERIC_ERROR;
+	}
+	for (i = 0; i < nrow; i++) {
+		rows[i] = data + (size_t)i * rowstride;
+	}
+	reg.nrow = nrow;
+	reg.ncol = ncol;
+	reg.rows_s16 = rows;
+	res = gfindstars(&reg, ptr, mode);
+	free(rows);
+	return res;
+}
+
 
 
 /*********************** FITTING ROUTINES *******************************
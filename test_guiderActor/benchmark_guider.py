@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""
+Repeatable benchmarks of the guider image pipeline, using the frames in data/.
+
+    ./benchmark_guider.py run [-o results.json] [-n 10] [case ...]
+    ./benchmark_guider.py compare old.json new.json [--threshold 0.2]
+
+"run" times each case twice, each time in a new python process:
+    cold: the first call, with nothing imported, cached or allocated yet
+          (and, for analyzeDark and analyzeFlat, no proc- file on disk);
+    warm: the median of n calls, after one untimed call.
+and writes the wall time, CPU time and peak RSS of each to a JSON file.
+
+"compare" lists the changes between two of those files, flagging the
+cases that got slower (or bigger) by more than the threshold, and exits
+with status 1 if there were any.
+"""
+import argparse
+import collections
+import imp
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+darkFile = 'data/gimg-0001.fits.gz'
+flatFile = 'data/gimg-0003.fits.gz'
+dataFile = 'data/gimg-0040.fits.gz'
+movieScript = '../bin/guider_movie.py'
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def proc_name(filename):
+    return os.path.join(os.path.dirname(filename), 'proc-' + os.path.basename(filename))
+
+
+def get_helper():
+    """Return a GuiderTester set up to guide on dataFile with a fake actor."""
+    import guiderTester
+    from actorcore import TestHelper
+
+    helper = guiderTester.GuiderTester()
+    helper.setUp()
+    helper.fakeActor = TestHelper.FakeActor('guider', 'guiderActor')
+    guiderTester.updateModel('mcp', TestHelper.mcpState['science'])
+    helper.actorState.bypassDark = False
+    helper.gState.cmd = helper.cmd
+    return helper
+
+
+def make_calibrations():
+    """Make sure the processed dark and flat are on disk, without caching them in this process."""
+    from guiderActor.gimg import guiderImage
+    if os.path.exists(proc_name(darkFile)) and os.path.exists(proc_name(flatFile)):
+        return
+    helper = get_helper()
+    gi = guiderImage.GuiderImageAnalysis(helper.setPoint_good)
+    gi.analyzeDark(darkFile, cmd=helper.cmd)
+    gi.analyzeFlat(flatFile, helper.gState.gprobes, cmd=helper.cmd)
+
+
+def find_stars(helper):
+    return helper.gi(helper.cmd, dataFile, helper.gState.gprobes, helper.setPoint_good)
+
+
+def get_frameInfo(helper):
+    from guiderActor import GuiderState
+    return GuiderState.FrameInfo(helper.gi.frameNo, 1, 1, 1)
+
+
+# Each case sets up what it needs and returns the function to time.
+# cold is True if the case is being timed in its cold variant.
+
+def case_analyzeDark(cold):
+    if cold and os.path.exists(proc_name(darkFile)):
+        os.remove(proc_name(darkFile))
+    helper = get_helper()
+
+    def analyzeDark():
+        # so we go through the calibration cache when warm.
+        helper.gi.currentDarkName = ''
+        helper.gi.analyzeDark(darkFile, cmd=helper.cmd)
+    return analyzeDark
+
+
+def case_analyzeFlat(cold):
+    if cold and os.path.exists(proc_name(flatFile)):
+        os.remove(proc_name(flatFile))
+    helper = get_helper()
+
+    def analyzeFlat():
+        helper.gi.currentFlatName = ''
+        helper.gi.analyzeFlat(flatFile, helper.gState.gprobes, cmd=helper.cmd)
+    return analyzeFlat
+
+
+def case_findStars(cold):
+    make_calibrations()
+    helper = get_helper()
+    return lambda: find_stars(helper)
+
+
+def case_getStampHDUs(cold):
+    make_calibrations()
+    helper = get_helper()
+    gi = helper.gi
+    find_stars(helper)
+    image, mask = gi.getFullImage()
+    bg = np.median(image[mask == 0])
+    smalls = [f for f in gi.fibers if not f.is_fake() and f.radius < gi.bigFiberRadius]
+    bigs = [f for f in gi.fibers if not f.is_fake() and f.radius >= gi.bigFiberRadius]
+
+    def getStampHDUs():
+        gi.getStampHDUs(smalls, bg, image, mask)
+        gi.getStampHDUs(bigs, bg, image, mask)
+    return getStampHDUs
+
+
+def case_writeFITS(cold):
+    make_calibrations()
+    helper = get_helper()
+    find_stars(helper)
+    frameInfo = get_frameInfo(helper)
+
+    def writeFITS():
+        helper.gi.writeFITS(helper.actorState.models, helper.cmd, frameInfo,
+                            helper.gState.gprobes)
+        os.remove(proc_name(dataFile))
+    return writeFITS
+
+
+def case_guideStep(cold):
+    from guiderActor import masterThread
+    make_calibrations()
+    helper = get_helper()
+
+    def guideStep():
+        masterThread.guideStep(helper.fakeActor, None, helper.cmd, helper.gState, dataFile,
+                               False, helper.gi)
+        os.remove(proc_name(dataFile))
+    return guideStep
+
+
+def case_ImageMaker(cold):
+    make_calibrations()
+    helper = get_helper()
+    find_stars(helper)
+    helper.gi.writeFITS(helper.actorState.models, helper.cmd, get_frameInfo(helper),
+                        helper.gState.gprobes)
+    procFile = proc_name(dataFile)
+    guider_movie = imp.load_source('guider_movie', movieScript)
+    outDir = tempfile.mkdtemp()
+
+    def ImageMaker():
+        try:
+            guider_movie.ImageMaker(procFile)(os.path.join(outDir, 'guider.png'))
+        finally:
+            shutil.rmtree(outDir, ignore_errors=True)
+            os.mkdir(outDir)
+    return ImageMaker
+
+
+# in pipeline order, which is the order they are run in.
+CASES = collections.OrderedDict(
+    (name, globals()['case_' + name]) for name in
+    ('analyzeDark', 'analyzeFlat', 'findStars', 'getStampHDUs', 'writeFITS', 'guideStep',
+     'ImageMaker'))
+VARIANTS = ('cold', 'warm')
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_case(name, variant, repeats):
+    """Time one variant of one case in this process, and return its results."""
+    from guiderActor.stageTimer import monotonic
+
+    cold = variant == 'cold'
+    func = CASES[name](cold)
+    if cold:
+        repeats = 1
+    else:
+        func()
+
+    walls = []
+    cpus = []
+    for i in range(repeats):
+        wall0, cpu0 = monotonic(), cpu_time()
+        func()
+        walls.append(monotonic() - wall0)
+        cpus.append(cpu_time() - cpu0)
+    # ru_maxrss is in kilobytes on linux.
+    peakMB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return {'wall': float(np.median(walls)), 'cpu': float(np.median(cpus)),
+            'peakMB': peakMB, 'n': repeats}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=testDir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Run the cases, each in a new process, and write the results to args.output."""
+    names = args.cases or CASES.keys()
+    for name in names:
+        if name not in CASES:
+            sys.exit('unknown case %r: choose from %s' % (name, ', '.join(CASES)))
+
+    results = collections.OrderedDict()
+    for name in names:
+        for variant in VARIANTS:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '_case', name, variant,
+                 str(args.repeats)], cwd=testDir)
+            result = json.loads(output.splitlines()[-1])
+            results['%s/%s' % (name, variant)] = result
+            print '%-20s %-5s wall %9.1f ms  cpu %9.1f ms  peak %7.1f MB' % (
+                name, variant, 1e3 * result['wall'], 1e3 * result['cpu'], result['peakMB'])
+
+    meta = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': socket.gethostname(),
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'revision': git_revision(),
+            'repeats': args.repeats}
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    print 'wrote', args.output
+
+
+def compare_results(old, new, threshold=0.2, minTime=1e-3, minMB=1.):
+    """
+    Return [(case, old wall, new wall, relative change, flags)] for the cases
+    in both old and new results dicts. flags lists the metrics that got worse
+    by more than threshold (and by more than minTime seconds or minMB MB).
+    """
+    rows = []
+    for case in old:
+        if case not in new:
+            continue
+        flags = []
+        for metric, minDiff in (('wall', minTime), ('cpu', minTime), ('peakMB', minMB)):
+            before, after = old[case][metric], new[case][metric]
+            if after > before * (1 + threshold) and after - before > minDiff:
+                flags.append(metric)
+        before, after = old[case]['wall'], new[case]['wall']
+        change = (after - before) / before if before > 0 else np.nan
+        rows.append((case, before, after, change, flags))
+    return rows
+
+
+def compare(args):
+    """Print the differences between two results files, and exit 1 if anything regressed."""
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print 'old: %(revision)s %(date)s on %(host)s' % old['meta']
+    print 'new: %(revision)s %(date)s on %(host)s' % new['meta']
+
+    rows = compare_results(old['results'], new['results'], threshold=args.threshold)
+    nRegressed = 0
+    for case, before, after, change, flags in rows:
+        flag = ''
+        if flags:
+            flag = 'REGRESSION (%s)' % ', '.join(flags)
+            nRegressed += 1
+        print '%-26s %9.1f ms -> %9.1f ms  %+7.1f%%  %s' % (case, 1e3 * before, 1e3 * after,
+                                                           100 * change, flag)
+    for case in set(old['results']).symmetric_difference(new['results']):
+        print '%-26s only in %s' % (case, args.old if case in old['results'] else args.new)
+    if nRegressed:
+        print '%d case(s) regressed by more than %g%%' % (nRegressed, 100 * args.threshold)
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    runParser = subparsers.add_parser('run', help='run the benchmarks')
+    runParser.add_argument('cases', nargs='*', help='cases to run (default: all): %s' %
+                           ', '.join(CASES))
+    runParser.add_argument('-o', '--output', default='benchmark_results.json',
+                           help='results file to write (default: %(default)s)')
+    runParser.add_argument('-n', '--repeats', type=int, default=10,
+                           help='number of timed calls for the warm variant')
+    runParser.set_defaults(func=run)
+
+    compareParser = subparsers.add_parser('compare', help='compare two results files')
+    compareParser.add_argument('old')
+    compareParser.add_argument('new')
+    compareParser.add_argument('--threshold', type=float, default=0.2,
+                               help='fractional slowdown to flag (default: %(default)s)')
+    compareParser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    if hasattr(args, 'output'):
+        args.output = os.path.abspath(args.output)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['_case']:
+        # one case, in its own process (see run()): print its results as the last line.
+        name, variant, repeats = sys.argv[2], sys.argv[3], int(sys.argv[4])
+        print json.dumps(run_case(name, variant, repeats))
+    else:
+        main()
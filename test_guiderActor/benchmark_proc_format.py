@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Compare the write time, read time and size of gzipped and tile-compressed proc- files.
+
+Builds the proc- file HDUList for each test frame once, then writes it with
+actorcore's writeFits, as writeFITS() does, and reads it back with pyfits:
+all of its HDUs, and just the fiber table, as STUI and our scripts often do.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import pyfits
+
+import actorcore.utility.fits as actorFits
+import guiderTester
+from guiderActor.gimg import guiderImage
+
+darkFile = 'data/gimg-0001.fits.gz'
+flatFile = 'data/gimg-0003.fits.gz'
+dataFiles = ['data/gimg-0040.fits.gz']
+nRepeats = 10
+
+helper = guiderTester.GuiderTester()
+helper.setUp()
+helper.actorState.bypassDark = False
+helper.gi.analyzeDark(darkFile, cmd=helper.cmd)
+helper.gi.analyzeFlat(flatFile, helper.gState.gprobes, cmd=helper.cmd)
+
+
+def get_hdulist(dataFile):
+    """Process dataFile and return its proc- file HDUList."""
+    helper.gi(helper.cmd, dataFile, helper.gState.gprobes, -40)
+    image, mask = helper.gi.getFullImage()
+    return helper.gi._getProcGimgHDUList(helper.gi.guiderHeader, helper.gState.gprobes,
+                                         helper.gi.fibers, image, mask)
+
+
+def read_all(filename):
+    hdulist = pyfits.open(filename)
+    for hdu in hdulist:
+        hdu.data
+    hdulist.close()
+
+
+def read_table(filename):
+    hdulist = pyfits.open(filename)
+    hdulist[6].data
+    hdulist.close()
+
+
+def mean_time(func, *args):
+    start = time.time()
+    for i in range(nRepeats):
+        func(*args)
+    return (time.time() - start) / nRepeats
+
+
+def benchmark(hdulist, procFormat, quantizeLevel=16):
+    """Return (write, read all, read table) seconds and size in bytes for one format."""
+    outDir = tempfile.mkdtemp()
+    try:
+        doCompress = procFormat == guiderImage.PROC_GZIP
+        filename = 'proc-gimg.fits.gz' if doCompress else 'proc-gimg.fits'
+        if not doCompress:
+            hdulist = guiderImage.tile_compress(hdulist, quantizeLevel)
+        outfile = os.path.join(outDir, filename)
+
+        def write():
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            actorFits.writeFits(helper.cmd, hdulist, outDir, filename,
+                                doCompress=doCompress, checksum=True)
+
+        writeTime = mean_time(write)
+        return (writeTime, mean_time(read_all, outfile), mean_time(read_table, outfile),
+                os.path.getsize(outfile))
+    finally:
+        shutil.rmtree(outDir)
+
+
+print '%-24s %-6s %10s %10s %10s %10s' % ('file', 'format', 'write ms', 'read ms',
+                                          'table ms', 'size kB')
+for dataFile in dataFiles:
+    hdulist = get_hdulist(dataFile)
+    for procFormat in (guiderImage.PROC_GZIP, guiderImage.PROC_TILE):
+        writeTime, readTime, tableTime, size = benchmark(hdulist, procFormat)
+        print '%-24s %-6s %10.1f %10.1f %10.1f %10.1f' % (
+            os.path.basename(dataFile), procFormat, 1e3 * writeTime, 1e3 * readTime,
+            1e3 * tableTime, size / 1024.)
@@ -2,6 +2,8 @@
 """Test the speed of guider image processing."""
 import cProfile
 import os
+import resource
+import time
 
 import guiderActor.myGlobals as myGlobals
 import guiderTester
@@ -45,3 +47,15 @@ prof = cProfile.Profile()
 result = prof.runcall(masterThread.guideStep, actor, None, helper.cmd,
                       helper.gState, dataFile, False, helper.gi)
 prof.dump_stats('guideStep.profile')
+
+
+# Per-frame time, once the dark, flat and work buffers are all in place.
+nFrames = 20
+start = time.time()
+for i in range(nFrames):
+    timeit_helper()
+perFrame = (time.time() - start) / nFrames
+# ru_maxrss is in kilobytes on linux.
+peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+print 'guideStep: %.1f ms/frame over %d frames; peak RSS %.1f MB' % (1e3 * perFrame, nFrames,
+                                                                    peakRSS)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Synthetic raw guider exposures, with known fibers and stars.
+
+The frames in data/ are a handful of real exposures of one cartridge. To see
+how the image analysis scales with the number and size of the fibers, star
+brightness, saturation and frame size, and how well findStars and the fitting
+algorithms recover the offsets, make a SyntheticCartridge and write its dark,
+flat and object frames:
+
+    cart = syntheticGimg.SyntheticCartridge(nGuide=50, size=2048, seed=3)
+    gprobes = cart.gprobes()
+    files = syntheticGimg.write_frames('/tmp/synthetic', cart,
+                                       offsets=[(0.01, -0.005, 0, 0)], flux=2e5)
+
+or from the command line, which also writes the truth as JSON:
+
+    ./syntheticGimg.py /tmp/synthetic --nGuide 50 --size 2048 --frames 10
+
+The frames have the headers, binning, bias, overscan and uint16 pixels of real
+gcamera exposures, so the whole pipeline (analyzeDark, analyzeFlat,
+findStars, guideStep) runs on them unchanged.
+
+Positions are in binned pixels, in the convention of Fiber.xcen/ycen (the
+centre of the first pixel is 0,0). A frame's offset (dRA, dDec, rotation,
+scale) is the displacement of the stars on the plug plate, in mm, degrees and
+as a fraction: each Star's dRA and dDec are what get_fibers_dra_ddec should
+measure for it.
+"""
+import argparse
+import collections
+import json
+import math
+import os
+
+import numpy as np
+import pyfits
+from scipy.special import erf
+
+from guiderActor import GuiderState
+
+# Binned gcamera pixel on the plug plate, in mm ([gcamera] pixelSize * magnification).
+PIXEL_MM = 26e-3
+# Binned gcamera pixel on the sky (GuiderImageAnalysis.pixelscale).
+PIXEL_ARCSEC = 0.428
+# gcamera frames are binned 2x2, except flats.
+BINNING = 2
+# Unbinned overscan columns, which find_bias_level only uses on 1024 pixel wide frames.
+OVERSCAN = 24
+SATURATION = 65535
+DATE_OBS = '2013-10-22 01:04:57.8Z'
+
+Star = collections.namedtuple('Star', 'fiberid x y flux fwhm dRA dDec')
+
+
+class SyntheticCartridge(object):
+    """
+    A cartridge of nAcquire acquisition and nGuide guide fibers, at random
+    non-overlapping positions on a size x size (unbinned) gcamera.
+
+    flatOffset is where the fibers are on the camera (in binned pixels)
+    relative to their platedb.gprobe positions, which _find_fibers_in_flat
+    has to find.
+    """
+
+    def __init__(self, nGuide=14, nAcquire=2, guideRadius=8.5, acquireRadius=28.5,
+                 size=1024, flatOffset=(0., 0.), cartridgeId=11, seed=1):
+        self.size = size
+        self.width = size // BINNING
+        self.flatOffset = flatOffset
+        self.cartridgeId = cartridgeId
+        self.rng = np.random.RandomState(seed)
+
+        self.gprobeKeys = collections.OrderedDict()
+        self.guideInfoKeys = collections.OrderedDict()
+        self.throughput = {}
+        margin = 2 + max(abs(flatOffset[0]), abs(flatOffset[1]))
+        placed = []
+        probes = [(acquireRadius, 'ACQUIRE')] * nAcquire + [(guideRadius, 'GUIDE')] * nGuide
+        for fiberid, (radius, fiberType) in enumerate(probes, 1):
+            low, high = radius + margin, self.width - radius - margin
+            for attempt in range(10000):
+                x, y = self.rng.uniform(low, high, 2)
+                # far enough apart that _find_fibers_in_flat's binary_closing can't join them.
+                if all(math.hypot(x - px, y - py) > radius + pr + 12 for px, py, pr in placed):
+                    break
+            else:
+                raise ValueError('Cannot fit %d fibers in a %d pixel frame.' %
+                                 (len(probes), size))
+            placed.append((x, y, radius))
+            rotation, phi = self.rng.uniform(0, 360, 2)
+            xFocal, yFocal = self.rng.uniform(-300, 300, 2)
+            self.gprobeKeys[fiberid] = [cartridgeId, fiberid, True, x, y, radius, rotation,
+                                        0.0, 0.0, 0.0, fiberType]
+            self.guideInfoKeys[fiberid] = [fiberid, 180 + xFocal / 217.7358,
+                                           30 + yFocal / 217.7358, xFocal, yFocal, phi, 0.0]
+            self.throughput[fiberid] = self.rng.uniform(0.8, 1.0)
+
+    def gprobes(self):
+        """Return a new gprobes dict of GProbes, as loadCartridge would make."""
+        return dict((fiberid, GuiderState.GProbe(fiberid, gprobeKey=self.gprobeKeys[fiberid],
+                                                 guideInfoKey=self.guideInfoKeys[fiberid]))
+                    for fiberid in self.gprobeKeys)
+
+    def fiber_center(self, fiberid):
+        """Return the binned x,y of fiberid's centre on the camera."""
+        key = self.gprobeKeys[fiberid]
+        return key[3] + self.flatOffset[0], key[4] + self.flatOffset[1]
+
+    def stars(self, offset=(0., 0., 0., 0.), flux=1e5, fwhm=1.5, jitter=0.):
+        """
+        Return a Star in each fiber, displaced from its centre by offset
+        (dRA and dDec in mm, rotation in degrees and scale as a fraction),
+        plus a random jitter (pixels rms).
+        """
+        dRA0, dDec0, rotation, scale = offset
+        rotation = math.radians(rotation)
+        stars = []
+        for fiberid, key in self.gprobeKeys.items():
+            xFocal, yFocal, phi = self.guideInfoKeys[fiberid][3:6]
+            dRA = dRA0 + scale * xFocal - rotation * yFocal
+            dDec = dDec0 + scale * yFocal + rotation * xFocal
+            # invert get_fibers_dra_ddec's rotation from the camera to the sky.
+            theta = math.radians(90 + key[6] - phi)
+            ct, st = math.cos(theta), math.sin(theta)
+            dx = dRA * ct + dDec * st
+            dy = dRA * st - dDec * ct
+            xcen, ycen = self.fiber_center(fiberid)
+            x = xcen + dx / PIXEL_MM + self.rng.normal(0, jitter)
+            y = ycen + dy / PIXEL_MM + self.rng.normal(0, jitter)
+            stars.append(Star(fiberid, x, y, flux, fwhm, dRA, dDec))
+        return stars
+
+    def _fibers(self, binning):
+        """
+        Yield (fiberid, slices, inside) for each fiber: the slices of an image
+        binned by binning around it, and which of those pixels are in it.
+        """
+        for fiberid in self.gprobeKeys:
+            xcen, ycen = self.fiber_center(fiberid)
+            radius = self.gprobeKeys[fiberid][5] * binning
+            # binned pixel 0 is the mean of pixels 0..binning-1 (cf. _find_fibers_in_flat).
+            xc = binning * xcen + (binning - 1) / 2.
+            yc = binning * ycen + (binning - 1) / 2.
+            y0, x0 = int(max(yc - radius - 1, 0)), int(max(xc - radius - 1, 0))
+            y1, x1 = int(yc + radius + 2), int(xc + radius + 2)
+            slices = (slice(y0, y1), slice(x0, x1))
+            yy, xx = np.mgrid[slices]
+            yield fiberid, slices, (xx - xc)**2 + (yy - yc)**2 <= radius**2
+
+    def _raw(self, signal, bias=1800., readNoise=5.):
+        """Return signal (binned or not) as raw uint16 pixels, with noise, bias and overscan."""
+        height, width = signal.shape
+        raw = np.empty((height, width + OVERSCAN * width // self.size), np.float64)
+        raw[:, :width] = self.rng.poisson(np.clip(signal, 0, None))
+        raw[:, width:] = 0
+        raw += bias + self.rng.normal(0, readNoise, raw.shape)
+        return np.clip(np.round(raw), 0, SATURATION).astype(np.uint16)
+
+    def make_dark(self, exptime=15., stack=9, darkCurrent=0.01, nHot=20):
+        """Return the pixels and header of a binned, stacked dark."""
+        signal = np.full((self.width, self.width), darkCurrent * exptime)
+        hot = self.rng.randint(0, self.width, (2, nHot))
+        signal[hot[1], hot[0]] += self.rng.uniform(10, 100, nHot) * exptime
+        # a median stack of stack frames has less read noise.
+        image = self._raw(signal, readNoise=5. / math.sqrt(stack))
+        return image, make_header('dark', exptime, STACK=stack, EXPTIMEN=stack * exptime)
+
+    def make_flat(self, darkFile, exptime=0.5, level=8000., background=20.):
+        """Return the pixels and header of an unbinned flat, lighting every fiber."""
+        signal = np.full((self.size, self.size), float(background))
+        for fiberid, slices, inside in self._fibers(BINNING):
+            signal[slices][inside] += level * self.throughput[fiberid]
+        image = self._raw(signal)
+        return image, make_header('flat', exptime, DARKFILE=darkFile, FLATCART=self.cartridgeId,
+                                  FF='1 1 1 1', FFS='1 1 1 1 1 1 1 1')
+
+    def make_object(self, stars, darkFile, flatFile, exptime=5., sky=10., darkCurrent=0.01):
+        """Return the pixels and header of a binned exposure of stars (a list of Star)."""
+        signal = np.full((self.width, self.width), darkCurrent * exptime)
+        stars = dict((star.fiberid, star) for star in stars)
+        for fiberid, slices, inside in self._fibers(1):
+            light = np.full(inside.shape, sky * exptime)
+            star = stars.get(fiberid)
+            if star is not None:
+                light += psf(slices, star.x, star.y, star.flux, star.fwhm / PIXEL_ARCSEC)
+            signal[slices][inside] += (light * self.throughput[fiberid])[inside]
+        image = self._raw(signal)
+        return image, make_header('object', exptime, DARKFILE=darkFile, FLATFILE=flatFile,
+                                  FLATCART=self.cartridgeId)
+
+    def truth(self):
+        """Return the cartridge as a JSON-able dict."""
+        return {'size': self.size,
+                'flatOffset': self.flatOffset,
+                'gprobeKeys': self.gprobeKeys,
+                'guideInfoKeys': self.guideInfoKeys,
+                'throughput': self.throughput}
+
+
+def psf(slices, x, y, flux, fwhm):
+    """Return a Gaussian of total flux and fwhm (pixels) at x,y, integrated over the pixels in slices."""
+    sigma = fwhm / (2 * math.sqrt(2 * math.log(2)))
+
+    def integrated(sl, centre):
+        edges = np.arange(sl.start, sl.stop + 1) - 0.5 - centre
+        return np.diff(erf(edges / (math.sqrt(2) * sigma))) / 2
+
+    return flux * np.outer(integrated(slices[0], y), integrated(slices[1], x))
+
+
+def make_header(imageType, exptime, ccdtemp=-40., **cards):
+    """Return a raw gcamera header, with any extra cards."""
+    header = pyfits.Header()
+    header['IMAGETYP'] = imageType
+    header['EXPTIME'] = exptime
+    header['TIMESYS'] = 'TAI'
+    header['DATE-OBS'] = DATE_OBS
+    header['CCDTEMP'] = ccdtemp
+    for name in ('BEGX', 'BEGY'):
+        header[name] = 0
+    for name in ('BINX', 'BINY'):
+        header[name] = 1
+    for name, value in cards.items():
+        header[name] = value
+    # as read from a raw (uint16) gimg file.
+    header['BSCALE'] = 1
+    header['BZERO'] = 32768
+    return header
+
+
+def write_frame(filename, image, header):
+    header['FILENAME'] = filename
+    header['OBJECT'] = os.path.basename(filename).split('.')[0]
+    pyfits.PrimaryHDU(image, header).writeto(filename, clobber=True)
+
+
+def write_frames(directory, cart, offsets=((0., 0., 0., 0.), ), flux=1e5, fwhm=1.5,
+                 jitter=0., exptime=5.):
+    """
+    Write a dark (gimg-0001), a flat (gimg-0002) and an exposure (gimg-0003...)
+    for each of offsets to directory, and return [(filename, stars)] for the exposures.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    directory = os.path.abspath(directory)
+    darkFile = os.path.join(directory, 'gimg-0001.fits.gz')
+    flatFile = os.path.join(directory, 'gimg-0002.fits.gz')
+    write_frame(darkFile, *cart.make_dark())
+    write_frame(flatFile, *cart.make_flat(darkFile))
+    frames = []
+    for i, offset in enumerate(offsets, 3):
+        filename = os.path.join(directory, 'gimg-%04d.fits.gz' % i)
+        stars = cart.stars(offset, flux=flux, fwhm=fwhm, jitter=jitter)
+        write_frame(filename, *cart.make_object(stars, darkFile, flatFile, exptime=exptime))
+        frames.append((filename, stars))
+    return frames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write synthetic guider frames and their truth.')
+    parser.add_argument('directory')
+    parser.add_argument('--nGuide', type=int, default=14)
+    parser.add_argument('--nAcquire', type=int, default=2)
+    parser.add_argument('--guideRadius', type=float, default=8.5, help='binned pixels')
+    parser.add_argument('--acquireRadius', type=float, default=28.5, help='binned pixels')
+    parser.add_argument('--size', type=int, default=1024, help='unbinned pixels')
+    parser.add_argument('--frames', type=int, default=1)
+    parser.add_argument('--drift', type=float, nargs=2, default=(0.005, -0.003),
+                        help='dRA, dDec change per frame, in mm')
+    parser.add_argument('--flux', type=float, default=1e5,
+                        help='star flux in ADU (bright stars saturate)')
+    parser.add_argument('--fwhm', type=float, default=1.5, help='arcsec')
+    parser.add_argument('--jitter', type=float, default=0., help='pixels rms')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    cart = SyntheticCartridge(nGuide=args.nGuide, nAcquire=args.nAcquire,
+                              guideRadius=args.guideRadius, acquireRadius=args.acquireRadius,
+                              size=args.size, seed=args.seed)
+    offsets = [(i * args.drift[0], i * args.drift[1], 0., 0.) for i in range(args.frames)]
+    frames = write_frames(args.directory, cart, offsets, flux=args.flux, fwhm=args.fwhm,
+                          jitter=args.jitter)
+    truth = cart.truth()
+    truth['frames'] = [{'filename': filename, 'offset': offset,
+                        'stars': [star._asdict() for star in stars]}
+                       for (filename, stars), offset in zip(frames, offsets)]
+    truthFile = os.path.join(args.directory, 'truth.json')
+    with open(truthFile, 'w') as f:
+        json.dump(truth, f, indent=1)
+    print 'wrote %d frames and %s' % (len(frames) + 2, truthFile)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ correct queue with the correct parameters.
 If these tests work correctly, each masterThread function should work
 correctly when called via a GuiderCmd (assuming test_masterThread clears).
 """
+import threading
 import unittest
 from Queue import Queue
 
@@ -253,6 +254,56 @@ class TestGuideOnOff(GuiderCmdTester, unittest.TestCase):
         self.assertEqual(msg.type, guiderActor.Msg.STOP_GUIDING)
 
 
+class TestTiming(GuiderCmdTester, unittest.TestCase):
+
+    def _timing(self, args, reset=False):
+        queue = self.queues[guiderActor.MASTER]
+        msg = self._run_cmd('timing %s' % (args), queue)
+        self.assertEqual(msg.type, guiderActor.Msg.TIMING)
+        self.assertEqual(msg.reset, reset)
+
+    def test_timing(self):
+        self._timing('')
+
+    def test_timing_reset(self):
+        self._timing('reset', reset=True)
+
+
+class TestPlugmapCache(GuiderCmdTester, unittest.TestCase):
+
+    def _plugmapCache(self, args, clear=False, plate=None):
+        queue = self.queues[guiderActor.MASTER]
+        msg = self._run_cmd('plugmapCache %s' % (args), queue)
+        self.assertEqual(msg.type, guiderActor.Msg.PLUGMAP_CACHE)
+        self.assertEqual(msg.clear, clear)
+        self.assertEqual(msg.plate, plate)
+
+    def test_plugmapCache(self):
+        self._plugmapCache('')
+
+    def test_plugmapCache_clear(self):
+        self._plugmapCache('clear', clear=True)
+
+    def test_plugmapCache_clear_plate(self):
+        self._plugmapCache('clear plate=6543', clear=True, plate=6543)
+
+
+class TestCall(unittest.TestCase):
+    """The threads loadCartridge uses to query the platedb concurrently."""
+
+    def test_result(self):
+        event = threading.Event()
+        # the first call can only finish once the second one has run.
+        first = GuiderCmd._Call(lambda: event.wait(1) and 'first')
+        second = GuiderCmd._Call(event.set)
+        self.assertIsNone(second.wait())
+        self.assertEqual(first.wait(), 'first')
+
+    def test_exception(self):
+        call = GuiderCmd._Call(int, 'not an int')
+        self.assertRaises(ValueError, call.wait)
+
+
 class TestEcam(GuiderCmdTester, unittest.TestCase):
 
     def _findstar(self, args, expect={}):
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Test the LRU cache of processed calibrations.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from guiderActor.gimg.calibCache import (CalibrationCache, CalibrationProduct,
+                                         CalibrationProducts)
+from guiderActor.gimg.fiberTable import FiberTable
+
+
+class TestCalibrationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        # each value holds exactly 1MB of array data.
+        self.value = (np.zeros(2**20, dtype=np.uint8), 'stuff')
+        self.cache = CalibrationCache(maxMB=2.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def _touch(self, name, mtime=1000):
+        filename = os.path.join(self.tempDir, name)
+        open(filename, 'w').close()
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get(self._touch('a')))
+        self.assertIsNone(self.cache.get(os.path.join(self.tempDir, 'nonexistent')))
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_hit(self):
+        a = self._touch('a')
+        self.cache.put(a, self.value)
+        self.assertIs(self.cache.get(a), self.value)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.nbytes, 2**20)
+        self.assertIn(a, self.cache)
+
+    def test_mtime_changed(self):
+        a = self._touch('a')
+        self.cache.put(a, self.value)
+        self._touch('a', mtime=2000)
+        self.assertIsNone(self.cache.get(a))
+        self.cache.put(a, self.value)
+        # the old version should have been dropped.
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.nbytes, 2**20)
+
+    def test_evict_least_recently_used(self):
+        a, b, c = self._touch('a'), self._touch('b'), self._touch('c')
+        self.cache.put(a, self.value)
+        self.cache.put(b, self.value)
+        self.cache.get(a)
+        self.cache.put(c, self.value)
+        self.assertIn(a, self.cache)
+        self.assertNotIn(b, self.cache)
+        self.assertIn(c, self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.status(), (2, 2.0, 2.5, 1, 0, 1))
+
+    def test_nbytes_fiberTable(self):
+        """A processed flat's FiberTable counts against the budget too."""
+        a = self._touch('a')
+        fibers = FiberTable(1000)
+        self.cache.put(a, self.value + (fibers, ))
+        self.assertEqual(self.cache.nbytes, 2**20 + fibers.data.nbytes)
+
+    def test_too_big(self):
+        a = self._touch('a')
+        self.cache.put(a, (np.zeros(3 * 2**20, dtype=np.uint8),))
+        self.assertNotIn(a, self.cache)
+        self.assertEqual(self.cache.nbytes, 0)
+
+    def test_clear(self):
+        a = self._touch('a')
+        self.cache.put(a, self.value)
+        self.cache.get(a)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.nbytes, 0)
+        self.assertEqual(self.cache.hits, 1)
+
+
+class TestCalibrationProduct(unittest.TestCase):
+
+    def setUp(self):
+        self.dark = np.array([[0.5, 1.0], [0.0, 2.0]], dtype=np.float32)
+        self.flat = np.array([[0.5, 1.0], [0.0, 2.0]], dtype=np.float32)
+        self.mask = np.array([[0, 0], [4, 0]], dtype=np.uint8)
+        self.key = ('dark', 'flat', 5, 2)
+        self.product = CalibrationProduct(self.key, self.dark, self.flat, self.mask, 5)
+
+    def test_apply(self):
+        image = np.full((2, 2), 10, dtype=np.float32)
+        result = self.product.apply(image)
+        self.assertIs(result, image)
+        np.testing.assert_allclose(image, [[15, 5], [10, 0]])
+
+    def test_apply_no_dark(self):
+        product = CalibrationProduct(self.key, None, self.flat, self.mask, 5)
+        image = np.full((2, 2), 10, dtype=np.float32)
+        np.testing.assert_allclose(product.apply(image), [[20, 10], [10, 5]])
+
+    def test_matches(self):
+        self.assertTrue(self.product.matches(self.key, self.dark, self.flat))
+        self.assertFalse(self.product.matches(('dark', 'flat', 10, 2), self.dark, self.flat))
+        self.assertFalse(self.product.matches(self.key, self.dark.copy(), self.flat))
+
+    def test_apply_roi(self):
+        roi, dark, invFlat = self.product.get_roi()
+        np.testing.assert_equal(roi, [0, 1, 3])
+        values = np.full(3, 10, dtype=np.float32)
+        self.product.apply_roi(values)
+        image = self.product.apply(np.full((2, 2), 10, dtype=np.float32))
+        np.testing.assert_allclose(values, image.ravel()[roi])
+
+
+class TestCalibrationProducts(unittest.TestCase):
+
+    def setUp(self):
+        self.dark = np.ones((2, 2), dtype=np.float32)
+        self.flat = np.full((2, 2), 2, dtype=np.float32)
+        self.mask = np.zeros((2, 2), dtype=np.uint8)
+        self.products = CalibrationProducts(maxProducts=2)
+
+    def _get(self, exptime, dark=None):
+        dark = self.dark if dark is None else dark
+        return self.products.get(('dark', 'flat', exptime, 2), dark, self.flat, self.mask,
+                                  exptime)
+
+    def test_exptimes(self):
+        """Alternating between exposure times reuses each one's product."""
+        five, ten = self._get(5), self._get(10)
+        self.assertIsNot(five, ten)
+        np.testing.assert_array_equal(ten.dark, 10)
+        self.assertIs(self._get(5), five)
+        self.assertIs(self._get(10), ten)
+
+    def test_lru(self):
+        five = self._get(5)
+        self._get(10)
+        self._get(5)
+        self._get(15)
+        self.assertEqual(len(self.products), 2)
+        self.assertIs(self._get(5), five)
+        self.assertEqual(len(self.products), 2)
+
+    def test_rebuilt(self):
+        """A product built from a dark that has since been re-read is rebuilt."""
+        five = self._get(5)
+        self.assertIsNot(self._get(5, dark=self.dark.copy()), five)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Test the guider fiber table and its Fiber views.
+"""
+import unittest
+
+import numpy as np
+
+from guiderActor.gimg.fiberTable import Fiber, FiberTable
+
+
+class TestFiberTable(unittest.TestCase):
+
+    def setUp(self):
+        self.gprobes = {1: 'probe 1', 3: 'probe 3', 5: 'probe 5'}
+        self.table = FiberTable.from_columns([5, 1, 3], [10., 20., np.nan], [11., 21., np.nan],
+                                             8.5, gprobes=self.gprobes)
+
+    def test_from_columns(self):
+        self.assertEqual(len(self.table), 3)
+        np.testing.assert_array_equal(self.table.data['fiberid'], [5, 1, 3])
+        np.testing.assert_array_equal(self.table.data['radius'], [8.5] * 3)
+        np.testing.assert_array_equal(self.table.data['label'], [-1] * 3)
+        self.assertTrue(np.isnan(self.table.data['xs']).all())
+        self.assertEqual(self.table.gprobes, ['probe 5', 'probe 1', 'probe 3'])
+        np.testing.assert_array_equal(self.table.fake(), [False, False, True])
+
+    def test_views(self):
+        """Fibers read and write their row of the table."""
+        fiber = self.table[1]
+        self.assertEqual(fiber.fiberid, 1)
+        self.assertEqual(fiber.xcen, 20.)
+        self.assertEqual(fiber.gProbe, 'probe 1')
+        fiber.xs = 3.5
+        fiber.gProbe = 'other'
+        self.assertEqual(self.table.data['xs'][1], 3.5)
+        self.assertEqual(self.table.gprobes[1], 'other')
+        self.assertEqual(self.table[-1].fiberid, 3)
+        self.assertTrue(self.table[2].is_fake())
+        self.assertRaises(IndexError, self.table.__getitem__, 3)
+        self.assertEqual([f.fiberid for f in self.table], [5, 1, 3])
+
+    def test_fiber(self):
+        """A Fiber made on its own has its own table."""
+        fiber = Fiber(7, 1., 2., 3., label=4)
+        self.assertEqual((fiber.fiberid, fiber.xcen, fiber.ycen, fiber.radius, fiber.label),
+                         (7, 1., 2., 3., 4))
+        self.assertTrue(np.isnan(fiber.illrad))
+        self.assertIsNone(fiber.gProbe)
+        self.assertFalse(fiber.is_fake())
+        fiber.set_fake()
+        self.assertTrue(fiber.is_fake())
+        self.assertRaises(AttributeError, setattr, fiber, 'notAColumn', 1)
+
+    def test_take(self):
+        """take() copies, so the original table is left alone."""
+        table = self.table.take(~self.table.fake())
+        np.testing.assert_array_equal(table.data['fiberid'], [5, 1])
+        self.assertEqual(table.gprobes, ['probe 5', 'probe 1'])
+        table[0].flux = 100.
+        self.assertTrue(np.isnan(self.table.data['flux']).all())
+
+    def test_from_fibers(self):
+        fibers = [Fiber(2, 5., 6., 7.), self.table[0]]
+        fibers[1].dRA = 0.5
+        table = FiberTable.from_fibers(fibers)
+        np.testing.assert_array_equal(table.data['fiberid'], [2, 5])
+        np.testing.assert_array_equal(table.data['dRA'], [np.nan, 0.5])
+        self.assertEqual(table.gprobes, [None, 'probe 5'])
+
+    def test_by_fiberid(self):
+        self.table[0].xs = 1.
+        table = self.table.by_fiberid([1, 2, 5])
+        np.testing.assert_array_equal(table.data['fiberid'], [1, 2, 5])
+        np.testing.assert_array_equal(table.data['xcen'], [20., np.nan, 10.])
+        np.testing.assert_array_equal(table.data['xs'], [np.nan, np.nan, 1.])
+        self.assertEqual(table.gprobes, ['probe 1', None, 'probe 5'])
+        self.assertEqual(len(FiberTable().by_fiberid([1, 2])), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
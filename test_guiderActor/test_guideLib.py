@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Test the interface to libguide.so.
+"""
+import unittest
+
+import numpy as np
+
+import syntheticGimg
+from guiderActor.gimg import GuiderExceptions, guideLib
+
+
+class TestGuideLib(unittest.TestCase):
+
+    def setUp(self):
+        self.cart = syntheticGimg.SyntheticCartridge(nGuide=6, nAcquire=0, seed=2)
+        self.stars = self.cart.stars(flux=2e4)
+        image = np.full((512, 512), 50, np.float64)
+        for star in self.stars:
+            image += syntheticGimg.psf((slice(0, 512), slice(0, 512)), star.x, star.y, star.flux,
+                                       star.fwhm / syntheticGimg.PIXEL_ARCSEC)
+        self.image = image.astype(np.int16)
+        fiberids = sorted(self.cart.gprobeKeys)
+        xcen, ycen = zip(*[self.cart.fiber_center(fid) for fid in fiberids])
+        radius = [self.cart.gprobeKeys[fid][5] for fid in fiberids]
+        self.fiberData = guideLib.FiberData(fiberids, xcen, ycen, radius, radius)
+
+    def test_load_once(self):
+        self.assertIs(guideLib.load(), guideLib.load())
+
+    def test_bad_abi(self):
+        abi = guideLib.ABI_VERSION
+        guideLib.ABI_VERSION = abi + 1
+        self.addCleanup(setattr, guideLib, 'ABI_VERSION', abi)
+        self.assertRaises(GuiderExceptions.LibguideError, guideLib._load,
+                          guideLib.default_path())
+
+    def test_find_stars(self):
+        res = guideLib.find_stars(self.image, self.fiberData)
+        self.assertEqual(np.uint32(res), np.uint32(guideLib.SH_SUCCESS))
+        for star in self.stars:
+            i = list(self.fiberData.fiberid).index(star.fiberid)
+            self.assertAlmostEqual(self.fiberData.xs[i], star.x, delta=0.1)
+            self.assertAlmostEqual(self.fiberData.ys[i], star.y, delta=0.1)
+
+    def test_find_stars_region(self):
+        """The buffer interface should give exactly what gfindstars() gives with a REGION."""
+        libguide = guideLib.load()
+        n = len(self.fiberData)
+        c_fibers = libguide.fiberdata_new(n)
+        for i in range(n):
+            c_fibers[0].g_fid[i] = self.fiberData.fiberid[i]
+            c_fibers[0].g_xcen[i] = self.fiberData.xcen[i]
+            c_fibers[0].g_ycen[i] = self.fiberData.ycen[i]
+            c_fibers[0].g_fibrad[i] = self.fiberData.fibrad[i]
+            c_fibers[0].g_illrad[i] = self.fiberData.illrad[i]
+        expected = libguide.gfindstars(guideLib.np_array_to_REGION(self.image.copy()), c_fibers, 1)
+        res = guideLib.find_stars(self.image.copy(), self.fiberData)
+        self.assertEqual(res, expected)
+        for name in ('g_xs', 'g_ys', 'flux', 'sky', 'fwhm', 'poserr'):
+            array = getattr(self.fiberData, name.replace('g_', ''))
+            self.assertEqual(list(array), getattr(c_fibers[0], name)[:n])
+        libguide.fiberdata_free(c_fibers)
+
+    def test_find_stars_padded(self):
+        """Rows that aren't next to each other in memory work like a contiguous copy."""
+        expected = guideLib.find_stars(self.image, self.fiberData)
+        xs = self.fiberData.xs.copy()
+        padded = np.zeros((512, 600), np.int16)
+        padded[:, :512] = self.image
+        self.assertEqual(guideLib.find_stars(padded[:, :512], self.fiberData), expected)
+        np.testing.assert_array_equal(self.fiberData.xs, xs)
+
+    def test_bad_image(self):
+        self.assertRaises(ValueError, guideLib.find_stars, self.image.astype(np.float32),
+                          self.fiberData)
+        wide = np.zeros((512, 1024), np.int16)
+        self.assertRaises(ValueError, guideLib.find_stars, wide[:, ::2], self.fiberData)
+
+
+if __name__ == '__main__':
+    unittest.main()
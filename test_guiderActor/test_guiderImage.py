@@ -5,12 +5,15 @@ Test the behavior of guider flats, including finding fibers..
 import os
 import unittest
 
+import numpy as np
 import pyfits
 
 import guiderTester
+import syntheticGimg
 from actorcore import TestHelper
-from guiderActor import GuiderState
-from guiderActor.gimg import GuiderExceptions
+from guiderActor import GuiderState, writerThread
+from guiderActor.gimg import GuiderExceptions, guideLib, guiderImage
+from guiderActor.gimg.guiderFrame import GuiderFrame
 
 
 class TestGuiderImage(guiderTester.GuiderTester, unittest.TestCase):
@@ -60,6 +63,18 @@ class TestGuiderImage(guiderTester.GuiderTester, unittest.TestCase):
         self.assertTrue(os.path.exists(outFile), 'analyzeDark file write')
         self._check_overwriting(inFile, outFile, self.gi.analyzeDark)
 
+    def test_analyzeDark_cached(self):
+        """A second analyzeDark() of the same dark should come from the calibration cache."""
+        inFile = self.path(self.inDarkFile)
+        self.gi.analyzeDark(inFile, cmd=self.cmd)
+        dark = self.gi.processedDark
+        self.gi.currentDarkName = ''
+        self.gi.analyzeDark(inFile, cmd=self.cmd)
+        self.assertIs(self.gi.processedDark, dark)
+        self.assertEqual(self.gi.currentDarkName, inFile)
+        self.assertEqual(self.gi.calibCache.hits, 1)
+        self._remove_file(self.path(self.outDarkFile))
+
     def test_analyzeFlat(self):
         """Test GuiderImageAnalysis.analyzeFlat()"""
         inFile = self.path(self.inFlatFile)
@@ -73,6 +88,48 @@ class TestGuiderImage(guiderTester.GuiderTester, unittest.TestCase):
         self._check_overwriting(inFile, outFile, self.gi.analyzeFlat,
                                 [self.gState.gprobes])
 
+    def test_analyzeFlat_writer(self):
+        """With a writer, a new flat is used straight away and written in the background."""
+        inFile = self.path(self.inFlatFile)
+        outFile = self.path(self.outFlatFile)
+        self.gi.writer = writerThread.ProcFileWriter()
+        self.addCleanup(self.gi.writer.stop)
+        self.gi.analyzeFlat(inFile, self.gState.gprobes, cmd=self.cmd)
+        self.assertEqual(self.gi.currentFlatName, inFile)
+        self.gi.flush()
+        flat, mask, fibers = self.gi.readProcessedFlat(outFile, self.gState.gprobes)
+        np.testing.assert_array_equal(flat, self.gi.flatImage)
+        np.testing.assert_array_equal(mask, self.gi.flatMask)
+        # the fibers that weren't found have NaN centers, which assert_array_equal matches.
+        for name in ('fiberid', 'xcen', 'ycen'):
+            np.testing.assert_array_equal([getattr(f, name) for f in fibers],
+                                          [getattr(f, name) for f in self.gi.flatFibers])
+        # it is cached once it has been written, as the version that was written.
+        self.assertIn(outFile, self.gi.calibCache)
+        self._remove_file(outFile)
+
+    def test_find_fibers_synthetic(self):
+        """Find the fibers in a synthetic flat, and normalize it by its guide fibers."""
+        cart = syntheticGimg.SyntheticCartridge(nGuide=14, nAcquire=2, flatOffset=(3, -2))
+        image, header = cart.make_flat(self.path(self.inDarkFile))
+        frame = GuiderFrame('gimg-0002.fits', image, header)
+        self.gi.cmd = self.cmd
+        image, hdr, sat = self.gi._pre_process(frame, binning=1)
+        hdulist, gprobes = self.gi._find_fibers_in_flat(image, frame.filename, cart.gprobes(),
+                                                        hdr)
+        flat = hdulist[0].data
+        self.assertTrue(np.isfinite(flat).all())
+        table = hdulist[6].data
+        guideThroughput = np.median([cart.throughput[k] for k, key in cart.gprobeKeys.items()
+                                     if key[10] == 'GUIDE'])
+        for fiberid, x, y in zip(table.field('fiberid'), table.field('xcenter'),
+                                 table.field('ycenter')):
+            xcen, ycen = cart.fiber_center(fiberid)
+            self.assertAlmostEqual(x, xcen, delta=0.1)
+            self.assertAlmostEqual(y, ycen, delta=0.1)
+            self.assertAlmostEqual(flat[int(round(y)), int(round(x))],
+                                   cart.throughput[fiberid] / guideThroughput, delta=0.02)
+
     def test_analyzeFlat_ecam(self):
         """Test GuiderImageAnalysis.analyzeFlat()"""
         inFile = self.path(self.inFlatEcamFile)
@@ -93,6 +150,39 @@ class TestGuiderImage(guiderTester.GuiderTester, unittest.TestCase):
             self.assertEqual(i, fibers[i].fiberid - 1)
         self.assertFalse(True, 'make a test!')
 
+    def test_call_frame(self):
+        """Test that __call__() on a GuiderFrame matches the filename, without changing the frame."""
+        fibers = self._call_gi(self.path(self.inDataFile))
+        expect = [(f.fiberid, f.xs, f.ys, f.flux) for f in fibers]
+        frame = GuiderFrame.read(self.path(self.inDataFile))
+        raw = frame.image.copy()
+        frameFibers = self._call_gi(frame)
+        self.assertEqual(self.gi.frameNo, 40)
+        self.assertIs(self.gi.frame, frame)
+        self.assertTrue((frame.image == raw).all(), 'frame pixels were modified')
+        np.testing.assert_equal([(f.fiberid, f.xs, f.ys, f.flux) for f in frameFibers], expect)
+
+    def test_call_sparse(self):
+        """Sparse processing should find the same stars and write the same full image."""
+        fibers = self._call_gi(self.path(self.inDataFile))
+        expect = [(f.fiberid, f.xs, f.ys, f.flux) for f in fibers]
+        image, mask = self.gi.guiderImage.copy(), self.gi.maskImage.copy()
+        self.gi.sparse = True
+        fibers = self._call_gi(self.path(self.inDataFile))
+        self.assertIsNone(self.gi.guiderImage)
+        np.testing.assert_equal([(f.fiberid, f.xs, f.ys, f.flux) for f in fibers], expect)
+        sparseImage, sparseMask = self.gi.getFullImage()
+        np.testing.assert_array_equal(sparseImage, image)
+        np.testing.assert_array_equal(sparseMask, mask)
+
+    def test_find_bias_level_no_overscan(self):
+        """Without an overscan, the bias is the 30th percentile pixel value."""
+        image = np.random.RandomState(1).rand(100, 100).astype(np.float32)
+        self.gi.cmd = self.cmd
+        self.gi.find_bias_level(image)
+        self.assertEqual(self.gi.imageBias, np.sort(image.ravel())[3000])
+        self.assertEqual(self.cmd.levels.count('w'), 1)
+
     def test_findStars_ecam(self):
         self.assertFalse(True, "make some tests for this!")
 
@@ -172,6 +262,135 @@ class TestGuiderImage(guiderTester.GuiderTester, unittest.TestCase):
                                frameInfo, objectname)
         self.assertEqual(hdu.header['MGDPOS'], 'N')
 
+    def test_tile_compress(self):
+        """Tile-compressed proc- files keep the same HDU layout, integer data and mask dtype."""
+        image = pyfits.getdata(self.path(self.inDataFile)).astype(np.float32)
+        mask = np.zeros(image.shape, dtype=np.uint8)
+        mask[10:20] = self.gi.mask_masked
+        hdulist = pyfits.HDUList([pyfits.PrimaryHDU(image),
+                                  pyfits.ImageHDU(mask),
+                                  pyfits.ImageHDU(np.array([[]]).astype(np.int16))])
+        hdulist[0].header['SDSSFMT'] = 'GPROC 1 4'
+        outFile = self.path('proc-tile-test.fits')
+        guiderImage.tile_compress(hdulist).writeto(outFile, checksum=True)
+        try:
+            result = pyfits.open(outFile)
+            self.assertEqual(len(result), 3)
+            self.assertEqual(result[0].header['SDSSFMT'], 'GPROC 1 4')
+            np.testing.assert_array_equal(result[0].data, image)
+            np.testing.assert_array_equal(result[1].data, mask)
+            self.assertEqual(result[1].data.dtype, np.uint8)
+            self.assertNotIsInstance(result[1], pyfits.CompImageHDU)
+            self.assertEqual(result[2].data.size, 0)
+        finally:
+            self._remove_file(outFile)
+
+
+class TestMatchFibers(unittest.TestCase):
+    """Test matching the fibers found in a flat to the probe positions."""
+
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        self.probeXY = rng.uniform(50, 450, (16, 2))
+        # the fibers are shifted, in a different order, with some spurious blobs.
+        self.order = rng.permutation(16)
+        self.fiberXY = np.vstack((self.probeXY[self.order] + (4.2, -3.1),
+                                  rng.uniform(0, 500, (3, 2))))
+        self.fiberRadius = np.full(len(self.fiberXY), 8.5)
+
+    def _check(self, result, nMatched=16):
+        dx, dy, matches = result
+        self.assertAlmostEqual(dx, 4.2)
+        self.assertAlmostEqual(dy, -3.1)
+        self.assertEqual(len(matches), nMatched)
+        for fiber, probe in matches:
+            self.assertEqual(self.order[fiber], probe)
+
+    def test_match(self):
+        self._check(guiderImage.match_fibers(self.fiberXY, self.fiberRadius, self.probeXY,
+                                             512, 512))
+
+    def test_missing_fibers(self):
+        fiberXY = self.fiberXY[3:]
+        result = guiderImage.match_fibers(fiberXY, self.fiberRadius[3:], self.probeXY, 512, 512)
+        dx, dy, matches = result
+        self.assertEqual(len(matches), 13)
+        for fiber, probe in matches:
+            self.assertEqual(self.order[fiber + 3], probe)
+
+    def test_prior(self):
+        self._check(guiderImage.match_fibers(self.fiberXY, self.fiberRadius, self.probeXY,
+                                             512, 512, prior=(4, -3)))
+
+    def test_bad_prior(self):
+        """A prior that doesn't match everything is ignored."""
+        self._check(guiderImage.match_fibers(self.fiberXY, self.fiberRadius, self.probeXY,
+                                             512, 512, prior=(-40, 20)))
+
+    def test_small_chunks(self):
+        self._check(guiderImage.match_fibers(self.fiberXY, self.fiberRadius, self.probeXY,
+                                             512, 512, maxPoints=10))
+
+    def test_no_match(self):
+        """Probes that can't all fit on the image can't be matched."""
+        self.assertIsNone(guiderImage.match_fibers(self.fiberXY, self.fiberRadius,
+                                                   self.probeXY, 100, 100))
+
+
+class TestStampRemap(unittest.TestCase):
+    """Test that the remapped stamps match libguide's rotate_region and rotate_mask."""
+
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        self.image = rng.uniform(-100, 40000, (200, 200)).astype(np.float32)
+        self.mask = (rng.randint(0, 8, (200, 200)) * (rng.rand(200, 200) < 0.3)).astype(np.uint8)
+        self.gi = guiderImage.GuiderImageAnalysis(None)
+        self.gi.ensureLibraryLoaded()
+
+    def _rotate(self, stamp, rot, toC, rotate):
+        rstamp = np.zeros_like(stamp)
+        rotate(toC(stamp), toC(rstamp), rot)
+        return np.flipud(rstamp)
+
+    def test_rotations(self):
+        r = 9
+        fibers = []
+        for i, rot in enumerate((0., 45., -90., 137.3, 180., -271.9)):
+            fiber = guiderImage.Fiber(i + 1, 30.4 + 25 * i, 100.6 + 10 * i, 8.5)
+            fiber.gProbe = GuiderState.GProbe(i + 1)
+            fiber.gProbe.rotStar2Sky = -rot
+            fibers.append(fiber)
+        stamps, maskstamps = guiderImage.StampRemap(fibers, r, self.image.shape)(self.image,
+                                                                                 self.mask)
+        for i, fiber in enumerate(fibers):
+            xc, yc = int(fiber.xcen + 0.5), int(fiber.ycen + 0.5)
+            rot = -fiber.gProbe.rotStar2Sky
+            stamp = self.image[yc - r:yc + r + 1, xc - r:xc + r + 1].astype(np.int16)
+            expected = self._rotate(stamp, rot, guideLib.np_array_to_REGION,
+                                    self.gi.libguide.rotate_region)
+            np.testing.assert_array_equal(stamps[i * 19:(i + 1) * 19], expected)
+
+            stamp = self.mask[yc - r:yc + r + 1, xc - r:xc + r + 1].copy()
+            stamp[stamp == 0] = 255
+            expected = self._rotate(stamp, rot, guideLib.np_array_to_MASK,
+                                    self.gi.libguide.rotate_mask)
+            expected[expected == 0] = guiderImage.GuiderImageAnalysis.mask_masked
+            expected[expected == 255] = 0
+            np.testing.assert_array_equal(maskstamps[i * 19:(i + 1) * 19], expected)
+
+    def test_no_rotation_yet(self):
+        """Fibers whose rotStar2Sky isn't set yet (e.g. in a flat) get unrotated stamps."""
+        fiber = guiderImage.Fiber(1, 50.2, 60.7, 8.5)
+        fiber.gProbe = GuiderState.GProbe(1)
+        fiber.gProbe.rotStar2Sky = np.nan
+        stamps, maskstamps = guiderImage.StampRemap([fiber], 9, self.image.shape)(self.image,
+                                                                                  self.mask)
+        # the last row and column (the first row, once flipped) are outside the stamp.
+        np.testing.assert_array_equal(stamps[1:, :-1],
+                                      np.flipud(self.image[52:70, 41:59].astype(np.int16)))
+        np.testing.assert_array_equal(maskstamps[1:, :-1], np.flipud(self.mask[52:70, 41:59]))
+        self.assertTrue((stamps[0] == 0).all())
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -2,6 +2,8 @@
 """
 Test the GuiderState module using unittest.
 """
+import os
+import tempfile
 import unittest
 
 import numpy as np
@@ -88,6 +90,31 @@ class TestGuiderState(guiderTester.GuiderTester, unittest.TestCase):
             else:
                 self.assertFalse(value, name)
 
+    def test_table_masks(self):
+        """The table's masks should agree with each probe's flags."""
+        probes = self.gState.gprobes
+        for name in ('exists', 'enabled', 'good', 'atFocus', 'tooFaint'):
+            mask = getattr(probes, name)()
+            for row, probe in enumerate(probes.values()):
+                self.assertEqual(mask[row], getattr(probe, name), (name, probe.id))
+
+    def test_ref_mag(self):
+        """ref_mag set for all probes at once should be as set for each."""
+        probe = GuiderState.GProbe(1)
+        probe.ugriz = ugriz
+        probes = self.gState.gprobes
+        probes.set_ugriz(np.arange(len(probes)), [ugriz] * len(probes))
+        np.testing.assert_array_equal(probes.data['ref_mag'], [probe.ref_mag] * len(probes))
+        np.testing.assert_array_equal(probes[1].ugriz, ugriz)
+
+    def test_setGprobeState_type(self):
+        self.gState.setGprobeState('GUIDE', enable=False)
+        for name in gprobeKey:
+            probe = self.gState.gprobes[gprobeKey[name][1]]
+            if probe.fiber_type == 'GUIDE':
+                self.assertTrue(probe.disabled, name)
+        self.assertTrue(self.gState.gprobes[2].enabled)
+
     def _setDecenter(self, decenters, enable=None, new=True):
         decenters = {'decenterRA': 1, 'decenterDec': 2}
         self.gState.setDecenter(decenters, self.cmd, enable)
@@ -229,5 +256,239 @@ class TestGuiderState(guiderTester.GuiderTester, unittest.TestCase):
         self._check_cmd(0, 4, 0, 0, False)
 
 
+class TestGProbeTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = GuiderState.GProbeTable()
+        self.probes = {}
+        for k, v in gprobeKey.items():
+            self.probes[v[1]] = GuiderState.GProbe(gprobeKey=v)
+            self.table[v[1]] = self.probes[v[1]]
+
+    def test_dict(self):
+        self.assertEqual(sorted(self.table.keys()), sorted(self.probes))
+        self.assertEqual(len(self.table), len(self.probes))
+        self.assertIn(4, self.table)
+        self.assertNotIn(99, self.table)
+        self.assertIsNone(self.table.get(99))
+        self.assertRaises(KeyError, self.table.__getitem__, 99)
+        self.assertEqual(self.table[4].focusOffset, -400)
+        self.assertEqual(self.table[3].fiber_type, 'TRITIUM')
+
+    def test_setitem_views(self):
+        """A GProbe put in the table becomes a view of its row."""
+        probe = self.probes[1]
+        self.assertIs(probe.table, self.table)
+        probe.disabled = True
+        self.assertTrue(self.table[1].disabled)
+        self.assertFalse(self.table.enabled()[self.table.rows([1])[0]])
+        self.table[1] = GuiderState.GProbe(gprobeKey=gprobeKey['good'])
+        self.assertEqual(len(self.table), len(self.probes))
+        self.assertTrue(self.table[1].enabled)
+
+    def test_rows(self):
+        rows = self.table.rows([5, 99, 1])
+        self.assertEqual(rows[1], -1)
+        np.testing.assert_array_equal(self.table.data['id'][rows[[0, 2]]], [5, 1])
+        self.assertEqual(len(GuiderState.GProbeTable().rows([1, 2])), 2)
+
+    def test_rows_index(self):
+        """The id index is reused between lookups, and rebuilt when the ids change."""
+        self.table.rows([1])
+        index = self.table._index
+        self.table.rows([2])
+        self.assertIs(self.table._index, index)
+        self.table[99] = GuiderState.GProbe(gprobeKey=gprobeKey['good'])
+        self.assertEqual(self.table.rows([99])[0], len(self.table) - 1)
+        self.table[99].id = 98
+        self.assertEqual(self.table.rows([99, 98])[0], -1)
+        self.assertEqual(self.table.rows([98])[0], len(self.table) - 1)
+        table = self.table.copy()
+        table.data = table.data[:1]
+        self.assertEqual(table.rows([table.data['id'][0], 98])[1], -1)
+
+    def test_set_bit(self):
+        rows = self.table.rows([1, 2])
+        self.table.set_bit(rows, GuiderState.TOOFAINT, [True, False])
+        self.assertTrue(self.probes[1].tooFaint)
+        self.assertFalse(self.probes[2].tooFaint)
+        self.table.set_bit(rows, GuiderState.TOOFAINT, False)
+        self.assertFalse(self.table.tooFaint().any())
+
+    def test_from_probes(self):
+        table = GuiderState.GProbeTable.from_probes([self.probes[6], None])
+        np.testing.assert_array_equal(table.data['id'], [6, -9999])
+        np.testing.assert_array_equal(table.exists(), [False, False])
+        self.assertEqual(table.data['bits'][1], GuiderState.UNKNOWN)
+        self.assertIs(self.probes[6].table, self.table)
+
+    def test_copy(self):
+        """A copy's probes can be changed without changing the original's."""
+        self.probes[1].haXOffsets[16600] = np.zeros(3)
+        table = self.table.copy()
+        self.assertEqual(table.data.tostring(), self.table.data.tostring())
+        table[1].disabled = True
+        table[1].haXOffsets[5400] = np.ones(3)
+        self.assertFalse(self.table[1].disabled)
+        self.assertNotIn(5400, self.table[1].haXOffsets)
+        self.assertIn(16600, table[1].haXOffsets)
+
+    def test_probe_on_its_own(self):
+        probe = GuiderState.GProbe(7)
+        self.assertEqual(probe.id, 7)
+        self.assertTrue(probe.good)
+        self.assertTrue(np.isnan(probe.phi))
+        self.assertRaises(AttributeError, setattr, probe, 'notAColumn', 1)
+
+
+class TestRefractionTable(unittest.TestCase):
+
+    def setUp(self):
+        self.gprobes = {}
+        for k, v in gprobeKey.items():
+            self.gprobes[v[1]] = GuiderState.GProbe(gprobeKey=v)
+        # probe 1 has 3 points, probe 2 has 5, probe 3 has none.
+        self.gprobes[1].haOffsetTimes[16600] = np.array([-30., 0., 30.])
+        self.gprobes[1].haXOffsets[16600] = np.array([0.01, 0., 0.02])
+        self.gprobes[1].haYOffsets[16600] = np.array([-0.01, 0., 0.01])
+        self.gprobes[2].haOffsetTimes[16600] = np.linspace(-60, 60, 5)
+        self.gprobes[2].haXOffsets[16600] = np.linspace(-0.1, 0.1, 5)
+        self.gprobes[2].haYOffsets[16600] = np.zeros(5)
+        self.table = GuiderState.RefractionTable(self.gprobes)
+
+    def _check_interpolate(self, dHA, ids=(1, 2, 3)):
+        """interpolate() should match numpy.interp on each probe's own table."""
+        haTime, xOffset, yOffset, found = self.table.interpolate(16600, ids, dHA)
+        for k, id in enumerate(ids):
+            gProbe = self.gprobes[id]
+            self.assertEqual(found[k], 16600 in gProbe.haOffsetTimes)
+            if not found[k]:
+                self.assertEqual((haTime[k], xOffset[k], yOffset[k]), (0, 0, 0))
+                continue
+            times = gProbe.haOffsetTimes[16600]
+            self.assertEqual(haTime[k], min(max(dHA, times[0]), times[-1]))
+            self.assertEqual(xOffset[k], np.interp(haTime[k], times, gProbe.haXOffsets[16600]))
+            self.assertEqual(yOffset[k], np.interp(haTime[k], times, gProbe.haYOffsets[16600]))
+
+    def test_interpolate(self):
+        self._check_interpolate(10.)
+
+    def test_interpolate_on_grid(self):
+        self._check_interpolate(30.)
+        self._check_interpolate(-30.)
+
+    def test_interpolate_clamped(self):
+        self._check_interpolate(-100.)
+        self._check_interpolate(45.)
+
+    def test_interpolate_unknown(self):
+        haTime, xOffset, yOffset, found = self.table.interpolate(5400, [1, 2], 10.)
+        self.assertFalse(found.any())
+        self.assertFalse(self.table.interpolate(16600, [99], 10.)[3].any())
+
+    def test_empty(self):
+        table = GuiderState.RefractionTable()
+        self.assertEqual(table.tables, {})
+        self.assertFalse(table.interpolate(16600, [1], 0.)[3].any())
+
+
+class TestCartridgeSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshots = GuiderState.CartridgeSnapshots(2)
+
+    def _snapshot(self, cartridge, plate, pointing='A'):
+        snapshot = GuiderState.CartridgeSnapshot(cartridge, pointing, ('plate=%d' % plate, ),
+                                                 {'plate': plate}, -1, 0)
+        self.snapshots.put(snapshot)
+        return snapshot
+
+    def test_get(self):
+        snapshot = self._snapshot(5, 6543)
+        self.assertIs(self.snapshots.get(5, 'A'), snapshot)
+        self.assertIsNone(self.snapshots.get(5, 'B'))
+        self.assertIsNone(self.snapshots.get(6, 'A'))
+
+    def test_put_replaces(self):
+        self._snapshot(5, 6543)
+        snapshot = self._snapshot(5, 7000)
+        self.assertEqual(len(self.snapshots), 1)
+        self.assertIs(self.snapshots.get(5, 'A'), snapshot)
+
+    def test_lru(self):
+        """The least recently used snapshot is evicted first, and get() counts as a use."""
+        self._snapshot(5, 6543)
+        self._snapshot(6, 7000)
+        self.snapshots.get(5, 'A')
+        self._snapshot(7, 7001)
+        self.assertEqual(len(self.snapshots), 2)
+        self.assertIsNone(self.snapshots.get(6, 'A'))
+        self.assertIsNotNone(self.snapshots.get(5, 'A'))
+        self.assertIsNotNone(self.snapshots.get(7, 'A'))
+
+    def test_disabled(self):
+        snapshots = GuiderState.CartridgeSnapshots(0)
+        snapshots.put(GuiderState.CartridgeSnapshot(5, 'A', (), {'plate': 6543}, -1, 0))
+        self.assertEqual(len(snapshots), 0)
+
+    def test_drop(self):
+        """drop() only forgets the snapshot it is given, not a newer one of its cartridge."""
+        old = self._snapshot(5, 6543)
+        new = self._snapshot(5, 7000)
+        self.snapshots.drop(old)
+        self.assertIs(self.snapshots.get(5, 'A'), new)
+        self.snapshots.drop(new)
+        self.assertEqual(len(self.snapshots), 0)
+
+    def test_clear(self):
+        self._snapshot(5, 6543)
+        self._snapshot(6, 7000)
+        self.assertEqual(self.snapshots.clear(6543), 1)
+        self.assertIsNone(self.snapshots.get(5, 'A'))
+        self.assertEqual(self.snapshots.clear(), 1)
+        self.assertEqual(len(self.snapshots), 0)
+
+    def test_matches(self):
+        snapshot = self._snapshot(5, 6543)
+        self.assertTrue(snapshot.matches(('plate=6543', )))
+        self.assertFalse(snapshot.matches(('plate=7000', )))
+
+    def test_matches_fscan(self):
+        """A replugging of the same plate, with only a new fscan, doesn't match."""
+        validation = ('', None, ('6543', '0', 'A'), '(None,)', '56789', '1')
+        snapshot = GuiderState.CartridgeSnapshot(5, 'A', validation, {'plate': 6543}, -1, 0)
+        self.assertTrue(snapshot.matches(validation))
+        self.assertFalse(snapshot.matches(validation[:-2] + ('56790', '1')))
+        self.assertFalse(snapshot.matches(validation[:-2] + ('56789', '2')))
+
+    def test_matches_offsets_changed(self):
+        """A rewritten plateGuideOffsets file means the snapshot is stale."""
+        fd, offsetsFile = tempfile.mkstemp(suffix='.par')
+        os.close(fd)
+        self.addCleanup(os.remove, offsetsFile)
+        snapshot = self._snapshot(5, 6543)
+        snapshot.offsetsFile = offsetsFile
+        snapshot.offsetsVersion = (os.path.getmtime(offsetsFile), 0)
+        self.assertTrue(snapshot.matches(('plate=6543', )))
+        with open(offsetsFile, 'w') as rewritten:
+            rewritten.write('typedef struct {')
+        self.assertFalse(snapshot.matches(('plate=6543', )))
+
+    def test_save_restore(self):
+        """The restored probes are a copy, so guiding can't change the snapshot."""
+        gState = GuiderState.GuiderState()
+        gState.gprobes[1] = GuiderState.GProbe(gprobeKey=gprobeKey['good'])
+        gState.allProbes = np.zeros(2, dtype=[('fiberId', 'i4')])
+        snapshot = self._snapshot(5, 6543)
+        snapshot.save(gState)
+        gState.deleteAllGprobes()
+        snapshot.restore(gState)
+        self.assertIs(gState.allProbes, snapshot.allProbes)
+        gState.gprobes[1].disabled = True
+        self.assertFalse(snapshot.gprobes[1].disabled)
+        snapshot.restore(gState)
+        self.assertFalse(gState.gprobes[1].disabled)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -12,6 +12,21 @@ from actorcore import TestHelper
 from guiderActor import masterThread
 
 
+class FakeTccActor(object):
+    """An actor whose TCC commands all succeed, and are kept in cmdStrs."""
+
+    class CmdVar(object):
+        didFail = False
+
+    def __init__(self):
+        self.cmdr = self
+        self.cmdStrs = []
+
+    def call(self, actor, forUserCmd, cmdStr, **kwargs):
+        self.cmdStrs.append(cmdStr)
+        return self.CmdVar()
+
+
 class TestMasterThread(guiderTester.GuiderTester, unittest.TestCase):
     """Test specific masterThread commands."""
 
@@ -71,6 +86,18 @@ class TestGuiderStep(guiderTester.GuiderTester, unittest.TestCase):
             else:
                 self.assertTrue(result, name)
 
+    def test_check_fibers(self):
+        """_check_fibers should check all the fibers just as _check_fiber checks each."""
+        self.gState.centerUp = False
+        self.fibers = self.gi(
+            self.cmd,
+            self.guidingIn,
+            self.gState.gprobes,
+            setPoint=self.setPoint_good)
+        result = masterThread._check_fibers(self.fibers, self.gState, self.cmd)
+        for i, fiber in enumerate(self.fibers):
+            self.assertEqual(result[i], masterThread._check_fiber(fiber, self.gState, self.cmd))
+
 
 class TestDecenter(guiderTester.GuiderTester, unittest.TestCase):
 
@@ -234,6 +261,7 @@ class TestStartStopGuider(guiderTester.GuiderTester, unittest.TestCase):
         self.assertEqual(msg.camera, kwargs.get('camera', 'gcamera'))
         self.assertEqual(msg.expTime, kwargs.get('expTime', 5))
         self.assertEqual(msg.stack, kwargs.get('stack', 1))
+        self.assertEqual(msg.guideRun, self.gState.guideRun)
         self._check_cmd(0, 1, nWarn, 0, False)
 
     def test_start_guider(self):
@@ -247,7 +275,10 @@ class TestStartStopGuider(guiderTester.GuiderTester, unittest.TestCase):
 
     def test_start_guider_already_running_force(self):
         self.gState.cmd = TestHelper.Cmd()
+        guideRun = self.gState.guideRun
         self._start_guider(force=True, nWarn=1)
+        # replies to the old run's exposures will be ignored.
+        self.assertEqual(self.gState.guideRun, guideRun + 1)
 
     def test_start_guider_ecamera(self):
         self._start_guider(camera='ecamera')
@@ -283,6 +314,39 @@ class TestStartStopGuider(guiderTester.GuiderTester, unittest.TestCase):
         self.assertEqual(self.gState.cmd, oldCmd)
         self._check_cmd(0, 0, 0, 0, True, True)
 
+    def test_request_exposure(self):
+        """The TCC moves so far are noted, to tell if the exposure straddles one."""
+        self.gState.cmd = self.cmd
+        self.gState.moveCount = 3
+        masterThread.request_exposure(self.queues, self.gState)
+        self.assertEqual(self.gState.exposeMoveCount, 3)
+        msg = self.queues[guiderActor.GCAMERA].get(False)
+        self.assertEqual(msg.type, guiderActor.Msg.EXPOSE)
+        self.assertIs(msg.replyQueue, self.queues[guiderActor.MASTER])
+        self.assertEqual(msg.camera, 'gcamera')
+        self.assertEqual(msg.guideRun, self.gState.guideRun)
+
+    def test_pipelined_cadence(self):
+        """
+        Pipelined, each exposure straddles the correction from the last one, so
+        it is marked as in motion and not guided on: corrections are made every other frame.
+        """
+        self.gState.cmd = self.cmd
+        self.gState.guideAxes = True
+        actor = FakeTccActor()
+        inMotion = []
+        masterThread.request_exposure(self.queues, self.gState)
+        for frameNo in range(4):
+            # The exposure finishes, and the next one is requested before processing it.
+            inMotion.append(self.gState.moveCount != self.gState.exposeMoveCount)
+            masterThread.request_exposure(self.queues, self.gState)
+            if not inMotion[-1]:
+                self.assertTrue(masterThread.apply_guide_offset(
+                    self.cmd, self.gState, actor, self.actorState,
+                    offsetRA=1e-4, offsetDec=-1e-4, offsetRot=0))
+        self.assertEqual(inMotion, [False, True, False, True])
+        self.assertEqual(len(actor.cmdStrs), 2)
+
     def _stop_guider(self, success=True):
         self.gState.cmd = self.cmd
         masterThread.stop_guider(self.cmd, self.gState, self.actorState,
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Test the on-disk cache of parsed plugmaps and guide offsets.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from guiderActor.plugmapCache import PlugmapCache
+
+
+class TestPlugmapCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.cache = PlugmapCache(os.path.join(self.tempDir, 'cache'))
+        self.array = np.zeros(3, dtype=[('holeType', 'S8'), ('fiberId', 'i4'),
+                                        ('mag', 'f4', (5, ))]).view(np.recarray)
+        self.array.holeType = ['GUIDE', 'MANGA', 'GUIDE']
+        self.array.fiberId = [1, 2, 3]
+        self.array.mag[1] = [1, 2, 3, 4, 5]
+        self.key = (5, 6543, 'A', 57000, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get('plugmap', 6543, self.key))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+
+    def test_hit(self):
+        self.cache.put('plugmap', 6543, self.key, self.array)
+        cached = self.cache.get('plugmap', 6543, self.key)
+        self.assertIsInstance(cached, np.memmap)
+        self.assertEqual(cached.dtype, self.array.dtype)
+        np.testing.assert_array_equal(cached, self.array)
+        np.testing.assert_array_equal(cached.view(np.recarray).mag[1], [1, 2, 3, 4, 5])
+        self.assertRaises(ValueError, cached.__setitem__, 0, cached[1])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_key(self):
+        """Anything in the key changing is a different entry, but str() equal keys are not."""
+        self.cache.put('plugmap', 6543, self.key, self.array)
+        self.assertIsNone(self.cache.get('plugmap', 6543, (5, 6543, 'A', 57000, 4)))
+        self.assertIsNone(self.cache.get('guideOffsets', 6543, self.key))
+        self.assertIsNotNone(self.cache.get('plugmap', 6543, (5, 6543, u'A', '57000', 3)))
+
+    def test_no_cacheDir(self):
+        cache = PlugmapCache()
+        cache.put('plugmap', 6543, self.key, self.array)
+        self.assertIsNone(cache.get('plugmap', 6543, self.key))
+        self.assertEqual(cache.status(), (0, 0., 0, 1))
+        self.assertEqual(cache.clear(), 0)
+
+    def test_not_cached(self):
+        """Arrays of objects can't be memory-mapped, and corrupt files are misses."""
+        self.cache.put('plugmap', 6543, self.key, np.array([None, 1]))
+        self.assertIsNone(self.cache.get('plugmap', 6543, self.key))
+        self.cache.put('plugmap', 6543, self.key, self.array)
+        with open(self.cache.path('plugmap', 6543, self.key), 'w') as corrupt:
+            corrupt.write('not an npy file')
+        self.assertIsNone(self.cache.get('plugmap', 6543, self.key))
+
+    def test_clear(self):
+        self.cache.put('plugmap', 6543, self.key, self.array)
+        self.cache.put('guideOffsets', 6543, self.key, self.array)
+        self.cache.put('plugmap', 7000, self.key, self.array)
+        self.assertEqual(self.cache.status()[0], 3)
+        self.assertEqual(self.cache.clear(6543), 2)
+        self.assertIsNone(self.cache.get('plugmap', 6543, self.key))
+        self.assertIsNotNone(self.cache.get('plugmap', 7000, self.key))
+        self.assertEqual(self.cache.clear(), 1)
+        self.assertEqual(os.listdir(self.cache.cacheDir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
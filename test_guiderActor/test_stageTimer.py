@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Test the per-stage timing of the guide loop.
+"""
+import unittest
+
+import numpy as np
+
+from guiderActor import stageTimer
+
+
+class TestFrameTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = stageTimer.FrameTimer()
+
+    def test_monotonic(self):
+        t0 = stageTimer.monotonic()
+        self.assertGreaterEqual(stageTimer.monotonic(), t0)
+
+    def test_stage_accumulates(self):
+        with self.timer.stage('pid'):
+            pass
+        first = self.timer.times['pid']
+        with self.timer.stage('pid'):
+            pass
+        self.assertGreaterEqual(self.timer.times['pid'], first)
+        self.assertNotIn('fit', self.timer.times)
+
+    def test_stage_exception(self):
+        """A stage that raises is still timed."""
+        with self.assertRaises(ValueError):
+            with self.timer.stage('fit'):
+                raise ValueError('bad fit')
+        self.assertIn('fit', self.timer.times)
+
+    def test_keyword(self):
+        self.timer.times = {'header': 0.0012, 'tcc': 0.25}
+        values = self.timer.keyword(42).split('=')[1].split(',')
+        self.assertEqual(values[0], '42')
+        self.assertEqual(len(values), len(stageTimer.STAGES) + 2)
+        self.assertEqual(values[1], '1.2')
+        self.assertEqual(values[stageTimer.STAGES.index('tcc') + 1], '250.0')
+        self.assertEqual(values[stageTimer.STAGES.index('fit') + 1], 'nan')
+
+    def test_loadKeyword(self):
+        self.timer.times = {'platedb': 0.5, 'fit': 1.0}
+        values = self.timer.loadKeyword(7).split('=')[1].split(',')
+        self.assertEqual(values[0], '7')
+        self.assertEqual(len(values), len(stageTimer.LOAD_STAGES) + 2)
+        self.assertEqual(values[stageTimer.LOAD_STAGES.index('platedb') + 1], '500.0')
+        self.assertEqual(values[stageTimer.LOAD_STAGES.index('mcp') + 1], 'nan')
+
+
+class TestStageTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = stageTimer.StageTimings(nFrames=100)
+
+    def _add(self, **times):
+        timer = stageTimer.FrameTimer()
+        timer.times = times
+        self.timings.add(timer)
+
+    def test_percentiles(self):
+        for i in range(1, 201):
+            self._add(fit=i * 1e-3)
+        nFrames, (p50, p95, p99) = self.timings.percentiles('fit')
+        # only the last 100 frames are kept.
+        self.assertEqual(nFrames, 100)
+        np.testing.assert_allclose((p50, p95, p99), np.percentile(np.arange(101, 201) * 1e-3,
+                                                                  (50, 95, 99)))
+        self.assertEqual(self.timings.percentiles(stageTimer.TOTAL)[0], 100)
+
+    def test_empty(self):
+        nFrames, percentiles = self.timings.percentiles('tcc')
+        self.assertEqual(nFrames, 0)
+        self.assertTrue(np.isnan(percentiles).all())
+
+    def test_clear(self):
+        self._add(fit=1.0, unknown=2.0)
+        self.timings.clear()
+        self.assertEqual(self.timings.percentiles('fit')[0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
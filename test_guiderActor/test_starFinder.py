@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Test the numpy star finder, against the synthetic stars and gfindstars().
+"""
+import unittest
+
+import numpy as np
+
+import syntheticGimg
+from guiderActor.gimg import guideLib, starFinder
+
+
+class TestStarFinder(unittest.TestCase):
+
+    def setUp(self):
+        self.cart = syntheticGimg.SyntheticCartridge(nGuide=6, nAcquire=0, seed=2)
+        self.stars = self.cart.stars(flux=2e4)
+        image = np.full((512, 512), 50, np.float64)
+        for star in self.stars:
+            image += syntheticGimg.psf((slice(0, 512), slice(0, 512)), star.x, star.y, star.flux,
+                                       star.fwhm / syntheticGimg.PIXEL_ARCSEC)
+        self.image = image.astype(np.int16)
+        fiberids = sorted(self.cart.gprobeKeys)
+        xcen, ycen = zip(*[self.cart.fiber_center(fid) for fid in fiberids])
+        radius = [self.cart.gprobeKeys[fid][5] for fid in fiberids]
+        self.fiberData = guideLib.FiberData(fiberids, xcen, ycen, radius, radius)
+
+    def index(self, star):
+        return list(self.fiberData.fiberid).index(star.fiberid)
+
+    def test_find_stars(self):
+        starFinder.find_stars(self.image, self.fiberData)
+        for star in self.stars:
+            i = self.index(star)
+            self.assertAlmostEqual(self.fiberData.xs[i], star.x, delta=0.05)
+            self.assertAlmostEqual(self.fiberData.ys[i], star.y, delta=0.05)
+            self.assertAlmostEqual(self.fiberData.fwhm[i],
+                                   star.fwhm / syntheticGimg.PIXEL_ARCSEC, delta=0.2)
+            self.assertAlmostEqual(self.fiberData.flux[i], star.flux, delta=0.01 * star.flux)
+            self.assertAlmostEqual(self.fiberData.sky[i], 50, delta=1)
+            self.assertLess(self.fiberData.poserr[i], 1)
+
+    def test_like_gfindstars(self):
+        """The two finders should put the stars in the same places."""
+        other = self.fiberData.copy()
+        guideLib.find_stars(self.image, other)
+        starFinder.find_stars(self.image, self.fiberData)
+        np.testing.assert_allclose(self.fiberData.xs, other.xs, atol=0.1)
+        np.testing.assert_allclose(self.fiberData.ys, other.ys, atol=0.1)
+        np.testing.assert_allclose(self.fiberData.fwhm, other.fwhm, rtol=0.1)
+
+    def test_no_star(self):
+        star = self.stars[0]
+        i = self.index(star)
+        image = np.full_like(self.image, 50)
+        starFinder.find_stars(image, self.fiberData)
+        self.assertEqual(self.fiberData.fwhm[i], guideLib.FWHM_BAD)
+        self.assertEqual(self.fiberData.flux[i], 0)
+        self.assertEqual(self.fiberData.poserr[i], 99.99)
+
+    def test_masked_pixels(self):
+        """Zeroed (masked) pixels shouldn't pull the star or the sky."""
+        star = self.stars[0]
+        i = self.index(star)
+        image = self.image.copy()
+        ycen = self.fiberData.ycen[i]
+        image[int(ycen) - 6:int(ycen) - 3, :] = 0
+        starFinder.find_stars(image, self.fiberData)
+        self.assertAlmostEqual(self.fiberData.xs[i], star.x, delta=0.1)
+        self.assertAlmostEqual(self.fiberData.ys[i], star.y, delta=0.1)
+        self.assertAlmostEqual(self.fiberData.sky[i], 50, delta=1)
+
+    def test_cut_stamps_edge(self):
+        image = np.arange(100.).reshape(10, 10)
+        good = np.ones(image.shape, bool)
+        stamps, ok, x, y = starFinder.cut_stamps(image, good, np.array([0., 5.]),
+                                                 np.array([9., 5.]), 1)
+        self.assertEqual(stamps.shape, (2, 3, 3))
+        # the first stamp hangs off the first column and the last row.
+        np.testing.assert_array_equal(ok[0], [[False, True, True], [False, True, True],
+                                              [False, False, False]])
+        np.testing.assert_array_equal(stamps[1], image[4:7, 4:7])
+        np.testing.assert_array_equal(x[1, 0], [4, 5, 6])
+        np.testing.assert_array_equal(y[1, :, 0], [4, 5, 6])
+
+    def test_masked_median(self):
+        values = np.array([[1., 2., 3., 100.], [5., 6., 7., 8.], [1., 1., 1., 1.]])
+        mask = np.array([[True, True, True, False], [True, True, True, True], [False] * 4])
+        np.testing.assert_array_equal(starFinder.masked_median(values, mask, default=-1),
+                                      [2., 6.5, -1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Test the synthetic guider frame generator.
+"""
+import math
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pyfits
+
+import syntheticGimg
+
+
+class TestSyntheticGimg(unittest.TestCase):
+
+    def setUp(self):
+        self.cart = syntheticGimg.SyntheticCartridge(nGuide=6, nAcquire=1, flatOffset=(2., -1.),
+                                                     seed=3)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_gprobes(self):
+        gprobes = self.cart.gprobes()
+        self.assertEqual(sorted(gprobes), range(1, 8))
+        self.assertEqual(gprobes[1].fiber_type, 'ACQUIRE')
+        self.assertEqual(gprobes[1].radius, 28.5)
+        self.assertEqual(gprobes[2].fiber_type, 'GUIDE')
+        self.assertEqual(gprobes[2].radius, 8.5)
+        for gprobe in gprobes.values():
+            self.assertFalse(gprobe.disabled)
+            self.assertTrue(0 < gprobe.xCenter < 512)
+
+    def test_too_many_fibers(self):
+        self.assertRaises(ValueError, syntheticGimg.SyntheticCartridge, nGuide=500)
+
+    def test_stars_offset(self):
+        """get_fibers_dra_ddec's rotation of each star's pixel offset should give its dRA, dDec."""
+        stars = self.cart.stars((0.01, -0.02, 0., 0.))
+        for star in stars:
+            key = self.cart.gprobeKeys[star.fiberid]
+            xcen, ycen = self.cart.fiber_center(star.fiberid)
+            dx = (star.x - xcen) * syntheticGimg.PIXEL_MM
+            dy = (star.y - ycen) * syntheticGimg.PIXEL_MM
+            theta = math.radians(90 + key[6] - self.cart.guideInfoKeys[star.fiberid][5])
+            ct, st = math.cos(theta), math.sin(theta)
+            self.assertAlmostEqual(dx * ct + dy * st, 0.01)
+            self.assertAlmostEqual(-(-dx * st + dy * ct), -0.02)
+
+    def test_write_frames(self):
+        frames = syntheticGimg.write_frames(self.directory, self.cart, flux=1e5)
+        dark = pyfits.open(self.directory + '/gimg-0001.fits.gz')[0]
+        flat = pyfits.open(self.directory + '/gimg-0002.fits.gz')[0]
+        self.assertEqual(dark.header['IMAGETYP'], 'dark')
+        self.assertEqual(dark.data.shape, (512, 524))
+        self.assertEqual(flat.header['IMAGETYP'], 'flat')
+        self.assertEqual(flat.data.shape, (1024, 1048))
+        self.assertEqual(flat.data.dtype, np.uint16)
+
+        filename, stars = frames[0]
+        obj = pyfits.open(filename)[0]
+        self.assertEqual(obj.header['FLATFILE'], self.directory + '/gimg-0002.fits.gz')
+        self.assertEqual(obj.header['DARKFILE'], self.directory + '/gimg-0001.fits.gz')
+        image = obj.data.astype(np.float64) - np.median(obj.data[:, 512:])
+        yy, xx = np.mgrid[:512, :512]
+        for star in stars:
+            xcen, ycen = self.cart.fiber_center(star.fiberid)
+            radius = self.cart.gprobeKeys[star.fiberid][5]
+            inside = (xx - xcen)**2 + (yy - ycen)**2 <= radius**2
+            # remove the sky to centroid the star.
+            weight = np.clip(image[:, :512] - 100, 0, None) * inside
+            self.assertAlmostEqual((weight * xx).sum() / weight.sum(), star.x, delta=0.05)
+            self.assertAlmostEqual((weight * yy).sum() / weight.sum(), star.y, delta=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Test the background proc- file writer.
+"""
+import threading
+import unittest
+
+from guiderActor import writerThread
+
+
+class FakeCmd(object):
+    def __init__(self):
+        self.messages = []
+
+    def warn(self, text):
+        self.messages.append(('w', text))
+
+    def error(self, text):
+        self.messages.append(('e', text))
+
+
+class FakeJob(object):
+    """A job that records that it was written, after waiting for release to be set."""
+
+    def __init__(self, name, written, release=None, fail=False, droppable=True):
+        self.cmd = FakeCmd()
+        self.filename = name
+        self.written = written
+        self.release = release
+        self.fail = fail
+        self.droppable = droppable
+
+    def write(self):
+        if self.release is not None:
+            self.release.wait()
+        if self.fail:
+            raise IOError('disk full')
+        self.written.append(self.filename)
+
+
+class TestProcFileWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.release = threading.Event()
+
+    def _writer(self, **kwargs):
+        writer = writerThread.ProcFileWriter(**kwargs)
+        self.addCleanup(writer.stop)
+        return writer
+
+    def test_in_order(self):
+        writer = self._writer(maxQueue=2)
+        names = ['proc-gimg-%04d.fits.gz' % i for i in range(10)]
+        for name in names:
+            writer.put(FakeJob(name, self.written))
+        writer.flush()
+        self.assertEqual(self.written, names)
+        status = writer.status()
+        self.assertEqual(status[:5], (0, 2, 10, 0, 0))
+        self.assertGreaterEqual(status[6], status[5])
+
+    def test_drop_oldest(self):
+        writer = self._writer(maxQueue=2, policy=writerThread.DROP_OLDEST)
+        # the first job keeps the thread busy until we release it.
+        first = FakeJob('first', self.written, self.release)
+        writer.put(first)
+        while writer.queue.qsize() > 0:
+            pass
+        jobs = [FakeJob(name, self.written) for name in 'abcd']
+        for job in jobs:
+            writer.put(job)
+        self.release.set()
+        writer.flush()
+        self.assertEqual(self.written, ['first', 'c', 'd'])
+        self.assertEqual(writer.nDropped, 2)
+        self.assertEqual(jobs[0].cmd.messages[0][0], 'w')
+
+    def test_never_drop_calibrations(self):
+        """Calibrations stay queued, and a drop-policy put waits if they fill the queue."""
+        writer = self._writer(maxQueue=2, policy=writerThread.DROP_OLDEST)
+        first = FakeJob('first', self.written, self.release)
+        writer.put(first)
+        while writer.queue.qsize() > 0:
+            pass
+        writer.put(FakeJob('proc-dark', self.written, droppable=False))
+        writer.put(FakeJob('a', self.written))
+        writer.put(FakeJob('b', self.written))
+        self.assertEqual(writer.nDropped, 1)
+        putter = threading.Thread(target=writer.put,
+                                  args=(FakeJob('proc-flat', self.written, droppable=False), ))
+        putter.start()
+        self.release.set()
+        putter.join()
+        writer.flush()
+        self.assertEqual(self.written, ['first', 'proc-dark', 'b', 'proc-flat'])
+        self.assertEqual(writer.nDropped, 1)
+
+    def test_onWritten(self):
+        """A ProcFileJob calls onWritten once its file has been written."""
+        calls = []
+        writeFits = writerThread.actorFits.writeFits
+        self.addCleanup(setattr, writerThread.actorFits, 'writeFits', writeFits)
+        writerThread.actorFits.writeFits = lambda *args, **kwargs: calls.append('write')
+        job = writerThread.ProcFileJob(FakeCmd(), None, 'dir', 'proc-dark.fits.gz',
+                                       announce=False, droppable=False,
+                                       onWritten=lambda: calls.append('cache'))
+        writer = self._writer(policy=writerThread.DROP_OLDEST)
+        writer.put(job)
+        writer.flush()
+        self.assertEqual(calls, ['write', 'cache'])
+
+    def test_failure(self):
+        writer = self._writer()
+        job = FakeJob('bad', self.written, fail=True)
+        writer.put(job)
+        writer.put(FakeJob('good', self.written))
+        writer.flush()
+        self.assertEqual(self.written, ['good'])
+        self.assertEqual(writer.nFailed, 1)
+        self.assertEqual(job.cmd.messages[0][0], 'e')
+
+    def test_stop_flushes(self):
+        writer = writerThread.ProcFileWriter(maxQueue=4)
+        for name in 'abc':
+            writer.put(FakeJob(name, self.written))
+        writer.stop()
+        self.assertEqual(self.written, ['a', 'b', 'c'])
+        self.assertFalse(writer.thread.is_alive())
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, writerThread.ProcFileWriter, policy='sometimes')
+
+
+if __name__ == '__main__':
+    unittest.main()